@@ -0,0 +1,284 @@
+"""
+#
+# Harvest the extent, feature count and per-agency statistics of the ITS
+# FeatureServer layers from the ArcGIS REST API: returnExtentOnly and
+# returnCountOnly queries, outStatistics grouped by agency, and concurrent
+# resultOffset/resultRecordCount paging when the layer has no statistics
+#
+"""
+
+import json
+import os
+
+from coordinates import convert_envelopes_to_lat_lon
+from http_client import get_session
+from metrics import timed
+from worker_pool import run_ordered
+
+ITS_LAYERS = ('ITS_V1_1_points_gdb', 'ITS_V1_1_lines_gdb', 'ITS_V1_1_polygons_gdb')
+
+# wkids ArcGIS uses for EPSG codes
+ESRI_WKIDS = {102100: 3857, 102113: 3857}
+
+
+def layer_url(layer_name):
+    """
+    The URL of a layer in the Hosted folder of the ArcGIS server,
+    its_arcgis_url in .env.
+    """
+    arcgis_url = os.getenv('its_arcgis_url', "https://sparcal.sdsc.edu/arcgis/rest/services/Hosted").rstrip('/')
+    return f"{arcgis_url}/{layer_name}/FeatureServer/0"
+
+
+def arcgis_get(url, params):
+    """
+    GET an ArcGIS REST endpoint as JSON.
+
+    ArcGIS answers most errors with a 200 and an error object, which is
+    raised like an HTTP error.
+    """
+    response = get_session().get(url, params=dict(params, f='json'))
+    response.raise_for_status()
+    try:
+        document = response.json()
+    except ValueError:
+        raise BaseException(f"{url} did not return JSON")
+    if 'error' in document:
+        error = document['error']
+        raise BaseException(f"ArcGIS error from {url}: {error.get('message', error)} {error.get('details') or ''}")
+    return document
+
+
+def find_field(layer_info, name):
+    """
+    The actual name of a field of the layer, matched case insensitively,
+    or None.
+    """
+    if not name:
+        return None
+    for field in layer_info.get('fields') or []:
+        if field['name'].lower() == name.lower():
+            return field['name']
+    return None
+
+
+def envelope_to_bbox(envelope):
+    """
+    Convert an ArcGIS envelope to (min_lon, min_lat, max_lon, max_lat).
+
+    Returns:
+    - tuple, or None for an empty envelope or one that cannot be reprojected.
+    """
+    if not envelope or envelope.get('xmin') is None or envelope.get('xmin') == 'NaN':
+        return None
+    spatial_reference = envelope.get('spatialReference') or {}
+    wkid = spatial_reference.get('latestWkid') or spatial_reference.get('wkid') or 4326
+    epsg_code = str(ESRI_WKIDS.get(wkid, wkid))
+    lat_lon_bbox = convert_envelopes_to_lat_lon([((envelope['xmin'], envelope['ymin']),
+                                                  (envelope['xmax'], envelope['ymax']), epsg_code)])[0]
+    if lat_lon_bbox is None:
+        return None
+    (lat_min, lon_min), (lat_max, lon_max) = lat_lon_bbox
+    return lon_min, lat_min, lon_max, lat_max
+
+
+@timed('arcgis_layer_extent')
+def get_layer_extent(url, layer_info):
+    """
+    The extent of the features of a layer in longitude and latitude, from a
+    returnExtentOnly query, or from the layer description when the server
+    does not support it.
+    """
+    try:
+        document = arcgis_get(f"{url}/query", {'where': '1=1', 'returnExtentOnly': 'true', 'outSR': 4326})
+        return envelope_to_bbox(document.get('extent'))
+    except BaseException as e:
+        print(f"Using the extent of the description of {url}: {e}")
+        return envelope_to_bbox(layer_info.get('extent'))
+
+
+@timed('arcgis_layer_count')
+def get_layer_count(url):
+    return arcgis_get(f"{url}/query", {'where': '1=1', 'returnCountOnly': 'true'})['count']
+
+
+def add_statistics(statistics, agency, features, area=None):
+    agency = agency if agency not in (None, '') else 'Unknown'
+    entry = statistics.setdefault(agency, {'features': 0})
+    entry['features'] += features
+    if area is not None:
+        entry['area'] = entry.get('area', 0) + area
+
+
+@timed('arcgis_layer_statistics')
+def query_statistics(url, object_id_field, agency_field, area_field=None):
+    """
+    Per-agency feature counts, and area sums, computed by the server with
+    outStatistics grouped by the agency field.
+    """
+    out_statistics = [{'statisticType': 'count', 'onStatisticField': object_id_field,
+                       'outStatisticFieldName': 'feature_count'}]
+    if area_field:
+        out_statistics.append({'statisticType': 'sum', 'onStatisticField': area_field,
+                               'outStatisticFieldName': 'area_sum'})
+    document = arcgis_get(f"{url}/query", {
+        'where': '1=1',
+        'groupByFieldsForStatistics': agency_field,
+        'outStatistics': json.dumps(out_statistics),
+    })
+    statistics = {}
+    for feature in document.get('features', []):
+        # some servers change the case of the output field names
+        attributes = {key.lower(): value for key, value in feature['attributes'].items()}
+        add_statistics(statistics, attributes.get(agency_field.lower()), attributes.get('feature_count') or 0,
+                       (attributes.get('area_sum') or 0) if area_field else None)
+    return statistics
+
+
+@timed('arcgis_layer_page')
+def query_page(url, fields, order_by, offset, page_size):
+    document = arcgis_get(f"{url}/query", {
+        'where': '1=1',
+        'outFields': ','.join(fields),
+        'returnGeometry': 'false',
+        'orderByFields': order_by,
+        'resultOffset': offset,
+        'resultRecordCount': page_size,
+    })
+    return [feature['attributes'] for feature in document.get('features', [])]
+
+
+def iter_features(url, fields, order_by, count, page_size, workers=None):
+    """
+    Yield the attributes of every feature of a layer, fetching pages of
+    page_size features concurrently. Only a window of pages is held in
+    memory at a time, however large the layer.
+    """
+    offsets = range(0, count, page_size)
+    for offset, page, error in run_ordered(lambda offset: query_page(url, fields, order_by, offset, page_size),
+                                           offsets, workers):
+        if error is not None:
+            raise BaseException(f"Failed to read the features {offset} to {offset + page_size} of {url}: {error}")
+        yield from page
+
+
+@timed('arcgis_layer_paging')
+def page_statistics(url, object_id_field, agency_field, count, area_field=None, page_size=None, workers=None):
+    """
+    The same statistics as query_statistics, aggregated while paging
+    through the features.
+    """
+    fields = [object_id_field, agency_field] + ([area_field] if area_field else [])
+    statistics = {}
+    for attributes in iter_features(url, fields, object_id_field, count, page_size, workers):
+        add_statistics(statistics, attributes.get(agency_field), 1,
+                       (attributes.get(area_field) or 0) if area_field else None)
+    return statistics
+
+
+@timed('harvest_arcgis_layer')
+def harvest_layer(layer_name, agency_field=None, area_field=None, page_size=None, workers=None):
+    """
+    Harvest one FeatureServer layer.
+
+    Parameters:
+    - layer_name: str, such as ITS_V1_1_points_gdb.
+    - agency_field: str, its_agency_field in .env, AGENCY by default.
+    - area_field: str, a numeric field summed per agency, its_area_field in
+      .env, none by default.
+    - page_size: int, features per page when paging, its_page_size in .env,
+      capped by the maxRecordCount of the layer, 2000 by default.
+    - workers: int, pages fetched concurrently, its_page_workers in .env, 4 by default.
+
+    Returns:
+    - dict with the name, url, count, bbox (min_lon, min_lat, max_lon,
+      max_lat) or None, statistics {agency: {'features', 'area'}} and the
+      method used for them, 'statistics' or 'paging'.
+    """
+    if agency_field is None:
+        agency_field = os.getenv('its_agency_field', 'AGENCY')
+    if area_field is None:
+        area_field = os.getenv('its_area_field') or None
+    if page_size is None:
+        page_size = int(os.getenv('its_page_size', 2000))
+    if workers is None:
+        workers = int(os.getenv('its_page_workers', 4))
+
+    url = layer_url(layer_name)
+    layer_info = arcgis_get(url, {})
+    count = get_layer_count(url)
+    bbox = get_layer_extent(url, layer_info)
+
+    object_id_field = layer_info.get('objectIdField') or 'OBJECTID'
+    agency_field = find_field(layer_info, agency_field)
+    area_field = find_field(layer_info, area_field)
+    statistics = {}
+    method = None
+    if agency_field is not None and count:
+        capabilities = layer_info.get('advancedQueryCapabilities') or {}
+        if capabilities.get('supportsStatistics', True):
+            try:
+                statistics = query_statistics(url, object_id_field, agency_field, area_field)
+                method = 'statistics'
+            except BaseException as e:
+                print(f"Paging through {url} instead: {e}")
+        if method is None:
+            page_size = min(page_size, layer_info.get('maxRecordCount') or page_size)
+            statistics = page_statistics(url, object_id_field, agency_field, count, area_field, page_size, workers)
+            method = 'paging'
+
+    return {
+        'name': layer_name,
+        'url': url,
+        'count': count,
+        'bbox': bbox,
+        'statistics': statistics,
+        'method': method,
+    }
+
+
+def merge_bboxes(bboxes):
+    bboxes = [bbox for bbox in bboxes if bbox is not None]
+    if not bboxes:
+        return None
+    return (min(bbox[0] for bbox in bboxes), min(bbox[1] for bbox in bboxes),
+            max(bbox[2] for bbox in bboxes), max(bbox[3] for bbox in bboxes))
+
+
+def merge_statistics(layers):
+    statistics = {}
+    for layer in layers:
+        for agency, entry in layer['statistics'].items():
+            add_statistics(statistics, agency, entry['features'], entry.get('area'))
+    return dict(sorted(statistics.items()))
+
+
+@timed('harvest_its_layers')
+def harvest_its_layers(layer_names=ITS_LAYERS):
+    """
+    Harvest the ITS layers concurrently.
+
+    Returns:
+    - dict of layer name -> the harvest_layer result, or None for a layer
+      that could not be harvested.
+    """
+    layers = {}
+    for layer_name, layer, error in run_ordered(harvest_layer, layer_names, len(layer_names)):
+        if error is not None:
+            print(f"Failed to harvest the ArcGIS layer {layer_name}: {error}")
+        layers[layer_name] = layer
+    return layers
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    try:
+        layers = harvest_its_layers()
+        for layer in layers.values():
+            if layer is not None:
+                print(json.dumps(layer, indent=1))
+    except BaseException as e:
+        print(f"Error: {str(e)}")
@@ -0,0 +1,107 @@
+"""
+#
+# Measure the startup cost of each command: the time to import the modules
+# a command needs, in a fresh interpreter, and whether the heavy geo
+# dependencies get loaded on the way.
+#
+# Usage: python benchmarks/bench_import.py [--repeat 7] [--top 5] [--budget-ms 250]
+#
+# With --budget-ms the script exits with status 1 when a command takes
+# longer to import, so that it can guard cron and container cold starts.
+#
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# command -> the modules it imports
+COMMANDS = {
+    'cli --help': ['cli'],
+    'publish its': ['cli', 'save_clm_and_its_to_ckan', 'save_its_to_ckan'],
+    'publish clm': ['cli', 'save_clm_and_its_to_ckan', 'save_clm_to_ckan'],
+    'publish clm --async': ['cli', 'save_clm_and_its_to_ckan', 'clm_pipeline'],
+    'delete': ['cli', 'delete_clm_and_its_from_ckan'],
+    'dry-run': ['cli', 'dry_run'],
+}
+
+# loaded only once a dataset needs to be reprojected
+HEAVY_MODULES = ('pyproj',)
+
+PROBE = """
+import sys, time
+start = time.perf_counter()
+for module in sys.argv[1:]:
+    __import__(module)
+elapsed = time.perf_counter() - start
+print(elapsed, ','.join(name for name in {heavy!r} if name in sys.modules))
+"""
+
+
+def measure(modules, repeat):
+    """
+    Import modules in repeat fresh interpreters.
+
+    Returns:
+    - (median seconds, heavy modules loaded, -X importtime lines of the last run)
+    """
+    samples = []
+    for _ in range(repeat):
+        completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', PROBE.format(heavy=HEAVY_MODULES),
+                                    *modules], cwd=REPO_DIR, capture_output=True, text=True)
+        if completed.returncode != 0:
+            raise RuntimeError(f"importing {modules} failed:\n{completed.stderr}")
+        elapsed, _, heavy = completed.stdout.strip().partition(' ')
+        samples.append(float(elapsed))
+    return statistics.median(samples), heavy, completed.stderr.splitlines()
+
+
+def slowest_imports(importtime_lines, exclude, top):
+    """
+    The top imports by cumulative time, from -X importtime output, as
+    (microseconds, module). A module is counted with everything it imports,
+    so nested imports overlap with their parents.
+    """
+    imports = []
+    for line in importtime_lines:
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if name.strip() not in exclude:
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the import time of each command")
+    parser.add_argument("--repeat", type=int, default=7, help="fresh interpreters per command")
+    parser.add_argument("--top", type=int, default=5, help="slowest imports to list per command")
+    parser.add_argument("--budget-ms", type=float, default=None,
+                        help="fail when a command takes longer than this to import")
+    args = parser.parse_args()
+
+    # the interpreter startup, and the entry modules themselves
+    _, _, startup_lines = measure([], 1)
+    startup = {line.rpartition('|')[2].strip() for line in startup_lines}
+
+    over_budget = []
+    print(f"{'command':<24}{'import ms':>10}  heavy modules")
+    for command, modules in COMMANDS.items():
+        seconds, heavy, importtime_lines = measure(modules, args.repeat)
+        print(f"{command:<24}{seconds * 1000:>10.1f}  {heavy or '-'}")
+        for microseconds, name in slowest_imports(importtime_lines, startup | set(modules), args.top):
+            print(f"{'':<26}{microseconds / 1000:>8.1f} ms  {name}")
+        if args.budget_ms is not None and seconds * 1000 > args.budget_ms:
+            over_budget.append(command)
+
+    if over_budget:
+        print(f"over the {args.budget_ms:g} ms budget: {', '.join(over_budget)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""
+#
+# Measure publish runs against the local fakes: end-to-end throughput,
+# per-stage latency percentiles and peak memory of save_clm_to_ckan,
+# the asyncio CLM pipeline, save_its_to_ckan and the delete path.
+#
+# Usage: python benchmarks/bench_publish.py [--datasets 100 1000 ...]
+#            [--scenarios clm clm-async its delete] [--latency 0.005]
+#            [--ckan-latency 0.02] [--error-rate 0.01] [--workers 8] [--no-memory]
+#
+# Every scenario runs in a fresh process, in a temporary directory holding
+# a synthetic dataset_keywords_map.json and clm_download_urls.json, with an
+# empty HTTP cache and its own package export. The fakes run in their own
+# process so that neither their CPU time nor their memory is counted.
+#
+"""
+
+import argparse
+import functools
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(1, os.path.join(BENCH_DIR, '..'))
+
+import fakes
+
+SCENARIOS = ('clm', 'clm-async', 'its', 'delete')
+
+
+class StageTimer:
+    """
+    Records the duration of wrapped calls per stage. A stage called from
+    another one is only counted in its own stage, not in its caller's.
+    """
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def wrap(self, stage, func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            stack = self.local.__dict__.setdefault('stack', [])
+            stack.append(0.0)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                nested = stack.pop()
+                if stack:
+                    stack[-1] += elapsed
+                with self.lock:
+                    self.samples[stage].append(elapsed - nested)
+        return timed
+
+    def patch(self, stage, module, name):
+        setattr(module, name, self.wrap(stage, getattr(module, name)))
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_scenario(scenario, workers, trace_memory):
+    """
+    Run one scenario in this process, which the parent prepared with the
+    environment and working directory. Returns the measurements.
+    """
+    import arcgis_harvest
+    import capabilities_extent
+    import ckan_publish
+    import clm_pipeline
+    import dataset_hierarchy
+    import delete_clm_and_its_from_ckan
+    import download_metadata
+    import save_clm_to_ckan
+    import save_its_to_ckan
+    import wms_extent
+
+    timer = StageTimer()
+    # startup fetches
+    timer.patch('rrk datasets page', save_clm_to_ckan, 'get_clm_dataset_page')
+    timer.patch('rrk hierarchy', dataset_hierarchy, 'get_clm_hierarchy')
+    timer.patch('wms capabilities', wms_extent, 'get_wms_info')
+    timer.patch('wcs/wfs capabilities', capabilities_extent, 'get_coverage_extents')
+    timer.patch('wcs/wfs capabilities', capabilities_extent, 'get_feature_type_extents')
+    timer.patch('download HEAD', download_metadata, 'head_download')
+    timer.patch('arcgis count', arcgis_harvest, 'get_layer_count')
+    timer.patch('arcgis extent', arcgis_harvest, 'get_layer_extent')
+    timer.patch('arcgis statistics', arcgis_harvest, 'query_statistics')
+    timer.patch('arcgis page', arcgis_harvest, 'query_page')
+    # per dataset
+    timer.patch('extent', save_clm_to_ckan, 'get_dataset_extents')
+    timer.patch('describe coverage', save_clm_to_ckan, 'get_wcs_extent')
+    timer.patch('transform', save_clm_to_ckan, 'transform_to_ckan_package')
+    timer.patch('delete', delete_clm_and_its_from_ckan, 'delete_package')
+    timer.patch('search', delete_clm_and_its_from_ckan, 'get_clm_and_its_package_ids')
+    for module in (save_clm_to_ckan, clm_pipeline):
+        module.get_clm_hierarchy = dataset_hierarchy.get_clm_hierarchy
+    for name in ('get_clm_dataset_page', 'get_dataset_extents', 'transform_to_ckan_package'):
+        setattr(clm_pipeline, name, getattr(save_clm_to_ckan, name))
+
+    published = []
+    publish = timer.wrap('publish', lambda package_dict: published.append(ckan_publish.create_dataset(package_dict)))
+
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    error = None
+    try:
+        if scenario == 'clm':
+            save_clm_to_ckan.save_clm_to_ckan(workers=workers, publish=publish)
+        elif scenario == 'clm-async':
+            clm_pipeline.save_clm_to_ckan_async(publish=publish)
+        elif scenario == 'its':
+            save_its_to_ckan.save_its_to_ckan(publish=publish)
+        elif scenario == 'delete':
+            delete_clm_and_its_from_ckan.delete_clm_and_its_packages(workers=workers)
+    except BaseException as e:
+        error = str(e)[:200]
+    elapsed = time.perf_counter() - start
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    items = len(timer.samples['delete']) if scenario == 'delete' else len(published)
+    stages = {
+        stage: {
+            'count': len(values),
+            'p50': percentile(values, 0.50),
+            'p90': percentile(values, 0.90),
+            'p99': percentile(values, 0.99),
+            'max': max(values),
+        }
+        for stage, values in timer.samples.items() if values
+    }
+    return {'seconds': elapsed, 'items': items, 'stages': stages, 'peak_bytes': peak, 'error': error}
+
+
+def prepare_directory(directory, datasets, base_url):
+    with open(os.path.join(directory, 'dataset_keywords_map.json'), 'w') as f:
+        json.dump(fakes.make_keywords_map(datasets), f)
+    with open(os.path.join(directory, 'clm_download_urls.json'), 'w') as f:
+        json.dump(fakes.make_download_urls(datasets, base_url), f)
+
+
+def run_child(base_url, scenario, datasets, workers, trace_memory):
+    """
+    Run a scenario in a fresh interpreter, so that the run-once caches of
+    the previous scenario are not reused.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        prepare_directory(directory, datasets, base_url)
+        env = dict(os.environ, **fakes.service_urls(base_url))
+        env['http_cache_dir'] = os.path.join(directory, 'cache')
+        env['package_export_path'] = os.path.join(directory, 'rrk.jsonl')
+        command = [sys.executable, os.path.abspath(__file__), '--child', scenario]
+        if workers:
+            command += ['--workers', str(workers)]
+        if trace_memory:
+            command.append('--trace-memory')
+        completed = subprocess.run(command, cwd=directory, env=env, capture_output=True, text=True)
+        if completed.returncode != 0:
+            raise RuntimeError(f"{scenario} failed:\n{completed.stderr}")
+        return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def report(scenario, datasets, result, stats):
+    print(f"\n{scenario}, {datasets} synthetic datasets")
+    throughput = result['items'] / result['seconds'] if result['seconds'] else 0.0
+    print(f"  {result['items']} packages in {result['seconds']:.2f} s, {throughput:.1f} packages/s")
+    if result['peak_bytes'] is not None:
+        print(f"  peak memory {result['peak_bytes'] / 2 ** 20:.1f} MiB")
+    if result['error']:
+        print(f"  error: {result['error']}")
+    print(f"  {'stage':<22}{'count':>7}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage, values in sorted(result['stages'].items()):
+        print(f"  {stage:<22}{values['count']:>7}" +
+              "".join(f"{values[key] * 1000:>10.2f}" for key in ('p50', 'p90', 'p99', 'max')))
+    requests_sent = {route: values for route, values in stats.items() if isinstance(values, dict) and route != 'bench'}
+    for route, values in sorted(requests_sent.items()):
+        print(f"  {route:<40}{values['requests']:>7} requests{values['errors']:>6} errors"
+              f"{values['bytes'] / 2 ** 20:>9.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the publish scripts against local fakes")
+    parser.add_argument("--datasets", type=int, nargs='+', default=[100, 1000],
+                        help="sizes of the synthetic collection")
+    parser.add_argument("--scenarios", nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds added to every response")
+    parser.add_argument("--ckan-latency", type=float, default=None,
+                        help="seconds added to every CKAN response, --latency by default")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of CKAN requests answered with 503")
+    parser.add_argument("--workers", type=int, default=None, help="publish_workers for the threaded paths")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc run")
+    parser.add_argument("--child", choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument("--trace-memory", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_scenario(args.child, args.workers, args.trace_memory)))
+        return
+
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    server = multiprocessing.Process(target=fakes.serve, kwargs={'ready': sender}, daemon=True)
+    server.start()
+    base_url = receiver.recv()
+    ckan_latency = args.latency if args.ckan_latency is None else args.ckan_latency
+
+    try:
+        for datasets in args.datasets:
+            for scenario in args.scenarios:
+                config = {
+                    'datasets': datasets,
+                    'seed_packages': datasets if scenario == 'delete' else 0,
+                    'latency': {'ckan': ckan_latency, 'rrk': args.latency, 'geoserver': args.latency,
+                                'arcgis': args.latency},
+                    'error_rate': {'ckan': args.error_rate},
+                }
+                requests.post(f"{base_url}/_bench/reset", json=config).raise_for_status()
+                result = run_child(base_url, scenario, datasets, args.workers, trace_memory=False)
+                stats = requests.get(f"{base_url}/_bench/stats").json()
+                if not args.no_memory:
+                    requests.post(f"{base_url}/_bench/reset", json=config).raise_for_status()
+                    result['peak_bytes'] = run_child(base_url, scenario, datasets, args.workers,
+                                                     trace_memory=True)['peak_bytes']
+                report(scenario, datasets, result, stats)
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
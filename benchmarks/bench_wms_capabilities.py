@@ -0,0 +1,139 @@
+"""
+#
+# Compare the streaming WMS capabilities parser with the previous
+# ElementTree parser on a large synthetic GetCapabilities document.
+#
+# Usage: python benchmarks/bench_wms_capabilities.py [number_of_layers]
+#
+"""
+
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from wms_extent import iter_wms_layers
+
+
+def write_capabilities(path, layer_count):
+    """
+    Write a WMS 1.3.0 capabilities document with layer_count named layers
+    in the shape GeoServer produces for a workspace.
+    """
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<WMS_Capabilities version="1.3.0" xmlns="http://www.opengis.net/wms" '
+                'xmlns:xlink="http://www.w3.org/1999/xlink">\n')
+        f.write('<Service><Name>WMS</Name><Title>GeoServer Web Map Service</Title></Service>\n')
+        f.write('<Capability><Layer><Title>rrk</Title><CRS>EPSG:3310</CRS>\n')
+        for i in range(layer_count):
+            f.write(
+                f'<Layer queryable="1"><Name>layer_{i}_202312_t1_v5</Name>'
+                f'<Title>Synthetic layer {i}</Title>'
+                f'<Abstract>Synthetic layer {i} used to benchmark the capabilities parser.</Abstract>'
+                f'<KeywordList><Keyword>features</Keyword><Keyword>layer_{i}</Keyword></KeywordList>'
+                f'<CRS>EPSG:3310</CRS><CRS>CRS:84</CRS>'
+                f'<EX_GeographicBoundingBox><westBoundLongitude>-124.4</westBoundLongitude>'
+                f'<eastBoundLongitude>-114.1</eastBoundLongitude><southBoundLatitude>32.5</southBoundLatitude>'
+                f'<northBoundLatitude>42.0</northBoundLatitude></EX_GeographicBoundingBox>'
+                f'<BoundingBox CRS="CRS:84" minx="-124.4" miny="32.5" maxx="-114.1" maxy="42.0"/>'
+                f'<BoundingBox CRS="EPSG:3310" minx="-374000" miny="-604000" maxx="540000" maxy="450000"/>'
+                f'<Style><Name>raster</Name><Title>Raster</Title><LegendURL width="20" height="20">'
+                f'<Format>image/png</Format><OnlineResource xlink:type="simple" '
+                f'xlink:href="https://example.org/legend?layer=layer_{i}"/></LegendURL></Style>'
+                f'</Layer>\n'
+            )
+        f.write('</Layer></Capability></WMS_Capabilities>\n')
+
+
+def legacy_parse(xml_text):
+    """
+    The parser get_wms_info used before the streaming parser.
+    """
+    root = ET.fromstring(xml_text)
+
+    layers = []
+    for path in [
+        './/{http://www.opengis.net/wms}Layer',
+        './/Layer',
+        './Capability/Layer/Layer'
+    ]:
+        layers.extend(root.findall(path))
+
+    layers_info = []
+    for layer in layers:
+        name = None
+        for name_path in ['./{http://www.opengis.net/wms}Name', './Name']:
+            name_elem = layer.find(name_path)
+            if name_elem is not None:
+                name = name_elem.text
+                break
+
+        title = None
+        for title_path in ['./{http://www.opengis.net/wms}Title', './Title']:
+            title_elem = layer.find(title_path)
+            if title_elem is not None:
+                title = title_elem.text
+                break
+
+        bbox = None
+        for bbox_path in ['./{http://www.opengis.net/wms}BoundingBox', './BoundingBox']:
+            bbox_elem = layer.find(bbox_path)
+            if bbox_elem is not None:
+                bbox = {
+                    'minx': bbox_elem.get('minx'),
+                    'miny': bbox_elem.get('miny'),
+                    'maxx': bbox_elem.get('maxx'),
+                    'maxy': bbox_elem.get('maxy')
+                }
+                break
+
+        if name:
+            layers_info.append({'name': name, 'title': title, 'bbox': bbox})
+
+    return layers_info
+
+
+def measure(label, parse):
+    # time without tracemalloc, which slows the parsers down several times
+    start = time.perf_counter()
+    layers = parse()
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    parse()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<10} {elapsed:8.3f} s  peak {peak / 2 ** 20:8.1f} MiB  {len(layers)} layers")
+    return layers
+
+
+def main():
+    layer_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'capabilities.xml')
+        write_capabilities(path, layer_count)
+        print(f"{layer_count} layers, {os.path.getsize(path) / 2 ** 20:.1f} MiB document")
+
+        def run_legacy():
+            with open(path, 'r') as f:
+                return legacy_parse(f.read())
+
+        def run_streaming():
+            with open(path, 'rb') as f:
+                return list(iter_wms_layers(f))
+
+        legacy = measure('legacy', run_legacy)
+        streaming = measure('streaming', run_streaming)
+
+    legacy_unique = list({layer['name']: layer for layer in legacy}.values())
+    assert legacy_unique == streaming, "parsers disagree"
+
+
+if __name__ == "__main__":
+    main()
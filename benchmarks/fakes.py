@@ -0,0 +1,708 @@
+"""
+#
+# Local stand-ins for the CKAN action API, the RRK API, the GeoServer
+# rrk workspace and the ITS ArcGIS FeatureServer layers, serving a
+# synthetic CLM collection with configurable latency and error injection.
+#
+# Usage: python benchmarks/fakes.py [--port 8900] [--datasets 1000]
+#
+# Routes:
+#   /api/3/action/<action>                          CKAN
+#   /rrk/DatasetCollection/100/Dataset              RRK dataset list (skip, limit)
+#   /rrk/DatasetCollection/100/taxonomy/33/hierarchy
+#   /geoserver/rrk/{wms,wcs,wfs}                    GetCapabilities, DescribeCoverage,
+#                                                   GetMap, GetCoverage, GetFeature
+#   /downloads/...                                  the download zips (HEAD, GET, Range)
+#   /arcgis/rest/services/Hosted/<layer>/FeatureServer/0[/query]
+#                                                   ITS layers: description, count, extent,
+#                                                   outStatistics, resultOffset paging
+#   /_bench/reset, /_bench/stats                    benchmark control
+#
+"""
+
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ORG = 'bench-org'
+
+DEFAULT_CONFIG = {
+    'datasets': 100,
+    # packages already in CKAN before the run, e.g. for the delete benchmark
+    'seed_packages': 0,
+    # seconds added to every response, per service
+    'latency': {'ckan': 0.0, 'rrk': 0.0, 'geoserver': 0.0, 'downloads': 0.0, 'arcgis': 0.0},
+    # fraction of the requests answered with 503, per service
+    'error_rate': {'ckan': 0.0, 'rrk': 0.0, 'geoserver': 0.0, 'downloads': 0.0, 'arcgis': 0.0},
+    # bump to change the ETag and Last-Modified date of every download zip
+    'download_version': 5,
+    # features of the ITS points layer; the lines layer has half, the polygons layer twice as many
+    'its_features': 5000,
+    # False to answer outStatistics with an error, so the harvest pages through the features
+    'arcgis_statistics': True,
+    'arcgis_max_record_count': 1000,
+    'seed': 0,
+}
+
+# California in EPSG:3310 and in lon/lat
+CA_ALBERS = (-374000.0, -604000.0, 540000.0, 450000.0)
+CA_LON_LAT = (-124.41, 32.53, -114.13, 42.01)
+
+
+def dataset_kind(index):
+    """
+    Where the layer of synthetic dataset `index` is published: most are
+    coverages, every tenth is a feature type, and a few are missing from
+    both capabilities documents so DescribeCoverage is exercised.
+    """
+    if index % 50 == 25:
+        return 'unlisted'
+    if index % 10 == 9:
+        return 'feature'
+    return 'coverage'
+
+
+def dataset_title(index):
+    return f"Synthetic Metric {index}"
+
+
+def dataset_slug(index):
+    return f"clm-synthetic-metric-{index}"
+
+
+def layer_name(index):
+    return f"synmetric{index}_202312_t1_v5"
+
+
+def file_path(index):
+    return f"/data/synthetic/Tier1/SynMetric{index}_202312_T1_v5.tif"
+
+
+def download_url(index, base_url=None):
+    """
+    The download zip of dataset `index`, on an unreachable host unless
+    base_url points at the fakes.
+    """
+    host = f"{base_url}/downloads" if base_url else "https://rrk.example.org"
+    return f"{host}/full_extent/d/synthetic/Tier1/SynMetric{index}_202312_T1_v5.zip"
+
+
+def download_size(index):
+    return 1024 * (index % 64 + 1)
+
+
+def download_missing(index):
+    # a few zips were never uploaded
+    return index % 20 == 13
+
+
+def download_refuses_head(index):
+    # served from a host answering HEAD with 405
+    return index % 16 == 5
+
+
+# ITS layer -> (share of its_features, degrees its extent is inside California)
+ITS_LAYERS = {
+    'ITS_V1_1_points_gdb': (1.0, 0.3),
+    'ITS_V1_1_lines_gdb': (0.5, 0.5),
+    'ITS_V1_1_polygons_gdb': (2.0, 0.1),
+}
+ITS_AGENCIES = ('CALFIRE', 'USFS', 'BLM', 'NPS', 'CNRA', 'CALEPA', 'DOD')
+
+
+def its_feature(index):
+    """
+    The attributes of ITS feature `index`; one in 25 has no agency.
+    """
+    return {
+        'OBJECTID': index + 1,
+        'AGENCY': None if index % 25 == 24 else ITS_AGENCIES[index % len(ITS_AGENCIES)],
+        'TREATED_ACRES': (index % 40) + 0.5,
+    }
+
+
+def its_extent(layer, web_mercator=False):
+    lon_min, lat_min, lon_max, lat_max = CA_LON_LAT
+    d = ITS_LAYERS[layer][1]
+    bbox = (lon_min + d, lat_min + d, lon_max - d, lat_max - d)
+    if not web_mercator:
+        return {'xmin': bbox[0], 'ymin': bbox[1], 'xmax': bbox[2], 'ymax': bbox[3],
+                'spatialReference': {'wkid': 4326, 'latestWkid': 4326}}
+    radius = 6378137.0
+    x = [math.radians(lon) * radius for lon in (bbox[0], bbox[2])]
+    y = [math.log(math.tan(math.pi / 4 + math.radians(lat) / 2)) * radius for lat in (bbox[1], bbox[3])]
+    return {'xmin': x[0], 'ymin': y[0], 'xmax': x[1], 'ymax': y[1],
+            'spatialReference': {'wkid': 102100, 'latestWkid': 3857}}
+
+
+def arcgis_request(path, query):
+    """
+    The kind of an ArcGIS request, for the statistics.
+    """
+    if not path.endswith('/query'):
+        return 'layer'
+    if query.get('returnCountOnly') == 'true':
+        return 'count'
+    if query.get('returnExtentOnly') == 'true':
+        return 'extent'
+    if 'outStatistics' in query:
+        return 'statistics'
+    return 'page'
+
+
+def make_its_layer_info(layer, max_record_count, statistics):
+    return {
+        'name': layer,
+        'type': 'Feature Layer',
+        'objectIdField': 'OBJECTID',
+        'maxRecordCount': max_record_count,
+        'extent': its_extent(layer, web_mercator=True),
+        'advancedQueryCapabilities': {'supportsStatistics': statistics, 'supportsPagination': True},
+        'fields': [
+            {'name': 'OBJECTID', 'type': 'esriFieldTypeOID'},
+            {'name': 'AGENCY', 'type': 'esriFieldTypeString'},
+            {'name': 'TREATED_ACRES', 'type': 'esriFieldTypeDouble'},
+        ],
+    }
+
+
+def make_dataset(index):
+    text = f"Synthetic metric {index} generated for the publish benchmark. " * 8
+    return {
+        'dataset_id': index + 1,
+        'name': dataset_title(index),
+        'file_path': file_path(index),
+        'file_type': 'GeoTIFF',
+        'gis_services': [{'layer_name': f"rrk:{layer_name(index)}", 'service_type': 'WMS'}],
+        'dataset_metadata': [
+            {'name': 'metric_definition_and_relevance', 'text_value': text},
+            {'name': 'creation_method', 'text_value': text},
+            {'name': 'data_vintage', 'text_value': '2023'},
+            {'name': 'data_units', 'text_value': 'Percent'},
+            {'name': 'tier', 'text_value': '1'},
+            {'name': 'min_value', 'float_value': 0.0},
+            {'name': 'max_value', 'float_value': 100.0},
+            {'name': 'data_resolution', 'text_value': '30m'},
+        ],
+    }
+
+
+def make_hierarchy(count, per_item=100):
+    """
+    Two levels of taxonomy items, the datasets split between the inner ones.
+    """
+    forest = []
+    for start in range(0, count, per_item * 10):
+        children = []
+        for item_start in range(start, min(count, start + per_item * 10), per_item):
+            children.append({
+                'taxonomy_item_name': f"item {item_start}",
+                'key': f"item-{item_start}",
+                'label': f"Item {item_start}",
+                'children': [{'dataset_id': i + 1, 'dataset_name': dataset_title(i)}
+                             for i in range(item_start, min(count, item_start + per_item))],
+            })
+        forest.append({
+            'taxonomy_item_name': f"pillar {start}",
+            'key': f"pillar-{start}",
+            'label': f"Pillar {start}",
+            'children': children,
+        })
+    return forest
+
+
+def make_keywords_map(count):
+    return {dataset_slug(i): ['California', 'synthetic', f"metric {i}"] for i in range(count)}
+
+
+def make_download_urls(count, base_url=None):
+    return [download_url(i, base_url) for i in range(count)]
+
+
+def _albers_bbox(rng):
+    minx, miny, maxx, maxy = CA_ALBERS
+    dx = rng.uniform(0, 50000)
+    dy = rng.uniform(0, 50000)
+    return minx + dx, miny + dy, maxx - dx, maxy - dy
+
+
+def make_wms_capabilities(count, seed=0):
+    rng = random.Random(seed)
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n'
+             '<WMS_Capabilities version="1.3.0" xmlns="http://www.opengis.net/wms">'
+             '<Service><Name>WMS</Name><Title>Fake GeoServer</Title></Service>'
+             '<Capability><Layer><Title>rrk</Title><CRS>EPSG:3310</CRS>\n']
+    lon_min, lat_min, lon_max, lat_max = CA_LON_LAT
+    for i in range(count):
+        d = rng.uniform(0, 0.5)
+        if i % 20 == 7:
+            # not in the WMS capabilities, the extent comes from WCS/WFS
+            continue
+        parts.append(
+            f'<Layer queryable="1"><Name>rrk:{layer_name(i)}</Name><Title>{dataset_title(i)}</Title>'
+            f'<CRS>EPSG:3310</CRS><CRS>CRS:84</CRS>'
+            f'<BoundingBox CRS="CRS:84" minx="{lon_min + d}" miny="{lat_min + d}" '
+            f'maxx="{lon_max - d}" maxy="{lat_max - d}"/></Layer>\n')
+    parts.append('</Layer></Capability></WMS_Capabilities>\n')
+    return ''.join(parts).encode('utf-8')
+
+
+def make_wcs_capabilities(count, seed=0):
+    rng = random.Random(seed)
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n'
+             '<wcs:Capabilities version="2.0.1" xmlns:wcs="http://www.opengis.net/wcs/2.0" '
+             'xmlns:ows="http://www.opengis.net/ows/2.0"><wcs:Contents>\n']
+    for i in range(count):
+        minx, miny, maxx, maxy = _albers_bbox(rng)
+        if dataset_kind(i) != 'coverage':
+            continue
+        parts.append(
+            f'<wcs:CoverageSummary><wcs:CoverageId>rrk__{layer_name(i)}</wcs:CoverageId>'
+            f'<wcs:CoverageSubtype>RectifiedGridCoverage</wcs:CoverageSubtype>'
+            f'<ows:BoundingBox crs="http://www.opengis.net/def/crs/EPSG/0/3310">'
+            f'<ows:LowerCorner>{minx} {miny}</ows:LowerCorner><ows:UpperCorner>{maxx} {maxy}</ows:UpperCorner>'
+            f'</ows:BoundingBox></wcs:CoverageSummary>\n')
+    parts.append('</wcs:Contents></wcs:Capabilities>\n')
+    return ''.join(parts).encode('utf-8')
+
+
+def make_wfs_capabilities(count, seed=0):
+    rng = random.Random(seed)
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n'
+             '<wfs:WFS_Capabilities version="2.0.0" xmlns:wfs="http://www.opengis.net/wfs/2.0" '
+             'xmlns:ows="http://www.opengis.net/ows/1.1"><wfs:FeatureTypeList>\n']
+    lon_min, lat_min, lon_max, lat_max = CA_LON_LAT
+    for i in range(count):
+        d = rng.uniform(0, 0.5)
+        if dataset_kind(i) != 'feature':
+            continue
+        parts.append(
+            f'<wfs:FeatureType><wfs:Name>rrk:{layer_name(i)}</wfs:Name><wfs:Title>{dataset_title(i)}</wfs:Title>'
+            f'<wfs:DefaultCRS>urn:ogc:def:crs:EPSG::3310</wfs:DefaultCRS>'
+            f'<ows:WGS84BoundingBox><ows:LowerCorner>{lon_min + d} {lat_min + d}</ows:LowerCorner>'
+            f'<ows:UpperCorner>{lon_max - d} {lat_max - d}</ows:UpperCorner></ows:WGS84BoundingBox>'
+            f'</wfs:FeatureType>\n')
+    parts.append('</wfs:FeatureTypeList></wfs:WFS_Capabilities>\n')
+    return ''.join(parts).encode('utf-8')
+
+
+def make_coverage_description(coverage_id):
+    minx, miny, maxx, maxy = CA_ALBERS
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<wcs:CoverageDescriptions xmlns:wcs="http://www.opengis.net/wcs/2.0" '
+        'xmlns:gml="http://www.opengis.net/gml/3.2">'
+        f'<wcs:CoverageDescription gml:id="{coverage_id}"><gml:boundedBy>'
+        '<gml:Envelope srsName="http://www.opengis.net/def/crs/EPSG/0/3310" axisLabels="x y" srsDimension="2">'
+        f'<gml:lowerCorner>{minx} {miny}</gml:lowerCorner><gml:upperCorner>{maxx} {maxy}</gml:upperCorner>'
+        '</gml:Envelope></gml:boundedBy>'
+        f'<wcs:CoverageId>{coverage_id}</wcs:CoverageId></wcs:CoverageDescription></wcs:CoverageDescriptions>\n'
+    ).encode('utf-8')
+
+
+class FakeState:
+    """
+    Configuration, synthetic documents, CKAN packages and request
+    statistics shared by the handler threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset({})
+
+    def reset(self, config):
+        merged = json.loads(json.dumps(DEFAULT_CONFIG))
+        for key, value in config.items():
+            if isinstance(value, dict):
+                merged[key].update(value)
+            else:
+                merged[key] = value
+        with self.lock:
+            self.config = merged
+            self.rng = random.Random(merged['seed'])
+            self.documents = {}
+            self.packages = {}
+            self.ids = {}
+            self.stats = defaultdict(lambda: {'requests': 0, 'errors': 0, 'bytes': 0})
+            for i in range(merged['seed_packages']):
+                package = {'id': str(uuid.uuid4()), 'name': dataset_slug(i), 'title': dataset_title(i),
+                           'owner_org': ORG, 'state': 'active'}
+                self.packages[package['name']] = package
+                self.ids[package['id']] = package['name']
+
+    def document(self, key, factory):
+        # generated once per reset, the large documents are reused
+        with self.lock:
+            if key not in self.documents:
+                self.documents[key] = factory(self.config['datasets'], self.config['seed'])
+            return self.documents[key]
+
+    def should_fail(self, service):
+        with self.lock:
+            return self.rng.random() < self.config['error_rate'][service]
+
+    def record(self, route, status, size):
+        with self.lock:
+            stats = self.stats[route]
+            stats['requests'] += 1
+            stats['bytes'] += size
+            if status >= 400:
+                stats['errors'] += 1
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, do not wait for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def do_GET(self):
+        self.dispatch(None)
+
+    def do_HEAD(self):
+        self.dispatch(None)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        self.dispatch(json.loads(body) if body else {})
+
+    def dispatch(self, payload):
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        path = url.path
+
+        if path.startswith('/_bench/'):
+            return self.bench(path, payload)
+        if path.startswith('/api/3/action/'):
+            service = 'ckan'
+            route = 'ckan ' + path.rsplit('/', 1)[-1]
+        elif path.startswith('/rrk/'):
+            service = 'rrk'
+            route = 'rrk hierarchy' if path.endswith('/hierarchy') else 'rrk datasets'
+        elif path.startswith('/geoserver/rrk/'):
+            service = 'geoserver'
+            route = f"geoserver {path.rsplit('/', 1)[-1]} {query.get('request', '')}"
+        elif path.startswith('/downloads/'):
+            service = 'downloads'
+            route = f"downloads {self.command}"
+        elif path.startswith('/arcgis/rest/services/'):
+            service = 'arcgis'
+            route = 'arcgis ' + arcgis_request(path, query)
+        else:
+            return self.reply(404, {'error': 'not found'}, route='unknown')
+
+        latency = self.state.config['latency'][service]
+        if latency:
+            time.sleep(latency)
+        if self.state.should_fail(service):
+            return self.reply(503, {'error': 'injected failure'}, route=route, headers={'Retry-After': '0'})
+
+        if service == 'ckan':
+            self.ckan(path.rsplit('/', 1)[-1], query if payload is None else payload, route)
+        elif service == 'rrk':
+            self.rrk(path, query, route)
+        elif service == 'downloads':
+            self.download(path, route)
+        elif service == 'arcgis':
+            self.arcgis(path, query, route)
+        else:
+            self.geoserver(path.rsplit('/', 1)[-1], query, route)
+
+    def reply(self, status, body, route, content_type='application/json', headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command == 'HEAD':
+            body = b''
+        # counted before the client can read the response and reset the stats
+        self.state.record(route, status, len(body))
+        self.wfile.write(body)
+
+    def bench(self, path, payload):
+        if path == '/_bench/reset':
+            self.state.reset(payload or {})
+            return self.reply(200, {'success': True}, route='bench')
+        if path == '/_bench/stats':
+            with self.state.lock:
+                stats = {route: dict(values) for route, values in self.state.stats.items()}
+                stats['packages'] = sum(1 for package in self.state.packages.values()
+                                        if package['state'] == 'active')
+            return self.reply(200, stats, route='bench')
+        return self.reply(404, {'error': 'not found'}, route='bench')
+
+    def rrk(self, path, query, route):
+        count = self.state.config['datasets']
+        if path == '/rrk/DatasetCollection/100/Dataset':
+            skip = int(query.get('skip', 0))
+            limit = int(query.get('limit', 100))
+            return self.reply(200, [make_dataset(i) for i in range(skip, min(count, skip + limit))], route)
+        if path == '/rrk/DatasetCollection/100/taxonomy/33/hierarchy':
+            return self.reply(200, self.state.document('hierarchy', lambda n, _: make_hierarchy(n)), route)
+        return self.reply(404, {'detail': 'Not Found'}, route)
+
+    def layer_index(self, name):
+        """
+        The synthetic dataset a layer, coverage or feature type name
+        belongs to, or None.
+        """
+        match = re.match(r'(?:rrk[:_]+)?synmetric(\d+)_', name or '')
+        if match and int(match.group(1)) < self.state.config['datasets']:
+            return int(match.group(1))
+        return None
+
+    def download(self, path, route):
+        match = re.search(r'SynMetric(\d+)_', path)
+        index = int(match.group(1)) if match else None
+        if index is None or index >= self.state.config['datasets'] or download_missing(index):
+            return self.reply(404, b'Not Found', route, content_type='text/plain')
+        if self.command == 'HEAD' and download_refuses_head(index):
+            return self.reply(405, b'Method Not Allowed', route, content_type='text/plain')
+        version = self.state.config['download_version']
+        etag = f'"synmetric-{index}-v{version}"'
+        headers = {
+            'ETag': etag,
+            'Last-Modified': time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(1702627200 + version * 86400)),
+            'Accept-Ranges': 'bytes',
+        }
+        if self.headers.get('If-None-Match') == etag:
+            return self.reply(304, b'', route, content_type='application/zip', headers=headers)
+        body = bytes(download_size(index))
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(body) - 1
+            headers['Content-Range'] = f"bytes {start}-{end}/{len(body)}"
+            return self.reply(206, body[start:end + 1], route, content_type='application/zip', headers=headers)
+        return self.reply(200, body, route, content_type='application/zip', headers=headers)
+
+    def arcgis(self, path, query, route):
+        match = re.match(r'/arcgis/rest/services/Hosted/(\w+)/FeatureServer/0(/query)?$', path)
+        if not match or match.group(1) not in ITS_LAYERS:
+            # ArcGIS reports errors in a 200 JSON response
+            return self.reply(200, {'error': {'code': 400, 'message': 'Invalid URL', 'details': []}}, route)
+        layer = match.group(1)
+        config = self.state.config
+        count = int(config['its_features'] * ITS_LAYERS[layer][0])
+        max_record_count = config['arcgis_max_record_count']
+        if not match.group(2):
+            return self.reply(200, make_its_layer_info(layer, max_record_count, config['arcgis_statistics']), route)
+
+        if query.get('returnCountOnly') == 'true':
+            return self.reply(200, {'count': count}, route)
+        if query.get('returnExtentOnly') == 'true':
+            return self.reply(200, {'extent': its_extent(layer, query.get('outSR') != '4326')}, route)
+        if 'outStatistics' in query:
+            group_by = query.get('groupByFieldsForStatistics')
+            if not config['arcgis_statistics'] or group_by != 'AGENCY':
+                return self.reply(200, {'error': {'code': 400, 'message': 'Unable to perform query.',
+                                                  'details': ["'outStatistics' is not supported"]}}, route)
+            statistics = json.loads(query['outStatistics'])
+            groups = {}
+            for i in range(count):
+                attributes = its_feature(i)
+                group = groups.setdefault(attributes[group_by], {group_by: attributes[group_by]})
+                for statistic in statistics:
+                    name = statistic['outStatisticFieldName']
+                    value = 1 if statistic['statisticType'] == 'count' else attributes[statistic['onStatisticField']]
+                    group[name] = group.get(name, 0) + value
+            return self.reply(200, {'features': [{'attributes': group} for group in groups.values()]}, route)
+
+        offset = int(query.get('resultOffset', 0))
+        size = min(int(query.get('resultRecordCount', max_record_count)), max_record_count)
+        fields = query.get('outFields', '*')
+        features = []
+        for i in range(offset, min(count, offset + size)):
+            attributes = its_feature(i)
+            if fields != '*':
+                attributes = {name: attributes[name] for name in fields.split(',') if name in attributes}
+            features.append({'attributes': attributes})
+        return self.reply(200, {'objectIdFieldName': 'OBJECTID', 'features': features,
+                                'exceededTransferLimit': offset + size < count}, route)
+
+    def geoserver(self, service, query, route):
+        request = query.get('request', '')
+        documents = {
+            ('wms', 'GetCapabilities'): make_wms_capabilities,
+            ('wcs', 'GetCapabilities'): make_wcs_capabilities,
+            ('wfs', 'GetCapabilities'): make_wfs_capabilities,
+        }
+        if (service, request) in documents:
+            body = self.state.document(service, documents[(service, request)])
+            return self.reply(200, body, route, content_type='application/xml')
+        if service == 'wcs' and request == 'DescribeCoverage':
+            coverage_id = query.get('coverageId', '')
+            index = self.layer_index(coverage_id)
+            if index is not None and dataset_kind(index) != 'feature':
+                return self.reply(200, make_coverage_description(coverage_id), route,
+                                  content_type='application/xml')
+            return self.reply(404, b'<ows:ExceptionReport/>', route, content_type='application/xml')
+        if service == 'wms' and request == 'GetMap':
+            index = self.layer_index(query.get('layers'))
+            if index is not None and dataset_kind(index) != 'unlisted':
+                return self.reply(200, b'\x89PNG\r\n\x1a\n' + bytes(64), route, content_type='image/png')
+            # GeoServer reports a missing layer with a 200 XML document
+            return self.reply(200, b'<ServiceExceptionReport><ServiceException code="LayerNotDefined"/>'
+                                   b'</ServiceExceptionReport>', route, content_type='application/vnd.ogc.se_xml')
+        if service == 'wcs' and request == 'GetCoverage':
+            index = self.layer_index(query.get('coverageId'))
+            if index is not None and dataset_kind(index) == 'coverage':
+                return self.reply(200, b'II*\x00' + bytes(256), route, content_type='image/tiff')
+            return self.reply(404, b'<ows:ExceptionReport/>', route, content_type='application/xml')
+        if service == 'wfs' and request == 'GetFeature':
+            index = self.layer_index(query.get('typeName'))
+            if index is not None and dataset_kind(index) == 'feature':
+                return self.reply(200, b'<wfs:FeatureCollection numberOfFeatures="1"/>', route,
+                                  content_type='text/xml; subtype=gml/3.1.1')
+            return self.reply(200, b'<ows:ExceptionReport><ows:Exception exceptionCode="InvalidParameterValue"/>'
+                                   b'</ows:ExceptionReport>', route, content_type='text/xml')
+        return self.reply(400, b'<ows:ExceptionReport/>', route, content_type='application/xml')
+
+    def ckan(self, action, data, route):
+        state = self.state
+        handler = getattr(self, f"action_{action}", None)
+        if handler is None:
+            return self.reply(400, {'success': False, 'error': {'message': f"Unknown action {action}"}}, route)
+        with state.lock:
+            status, result = handler(state, data)
+        if status == 200:
+            return self.reply(200, {'success': True, 'result': result}, route)
+        return self.reply(status, {'success': False, 'error': result}, route)
+
+    def action_organization_show(self, state, data):
+        if data.get('id') == ORG:
+            return 200, {'name': ORG}
+        return 404, {'message': 'Not found: Organization does not exist'}
+
+    def action_package_create(self, state, data):
+        if self._find(state, data.get('name')) is not None:
+            return 409, {'name': ['That URL is already in use.'], '__type': 'Validation Error'}
+        package = dict(data, id=str(uuid.uuid4()), state='active')
+        state.packages[package['name']] = package
+        state.ids[package['id']] = package['name']
+        return 200, package
+
+    def _find(self, state, key):
+        package = state.packages.get(state.ids.get(key, key))
+        if package is None or package['state'] != 'active':
+            return None
+        return package
+
+    def action_package_patch(self, state, data):
+        package = self._find(state, data.get('id'))
+        if package is None:
+            return 404, {'message': 'Not found'}
+        package.update((key, value) for key, value in data.items() if key != 'id')
+        return 200, package
+
+    def action_package_show(self, state, data):
+        package = self._find(state, data.get('id'))
+        if package is None:
+            return 404, {'message': 'Not found'}
+        return 200, package
+
+    def action_package_list(self, state, data):
+        return 200, sorted(name for name, package in state.packages.items() if package['state'] == 'active')
+
+    def action_package_search(self, state, data):
+        prefixes = tuple(re.findall(r'name:(\S+?)\*', data.get('q', '')))
+        results = [package for name, package in sorted(state.packages.items())
+                   if package['state'] == 'active' and (not prefixes or name.startswith(prefixes))]
+        start = int(data.get('start', 0))
+        rows = int(data.get('rows', 10))
+        page = results[start:start + rows]
+        if data.get('fl'):
+            fields = data['fl'].split(',')
+            page = [{field: package.get(field) for field in fields} for package in page]
+        return 200, {'count': len(results), 'results': page}
+
+    def action_package_delete(self, state, data):
+        package = self._find(state, data.get('id'))
+        if package is None:
+            return 404, {'message': 'Not found'}
+        package['state'] = 'deleted'
+        return 200, None
+
+    def action_dataset_purge(self, state, data):
+        package = self._find(state, data.get('id'))
+        if package is None:
+            return 404, {'message': 'Not found'}
+        del state.packages[package['name']]
+        del state.ids[package['id']]
+        return 200, None
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, port=0):
+        super().__init__(('127.0.0.1', port), FakeHandler)
+        self.state = FakeState()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+def service_urls(base_url):
+    """
+    The .env settings pointing the scripts at the fakes.
+    """
+    return {
+        'ckan_url': base_url,
+        'rrk_api_url': f"{base_url}/rrk",
+        'geoserver_url': f"{base_url}/geoserver/rrk",
+        'its_arcgis_url': f"{base_url}/arcgis/rest/services/Hosted",
+        'org_ckan_name': ORG,
+        'api_key': 'bench-key',
+    }
+
+
+def serve(port=0, ready=None):
+    """
+    Run the fakes until the process is stopped. When ready is a pipe
+    connection, the base URL is sent through it once the server listens.
+    """
+    server = FakeServer(port)
+    if ready is not None:
+        ready.send(server.base_url)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve fake CKAN, RRK API, GeoServer and ArcGIS endpoints")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--datasets", type=int, default=DEFAULT_CONFIG['datasets'])
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of CKAN requests failing with 503")
+    args = parser.parse_args()
+
+    server = FakeServer(args.port)
+    server.state.reset({
+        'datasets': args.datasets,
+        'latency': {service: args.latency for service in ('ckan', 'rrk', 'geoserver', 'arcgis')},
+        'error_rate': {'ckan': args.error_rate},
+    })
+    for name, value in service_urls(server.base_url).items():
+        print(f"{name}={value}")
+    server.serve_forever()
@@ -0,0 +1,222 @@
+"""
+#
+# Harvest coverage and feature type extents from the WCS and WFS
+# GetCapabilities documents, so that each layer does not need its own
+# DescribeCoverage request
+#
+"""
+
+import os
+import re
+import threading
+import xml.etree.ElementTree as ET
+
+import requests
+from dotenv import load_dotenv
+
+from coordinates import convert_envelopes_to_lat_lon
+from http_cache import cached_get
+from metrics import timed
+
+load_dotenv()
+
+# the rrk workspace of GeoServer, geoserver_url in .env
+GEOSERVER_URL = os.getenv('geoserver_url', "https://sparcal.sdsc.edu/geoserver/rrk").rstrip('/')
+WMS_URL = f"{GEOSERVER_URL}/wms"
+WCS_URL = f"{GEOSERVER_URL}/wcs"
+WFS_URL = f"{GEOSERVER_URL}/wfs"
+
+coverages = None
+feature_types = None
+lat_lon_bboxes = None
+extents_lock = threading.Lock()
+
+
+def normalize_layer_name(layer_name):
+    """
+    Strip the workspace prefix from a layer name, coverage id or feature
+    type name, e.g. rrk:foo, rrk__foo and foo all become foo.
+    """
+    name = layer_name.strip().lower()
+    if ':' in name:
+        name = name.split(':', 1)[1]
+    elif '__' in name:
+        name = name.split('__', 1)[1]
+    return name
+
+
+def get_epsg_code(crs):
+    """
+    Extract the EPSG number from a CRS identifier such as
+    http://www.opengis.net/def/crs/EPSG/0/3310, urn:ogc:def:crs:EPSG::3310
+    or EPSG:3310.
+    """
+    if not crs:
+        return None
+    match = re.search(r'EPSG(?:/0/|::|:)(\d+)', crs)
+    if match:
+        return match.group(1)
+    return None
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _child(elem, name):
+    for kid in elem:
+        if _local_name(kid.tag) == name:
+            return kid
+    return None
+
+
+def _parse_corners(bbox_elem):
+    lower = _child(bbox_elem, 'LowerCorner')
+    upper = _child(bbox_elem, 'UpperCorner')
+    if lower is None or upper is None:
+        return None
+    return list(map(float, lower.text.split())), list(map(float, upper.text.split()))
+
+
+def _parse_envelope(elem):
+    """
+    Return (lower_coords, upper_coords, epsg_code) for a CoverageSummary or
+    FeatureType element. The native BoundingBox is preferred; otherwise the
+    WGS84BoundingBox is used, whose corners are in lon/lat order.
+    """
+    wgs84 = None
+    for kid in elem:
+        tag = _local_name(kid.tag)
+        if tag == 'BoundingBox':
+            epsg_code = get_epsg_code(kid.get('crs'))
+            corners = _parse_corners(kid)
+            # an EPSG:4326 BoundingBox is in lat/lon order, use WGS84BoundingBox instead
+            if corners and epsg_code and epsg_code != '4326':
+                return corners[0], corners[1], epsg_code
+        elif tag == 'WGS84BoundingBox':
+            wgs84 = _parse_corners(kid)
+    if wgs84:
+        return wgs84[0], wgs84[1], '4326'
+    return None
+
+
+def _get_capabilities(url, service, version):
+    params = {
+        'service': service,
+        'version': version,
+        'request': 'GetCapabilities'
+    }
+    try:
+        response = cached_get(url, params=params)
+        if response.status_code != 200:
+            print(f"Failed to retrieve {service} capabilities: {response.status_code}")
+            return None
+        return ET.fromstring(response.content)
+    except (requests.exceptions.RequestException, ET.ParseError) as e:
+        print(f"Failed to retrieve {service} capabilities: {e}")
+        return None
+
+
+def get_coverage_extents(wcs_url):
+    """
+    Map every coverage listed in the WCS capabilities to its extent.
+
+    Parameters:
+    - wcs_url: str, the URL of the WCS service.
+
+    Returns:
+    - dict, normalized coverage id -> (lower_coords, upper_coords, epsg_code),
+      or None if the capabilities could not be retrieved.
+    """
+    root = _get_capabilities(wcs_url, 'WCS', '2.0.1')
+    if root is None:
+        return None
+
+    extents = {}
+    for elem in root.iter():
+        if _local_name(elem.tag) != 'CoverageSummary':
+            continue
+        coverage_id = _child(elem, 'CoverageId')
+        if coverage_id is None or not coverage_id.text:
+            continue
+        extents[normalize_layer_name(coverage_id.text)] = _parse_envelope(elem)
+    return extents
+
+
+def get_feature_type_extents(wfs_url):
+    """
+    Map every feature type listed in the WFS capabilities to its extent.
+
+    Parameters:
+    - wfs_url: str, the URL of the WFS service.
+
+    Returns:
+    - dict, normalized feature type name -> (lower_coords, upper_coords, epsg_code),
+      or None if the capabilities could not be retrieved.
+    """
+    root = _get_capabilities(wfs_url, 'WFS', '2.0.0')
+    if root is None:
+        return None
+
+    extents = {}
+    for elem in root.iter():
+        if _local_name(elem.tag) != 'FeatureType':
+            continue
+        name = _child(elem, 'Name')
+        if name is None or not name.text:
+            continue
+        extents[normalize_layer_name(name.text)] = _parse_envelope(elem)
+    return extents
+
+
+@timed('harvest_extents')
+def harvest_extents():
+    """
+    Fetch the WCS and WFS capabilities once per run, and reproject all the
+    harvested envelopes to latitude and longitude in one batch. A service
+    whose capabilities cannot be retrieved is recorded as having no layer,
+    which then fall back to DescribeCoverage, and is not fetched again.
+    """
+    global coverages, feature_types, lat_lon_bboxes
+    with extents_lock:
+        if lat_lon_bboxes is not None:
+            return
+        harvested_coverages = get_coverage_extents(WCS_URL) or {}
+        harvested_feature_types = get_feature_type_extents(WFS_URL) or {}
+        # feature types first, so that coverages win as they do in lookup_extent
+        extents = {}
+        for harvested in (harvested_feature_types, harvested_coverages):
+            extents.update((name, extent) for name, extent in harvested.items() if extent)
+        names = list(extents)
+        bboxes = dict(zip(names, convert_envelopes_to_lat_lon([extents[name] for name in names])))
+        coverages, feature_types, lat_lon_bboxes = harvested_coverages, harvested_feature_types, bboxes
+
+
+def lookup_extent(layer_name):
+    """
+    Find the harvested extent of a layer.
+
+    Parameters:
+    - layer_name: str, the GeoServer layer name.
+
+    Returns:
+    - (kind, extent): kind is 'coverage' or 'feature' when the layer was
+      found in the WCS or WFS capabilities, and None when it is unknown,
+      in which case the caller should fall back to DescribeCoverage.
+    """
+    harvest_extents()
+    name = normalize_layer_name(layer_name)
+    if coverages is not None and name in coverages:
+        return 'coverage', coverages[name]
+    if feature_types is not None and name in feature_types:
+        return 'feature', feature_types[name]
+    return None, None
+
+
+def lookup_lat_lon_bbox(layer_name):
+    """
+    Returns:
+    - ((lat_min, lon_min), (lat_max, lon_max)) of a harvested layer, or None.
+    """
+    harvest_extents()
+    return lat_lon_bboxes.get(normalize_layer_name(layer_name))
@@ -0,0 +1,324 @@
+"""
+#
+# Local SQLite catalog of the generated CKAN packages, indexed by slug,
+# category, tier, resource format, tag and spatial extent, to answer
+# questions about what was published without CKAN or the export file
+#
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from package_fields import get_extra
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS packages (
+    id INTEGER PRIMARY KEY,
+    slug TEXT NOT NULL UNIQUE,
+    title TEXT,
+    collection TEXT,
+    category TEXT,
+    tier TEXT,
+    package TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS packages_category ON packages (category);
+CREATE INDEX IF NOT EXISTS packages_tier ON packages (tier);
+CREATE INDEX IF NOT EXISTS packages_collection ON packages (collection);
+CREATE TABLE IF NOT EXISTS tags (
+    package_id INTEGER NOT NULL REFERENCES packages (id) ON DELETE CASCADE,
+    tag TEXT NOT NULL COLLATE NOCASE
+);
+CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag);
+CREATE INDEX IF NOT EXISTS tags_package ON tags (package_id);
+CREATE TABLE IF NOT EXISTS resources (
+    package_id INTEGER NOT NULL REFERENCES packages (id) ON DELETE CASCADE,
+    name TEXT,
+    format TEXT COLLATE NOCASE,
+    url TEXT
+);
+CREATE INDEX IF NOT EXISTS resources_format ON resources (format);
+CREATE INDEX IF NOT EXISTS resources_package ON resources (package_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS extents USING rtree (
+    id, min_lon, max_lon, min_lat, max_lat
+);
+"""
+
+
+def spatial_bbox(package_dict):
+    """
+    The (min_lon, min_lat, max_lon, max_lat) of the spatial extra, or None
+    when there is none or it is not in longitude and latitude.
+    """
+    value = get_extra(package_dict, 'spatial')
+    if not value:
+        return None
+    try:
+        geometry = json.loads(value)
+    except ValueError:
+        return None
+    crs = geometry.get('crs', {}).get('properties', {}).get('name', '')
+    if crs and not crs.endswith(('4326', 'CRS84')):
+        return None
+
+    points = []
+
+    def collect(coordinates):
+        if coordinates and isinstance(coordinates[0], (int, float)):
+            points.append(coordinates)
+        else:
+            for item in coordinates:
+                collect(item)
+
+    collect(geometry.get('coordinates', []))
+    if not points:
+        return None
+    lons = [point[0] for point in points]
+    lats = [point[1] for point in points]
+    if min(lons) < -180 or max(lons) > 180 or min(lats) < -90 or max(lats) > 90:
+        return None
+    return min(lons), min(lats), max(lons), max(lats)
+
+
+class PackageCatalog:
+    """
+    Materializes packages into a SQLite database. Adding a package replaces
+    the previous version with the same slug, and removing it drops it once
+    it is deleted from CKAN. Writes are committed every commit_every
+    packages and on close.
+    """
+
+    def __init__(self, path=None, commit_every=100):
+        """
+        Parameters:
+        - path: str, catalog_path in .env, /tmp/rrk_catalog.sqlite by default.
+        """
+        if path is None:
+            path = os.getenv('catalog_path', '/tmp/rrk_catalog.sqlite')
+        self.path = path
+        self.commit_every = commit_every
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def add(self, package_dict):
+        slug = package_dict['name']
+        row = (
+            slug,
+            package_dict.get('title'),
+            slug.split('-', 1)[0],
+            get_extra(package_dict, 'Category'),
+            get_extra(package_dict, 'Tier'),
+            json.dumps(package_dict, separators=(',', ':')),
+            time.time(),
+        )
+        bbox = spatial_bbox(package_dict)
+        with self.lock:
+            cursor = self.connection.cursor()
+            self._delete(cursor, slug)
+            cursor.execute("INSERT INTO packages (slug, title, collection, category, tier, package, updated) "
+                           "VALUES (?, ?, ?, ?, ?, ?, ?)", row)
+            package_id = cursor.lastrowid
+            cursor.executemany("INSERT INTO tags (package_id, tag) VALUES (?, ?)",
+                               [(package_id, tag['name']) for tag in package_dict.get('tags', [])])
+            cursor.executemany("INSERT INTO resources (package_id, name, format, url) VALUES (?, ?, ?, ?)",
+                               [(package_id, resource.get('name'), resource.get('format'), resource.get('url'))
+                                for resource in package_dict.get('resources', [])])
+            if bbox is not None:
+                cursor.execute("INSERT INTO extents (id, min_lon, max_lon, min_lat, max_lat) VALUES (?, ?, ?, ?, ?)",
+                               (package_id, bbox[0], bbox[2], bbox[1], bbox[3]))
+            self._written()
+
+    def remove(self, slug):
+        """
+        Remove the package with this slug, if it is in the catalog.
+        """
+        with self.lock:
+            if self._delete(self.connection.cursor(), slug):
+                self._written()
+
+    def _delete(self, cursor, slug):
+        previous = cursor.execute("SELECT id FROM packages WHERE slug = ?", (slug,)).fetchone()
+        if previous is None:
+            return False
+        # the tags and resources go with it
+        cursor.execute("DELETE FROM packages WHERE id = ?", (previous['id'],))
+        cursor.execute("DELETE FROM extents WHERE id = ?", (previous['id'],))
+        return True
+
+    def _written(self):
+        # called with the lock held
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.connection.commit()
+            self.pending = 0
+
+    def wrap(self, publish):
+        """
+        Wrap a publish callable so that every package it publishes without
+        error is added to the catalog.
+        """
+        def cataloged_publish(package_dict):
+            outcome = publish(package_dict)
+            self.add(package_dict)
+            return outcome
+        return cataloged_publish
+
+    def find(self, slug=None, collection=None, category=None, tier=None, tag=None, format=None,
+             missing_format=None, bbox=None):
+        """
+        Find the packages matching every given criterion.
+
+        Parameters:
+        - slug: str, glob pattern of the slug, such as 'clm-fire-*'.
+        - collection: str, 'clm' or 'its'.
+        - category, tier: str, exact values of the Category and Tier extras.
+        - tag: str, a tag of the package, case insensitive.
+        - format: str, the format of one of its resources, such as 'WCS'.
+        - missing_format: str, a resource format the package does not have.
+        - bbox: (min_lon, min_lat, max_lon, max_lat), an area its spatial
+          extent intersects.
+
+        Returns:
+        - list of dict with the slug, title, collection, category and tier.
+        """
+        conditions = []
+        params = []
+        if slug is not None:
+            conditions.append("p.slug GLOB ?")
+            params.append(slug)
+        for column, value in (('collection', collection), ('category', category), ('tier', tier)):
+            if value is not None:
+                conditions.append(f"p.{column} = ?")
+                params.append(value)
+        if tag is not None:
+            conditions.append("p.id IN (SELECT package_id FROM tags WHERE tag = ?)")
+            params.append(tag)
+        if format is not None:
+            conditions.append("p.id IN (SELECT package_id FROM resources WHERE format = ?)")
+            params.append(format)
+        if missing_format is not None:
+            conditions.append("p.id NOT IN (SELECT package_id FROM resources WHERE format = ?)")
+            params.append(missing_format)
+        if bbox is not None:
+            conditions.append("p.id IN (SELECT id FROM extents "
+                              "WHERE max_lon >= ? AND min_lon <= ? AND max_lat >= ? AND min_lat <= ?)")
+            params.extend([bbox[0], bbox[2], bbox[1], bbox[3]])
+        query = "SELECT p.slug, p.title, p.collection, p.category, p.tier FROM packages p"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY p.slug"
+        with self.lock:
+            return [dict(row) for row in self.connection.execute(query, params)]
+
+    def get(self, slug):
+        """
+        Returns:
+        - dict, the package with this slug, or None.
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT package FROM packages WHERE slug = ?", (slug,)).fetchone()
+        return json.loads(row['package']) if row else None
+
+    def counts(self, field):
+        """
+        Number of packages per category, tier, collection, tag or format.
+
+        Returns:
+        - list of (value, count), the most frequent first.
+        """
+        queries = {
+            'category': "SELECT category, COUNT(*) FROM packages GROUP BY category",
+            'tier': "SELECT tier, COUNT(*) FROM packages GROUP BY tier",
+            'collection': "SELECT collection, COUNT(*) FROM packages GROUP BY collection",
+            'tag': "SELECT tag, COUNT(DISTINCT package_id) FROM tags GROUP BY tag",
+            'format': "SELECT format, COUNT(DISTINCT package_id) FROM resources GROUP BY format",
+        }
+        with self.lock:
+            rows = self.connection.execute(queries[field] + " ORDER BY 2 DESC, 1").fetchall()
+        return [(row[0], row[1]) for row in rows]
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+            self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def add_query_arguments(parser):
+    parser.add_argument("--catalog", default=None, help="catalog file, catalog_path in .env by default")
+    parser.add_argument("--load", metavar="EXPORT",
+                        help="first add the packages of a package export (JSON Lines, .gz or .zst)")
+    parser.add_argument("--slug", help="glob pattern of the slug, such as 'clm-fire-*'")
+    parser.add_argument("--collection", choices=('clm', 'its'))
+    parser.add_argument("--category")
+    parser.add_argument("--tier")
+    parser.add_argument("--tag")
+    parser.add_argument("--format", help="resource format the packages have, such as WCS")
+    parser.add_argument("--missing-format", help="resource format the packages do not have")
+    parser.add_argument("--bbox", type=float, nargs=4, metavar=("MIN_LON", "MIN_LAT", "MAX_LON", "MAX_LAT"),
+                        help="area the spatial extent of the packages intersects")
+    parser.add_argument("--counts", choices=('category', 'tier', 'collection', 'tag', 'format'),
+                        help="count the packages per value of a field instead")
+    parser.add_argument("--json", action="store_true", help="print the matching packages in full, one per line")
+
+
+def query_command(args):
+    with PackageCatalog(args.catalog) as catalog:
+        if args.load:
+            from package_export import iter_packages
+
+            for package_dict in iter_packages(args.load):
+                # the export also holds the packages that failed to publish
+                if package_dict.get('publish_outcome') != 'failed':
+                    catalog.add(package_dict)
+            catalog.commit()
+
+        if args.counts:
+            for value, count in catalog.counts(args.counts):
+                print(f"{count:>6}  {value}")
+            return
+
+        packages = catalog.find(slug=args.slug, collection=args.collection, category=args.category, tier=args.tier,
+                                tag=args.tag, format=args.format, missing_format=args.missing_format,
+                                bbox=args.bbox)
+        for package in packages:
+            if args.json:
+                print(json.dumps(catalog.get(package['slug'])))
+            else:
+                print(f"{package['slug']}\t{package['category'] or ''}\t{package['title']}")
+        if not args.json:
+            print(f"{len(packages)} packages")
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Query the local catalog of the generated packages")
+    add_query_arguments(parser)
+    args = parser.parse_args()
+
+    try:
+        query_command(args)
+    except BaseException as e:
+        print(f"Error: {str(e)}")
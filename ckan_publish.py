@@ -0,0 +1,38 @@
+"""
+#
+# Create and patch packages in CKAN
+#
+"""
+
+from http_client import ckan_action
+from metrics import timed
+
+
+@timed('create_dataset')
+def create_dataset(dataset_dict):
+    # Make the API request to create a new dataset
+    response = ckan_action('package_create', dataset_dict)
+
+    # Check the response
+    if response.status_code == 200:
+        created_package = response.json()['result']
+        # print('-' * 70)
+        # print("Dataset created successfully:")
+        # print(json.dumps(created_package, indent=2))
+    else:
+        raise BaseException(f"Error creating dataset: {response.text}")
+
+
+@timed('patch_dataset')
+def patch_dataset(dataset_dict):
+    # Make the API request to update the fields of an existing dataset
+    response = ckan_action('package_patch', dataset_dict)
+
+    # Check the response
+    if response.status_code != 200:
+        raise BaseException(f"Error updating dataset: {response.text}")
+
+
+def publish_dataset(dataset_dict):
+    print(f"creating {dataset_dict['title']}")
+    create_dataset(dataset_dict)
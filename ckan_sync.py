@@ -0,0 +1,106 @@
+"""
+#
+# Synchronize generated CLM and ITS packages with CKAN: create the new
+# ones, patch the changed ones and leave the unchanged ones alone
+#
+"""
+
+import threading
+
+from ckan_publish import create_dataset, patch_dataset
+from http_client import ckan_action, search_packages
+from package_fields import HASH_KEY, get_extra, package_hash
+
+
+def with_hash(package_dict, content_hash):
+    """
+    Return a copy of package_dict carrying content_hash in its extras.
+    """
+    package = dict(package_dict)
+    package['extras'] = [extra for extra in package.get('extras', []) if extra['key'] != HASH_KEY]
+    package['extras'].append({
+        "key": HASH_KEY,
+        "value": content_hash
+    })
+    return package
+
+
+class PackageSync:
+    """
+    Publishes packages by comparing the hash of each generated package with
+    the content_hash extra stored on the package already in CKAN, sending
+    package_create, package_patch or nothing.
+    """
+
+    def __init__(self, org, prefixes=('clm-', 'its-')):
+        self.org = org
+        self.existing = {}
+        for package in search_packages(prefixes, org):
+            self.existing[package['name']] = (package['id'], get_extra(package, HASH_KEY))
+        self.published = set()
+        self.outcomes = {}
+        self.lock = threading.Lock()
+
+    def publish(self, package_dict):
+        """
+        Create, patch or skip one package. Safe to call from worker threads.
+
+        Returns:
+        - str: 'created', 'patched' or 'unchanged'.
+        """
+        content_hash = package_hash(package_dict)
+        package = with_hash(package_dict, content_hash)
+        name = package['name']
+        with self.lock:
+            self.published.add(name)
+
+        if name not in self.existing:
+            print(f"creating {package['title']}")
+            create_dataset(package)
+            outcome = 'created'
+        elif self.existing[name][1] == content_hash:
+            outcome = 'unchanged'
+        else:
+            print(f"updating {package['title']}")
+            package['id'] = self.existing[name][0]
+            patch_dataset(package)
+            outcome = 'patched'
+
+        with self.lock:
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+        return outcome
+
+    def skip(self, package_dict):
+        """
+        Count a package published by a previous run as published by this one,
+        so that it is not deleted as an orphan.
+        """
+        with self.lock:
+            self.published.add(package_dict['name'])
+            self.outcomes['resumed'] = self.outcomes.get('resumed', 0) + 1
+
+    def delete_orphans(self, catalog=None):
+        """
+        Delete the packages found in CKAN that were not published by this run.
+
+        Parameters:
+        - catalog: PackageCatalog, to remove the deleted packages from.
+
+        Returns:
+        - list of the names of the deleted packages.
+        """
+        deleted = []
+        for name in sorted(set(self.existing) - self.published):
+            response = ckan_action('package_delete', {"id": self.existing[name][0]})
+            if response.status_code != 200:
+                raise BaseException(f"Error deleting dataset: {response.text}")
+            print("deleted", name)
+            if catalog is not None:
+                catalog.remove(name)
+            deleted.append(name)
+        with self.lock:
+            self.outcomes['deleted'] = len(deleted)
+        return deleted
+
+    def summary(self):
+        return ", ".join(f"{count} {outcome}" for outcome, count in sorted(self.outcomes.items()))
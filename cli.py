@@ -0,0 +1,165 @@
+"""
+#
+# A single entry point for publishing, synchronizing, deleting and building
+# the CLM and ITS packages. Each command imports the modules it needs when it
+# runs, so that a delete or an ITS publish does not load the CLM and
+# GeoServer code paths, and `--help` loads almost nothing.
+#
+# Usage: python cli.py [--profile DIR] {publish,sync,delete,dry-run} ...
+#
+"""
+
+import argparse
+import os
+import sys
+
+TARGETS = {
+    'all': ('its', 'clm'),
+    'its': ('its',),
+    'clm': ('clm',),
+}
+
+
+def publish_command(args):
+    from save_clm_and_its_to_ckan import publish_clm_and_its
+
+    publish_clm_and_its(TARGETS[args.target], use_async=args.use_async, resume=args.resume, workers=args.workers,
+                        validate=args.validate)
+
+
+def sync_command(args):
+    from save_clm_and_its_to_ckan import publish_clm_and_its
+
+    publish_clm_and_its(TARGETS[args.target], sync=True, delete_orphans=args.delete_orphans,
+                        use_async=args.use_async, resume=args.resume, workers=args.workers,
+                        validate=args.validate)
+
+
+def delete_command(args):
+    from delete_clm_and_its_from_ckan import delete_clm_and_its_packages
+
+    delete_clm_and_its_packages(purge=args.purge, dry_run=args.dry_run, workers=args.workers)
+
+
+def dry_run_command(args):
+    from dry_run import dry_run
+
+    dry_run(args.snapshot, args.out, args.record)
+
+
+def validate_command(args):
+    from endpoint_validation import validate_export
+
+    validate_export(args.packages, args.report)
+
+
+def catalog_command(args):
+    from catalog import query_command
+
+    query_command(args)
+
+
+def add_publish_arguments(parser):
+    parser.add_argument("target", nargs="?", choices=TARGETS, default="all",
+                        help="the packages to publish, all by default")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="run the CLM ingest on the asyncio pipeline")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of CLM packages published in parallel")
+    parser.add_argument("--refresh", action="store_true",
+                        help="revalidate every cached RRK and GeoServer response")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip the packages the run journal confirms as published with the same content")
+    parser.add_argument("--validate", choices=('report', 'flag', 'drop'),
+                        help="check every resource endpoint before publishing and report, flag or drop "
+                             "the broken ones")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Register the CLM and ITS datasets in CKAN")
+    parser.add_argument("--profile", metavar="DIR",
+                        help="write a CPU profile, stage timeline, memory snapshots and the slowest datasets to DIR")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("publish", help="create the CLM and/or ITS packages")
+    add_publish_arguments(command)
+    command.set_defaults(run=publish_command)
+
+    command = commands.add_parser("sync", help="create new packages, patch changed ones and skip unchanged ones")
+    add_publish_arguments(command)
+    command.add_argument("--delete-orphans", action="store_true",
+                         help="delete the clm-/its- packages that are no longer generated (target all only)")
+    command.set_defaults(run=sync_command)
+
+    command = commands.add_parser("delete", help="delete the CLM and ITS packages")
+    command.add_argument("--purge", action="store_true",
+                         help="purge the datasets instead of marking them deleted (requires a sysadmin API key)")
+    command.add_argument("--dry-run", action="store_true",
+                         help="list the datasets that would be deleted without deleting them")
+    command.add_argument("--workers", type=int, default=None,
+                         help="number of parallel deletions")
+    command.set_defaults(run=delete_command)
+
+    command = commands.add_parser("dry-run", help="build every package from a snapshot without writing to CKAN")
+    command.add_argument("--snapshot", default="snapshot", help="directory of the snapshot bundle")
+    command.add_argument("--out", default="build", help="directory of the build")
+    command.add_argument("--record", action="store_true",
+                         help="fetch the RRK, GeoServer and CKAN responses and record them in the snapshot")
+    command.set_defaults(run=dry_run_command)
+
+    command = commands.add_parser("validate", help="check the resource endpoints of exported packages")
+    command.add_argument("--packages", default=None,
+                         help="package export (JSON Lines, .gz or .zst), package_export_path in .env by default")
+    command.add_argument("--report", default=None, help="report file, validation_report_path in .env by default")
+    command.set_defaults(run=validate_command)
+
+    command = commands.add_parser("catalog", help="query the local catalog of the published packages")
+    from catalog import add_query_arguments
+
+    add_query_arguments(command)
+    # a query does not replace the metrics of the last run
+    command.set_defaults(run=catalog_command, reports=False)
+    return parser
+
+
+def main(argv=None):
+    """
+    Run a command and return the exit status, 0 on success.
+    """
+    args = build_parser().parse_args(argv)
+
+    # before any module reads its settings
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    import metrics
+    import profiling
+
+    if getattr(args, 'refresh', False):
+        import http_cache
+
+        http_cache.refresh = True
+
+    if args.profile:
+        profiling.start(args.profile)
+    success = False
+    try:
+        args.run(args)
+        success = True
+    except BaseException as e:
+        if "That URL is already in use." in str(e):
+            print(f"Error: the dataset with the same name exists in CKAN")
+        elif "Organization does not exist" in str(e):
+            print(f"Error: No orgnaization in CKAN has the name: {os.getenv('org_ckan_name')}")
+        else:
+            print(f"Error: {str(e)}")
+    finally:
+        profiling.stop()
+        if getattr(args, 'reports', True):
+            metrics.write_reports(success)
+    return 0 if success else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
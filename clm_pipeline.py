@@ -0,0 +1,229 @@
+"""
+#
+# Asyncio engine for the CLM ingest: the startup fetches run concurrently,
+# then each dataset flows through extent -> transform -> publish stages
+# connected by bounded queues
+#
+"""
+
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urlparse
+
+import profiling
+from capabilities_extent import WCS_URL, harvest_extents
+from dataset_hierarchy import HierarchyIndex, get_clm_hierarchy
+from download_metadata import harvest_download_metadata
+from download_urls import load_download_url_index, report_download_urls
+from ckan_publish import publish_dataset
+from package_export import PackageExporter, with_outcome
+from save_clm_to_ckan import (get_clm_dataset_page, get_dataset_extents, get_page_size, next_skip, prepare_dataset,
+                              transform_to_ckan_package, validate_org)
+from wms_extent import load_layer_index
+
+_DONE = object()
+
+
+class HostLimiter:
+    """
+    Runs blocking calls on a thread pool with at most `limit` calls in
+    flight per host (max_connections_per_host in .env, 8 by default).
+    """
+
+    def __init__(self, limit=None):
+        if limit is None:
+            limit = int(os.getenv('max_connections_per_host', 8))
+        self.limit = limit
+        self.semaphores = {}
+        self.executor = None
+
+    def host(self, url):
+        return urlparse(url).hostname
+
+    async def run(self, url, func, *args, **kwargs):
+        host = self.host(url)
+        if host not in self.semaphores:
+            self.semaphores[host] = asyncio.Semaphore(self.limit)
+        async with self.semaphores[host]:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    def __enter__(self):
+        # enough threads for every host to reach its limit
+        self.executor = ThreadPoolExecutor(max_workers=self.limit * 4)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.executor.shutdown(wait=True)
+
+
+async def _fan_out(count, worker):
+    await asyncio.gather(*(worker() for _ in range(count)))
+
+
+async def _iter_datasets(limiter, rrk_url, page_size):
+    """
+    Page through the RRK CLM dataset collection, requesting the next page
+    while the current one is consumed.
+    """
+    skip = 0
+    last_id = None
+    next_page = asyncio.ensure_future(limiter.run(rrk_url, get_clm_dataset_page, skip, page_size))
+    try:
+        while True:
+            page = await next_page
+            if not page:
+                return
+            skip = next_skip(skip, page, last_id)
+            last_id = page[-1]['dataset_id']
+            next_page = asyncio.ensure_future(limiter.run(rrk_url, get_clm_dataset_page, skip, page_size))
+            for dataset in page:
+                yield dataset
+    finally:
+        if not next_page.done():
+            next_page.cancel()
+
+
+async def run_clm_pipeline(publish=None, queue_size=None):
+    """
+    Register every CLM dataset in CKAN with asyncio.
+
+    validate_org, the taxonomy hierarchy and the WMS, WCS and WFS
+    capabilities are fetched concurrently. The RRK datasets are then paged
+    in, and each one goes through the GeoServer extent lookup, the
+    transform and the publish stages; the stages overlap and are limited
+    per host by HostLimiter.
+
+    Parameters:
+    - publish: callable, sends a package dict to CKAN, publish_dataset by default.
+    - queue_size: int, capacity of the queues between stages.
+
+    Transformed packages are exported in dataset order, with the outcome
+    of their publish, as soon as every earlier dataset is done.
+
+    Returns:
+    - int, the number of published packages.
+    """
+    if publish is None:
+        publish = publish_dataset
+    org = os.getenv('org_ckan_name')
+    ckan_url = os.getenv('ckan_url')
+    rrk_url = os.getenv('rrk_api_url')
+
+    with HostLimiter() as limiter:
+        if queue_size is None:
+            queue_size = limiter.limit * 2
+
+        _, hierarchy, _, _, _ = await asyncio.gather(
+            limiter.run(ckan_url, validate_org, org),
+            limiter.run(rrk_url, get_clm_hierarchy),
+            limiter.run(WCS_URL, load_layer_index),
+            limiter.run(WCS_URL, harvest_extents),
+            # on its own pool of HEAD requests, not counted against a host limit
+            asyncio.get_running_loop().run_in_executor(limiter.executor, harvest_download_metadata),
+        )
+        hierarchy = HierarchyIndex(hierarchy)
+
+        download_url_index = load_download_url_index("clm_download_urls.json")
+        with open("dataset_keywords_map.json", "r") as json_file:
+            dataset_keywords_map = json.load(json_file)
+
+        extent_queue = asyncio.Queue(maxsize=queue_size)
+        transform_queue = asyncio.Queue(maxsize=queue_size)
+        publish_queue = asyncio.Queue(maxsize=queue_size)
+        exporter = PackageExporter()
+        failures = []
+        published = []
+
+        file_paths = []
+
+        async def feed():
+            async for dataset in _iter_datasets(limiter, rrk_url, get_page_size()):
+                await extent_queue.put((len(file_paths), dataset))
+                file_paths.append(dataset['file_path'])
+            for _ in range(limiter.limit):
+                await extent_queue.put(_DONE)
+
+        async def extent_worker():
+            while True:
+                item = await extent_queue.get()
+                if item is _DONE:
+                    break
+                index, dataset = item
+                try:
+                    extents = await limiter.run(WCS_URL, profiling.track(dataset['name'], get_dataset_extents),
+                                                dataset)
+                except Exception as e:
+                    print(f"failed {dataset['name']}: {e}")
+                    failures.append((index, dataset['name'], e))
+                    exporter.put(index, None)
+                    continue
+                await transform_queue.put((index, dataset, extents))
+
+        async def transform_stage():
+            await _fan_out(limiter.limit, extent_worker)
+            await transform_queue.put(_DONE)
+
+        async def transform_worker():
+            while True:
+                item = await transform_queue.get()
+                if item is _DONE:
+                    break
+                index, dataset, extents = item
+                try:
+                    category, label = prepare_dataset(dataset, hierarchy)
+                    transform = profiling.track(dataset['name'], transform_to_ckan_package)
+                    package_dict = transform(dataset, org, category, label, dataset_keywords_map,
+                                             download_url_index, extents=extents)
+                    if not "notes" in package_dict.keys():
+                        raise ValueError(f'No notes: {package_dict["name"]}')
+                except Exception as e:
+                    print(f"failed {dataset['name']}: {e}")
+                    failures.append((index, dataset['name'], e))
+                    exporter.put(index, None)
+                    continue
+                await publish_queue.put((index, dataset, package_dict))
+            for _ in range(limiter.limit):
+                await publish_queue.put(_DONE)
+
+        async def publish_worker():
+            while True:
+                item = await publish_queue.get()
+                if item is _DONE:
+                    break
+                index, dataset, package_dict = item
+                try:
+                    outcome = await limiter.run(ckan_url, profiling.track(dataset['name'], publish), package_dict)
+                    exporter.put(index, with_outcome(package_dict, outcome))
+                    published.append(index)
+                except BaseException as e:
+                    if isinstance(e, (KeyboardInterrupt, SystemExit, asyncio.CancelledError)):
+                        raise
+                    print(f"failed {dataset['name']}: {e}")
+                    failures.append((index, dataset['name'], e))
+                    exporter.put(index, with_outcome(package_dict, error=e))
+
+        try:
+            await asyncio.gather(
+                feed(),
+                transform_stage(),
+                transform_worker(),
+                _fan_out(limiter.limit, publish_worker),
+            )
+        finally:
+            exporter.close()
+
+    report_download_urls(download_url_index, file_paths)
+
+    if failures:
+        failures.sort(key=lambda failure: failure[0])
+        raise BaseException(f"{len(failures)} of {len(file_paths)} CLM datasets failed: " +
+                            "; ".join(f"{name}: {error}" for _, name, error in failures))
+    return len(published)
+
+
+def save_clm_to_ckan_async(publish=None):
+    return asyncio.run(run_clm_pipeline(publish))
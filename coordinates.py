@@ -0,0 +1,116 @@
+"""
+#
+# Reproject bounding boxes to latitude and longitude (EPSG:4326)
+#
+"""
+
+import math
+import threading
+
+from metrics import timed
+
+# California in longitude and latitude, for the data without a known extent
+CALIFORNIA_BBOX = (-124.41, 32.53, -114.13, 42.01)
+
+_transformers = threading.local()
+
+
+def get_transformer(source_epsg, target_epsg="4326"):
+    """
+    Return a cached transformer between two EPSG codes.
+
+    Building the PROJ pipeline is much more expensive than transforming,
+    so each thread builds a transformer once per pair of codes and reuses it.
+    pyproj is imported on first use, so that the commands which never
+    reproject do not pay for loading PROJ.
+    """
+    from pyproj import Transformer
+
+    cache = getattr(_transformers, 'cache', None)
+    if cache is None:
+        cache = _transformers.cache = {}
+    key = (str(source_epsg), str(target_epsg))
+    if key not in cache:
+        cache[key] = Transformer.from_crs(f"EPSG:{key[0]}", f"EPSG:{key[1]}", always_xy=True)
+    return cache[key]
+
+
+def densify_bbox(lower_coords, upper_coords, densify_pts=21):
+    """
+    Return the x and y coordinates of densify_pts points along each edge of
+    a bounding box, so that its reprojection follows the curved edges
+    instead of only the two corners.
+    """
+    x_min, y_min = lower_coords[0], lower_coords[1]
+    x_max, y_max = upper_coords[0], upper_coords[1]
+    xs = []
+    ys = []
+    for i in range(densify_pts):
+        t = i / (densify_pts - 1)
+        x = x_min + (x_max - x_min) * t
+        y = y_min + (y_max - y_min) * t
+        xs.extend([x, x, x_min, x_max])
+        ys.extend([y_min, y_max, y, y])
+    return xs, ys
+
+
+@timed('convert_envelopes_to_lat_lon')
+def convert_envelopes_to_lat_lon(envelopes, densify_pts=21):
+    """
+    Reproject many bounding boxes to latitude and longitude.
+
+    The densified edges of all the envelopes sharing an EPSG code are
+    transformed in a single call.
+
+    Parameters:
+    - envelopes: list of (lower_coords, upper_coords, epsg_code); a missing
+      epsg_code means EPSG:3310.
+    - densify_pts: int, number of points per bbox edge, at least 2.
+
+    Returns:
+    - list of ((lat_min, lon_min), (lat_max, lon_max)), in the order of
+      envelopes, with None for envelopes that could not be reprojected.
+    """
+    by_epsg = {}
+    for i, (lower_coords, upper_coords, epsg_code) in enumerate(envelopes):
+        by_epsg.setdefault(epsg_code or "3310", []).append(i)
+
+    lat_lon_bboxes = [None] * len(envelopes)
+    points_per_bbox = densify_pts * 4
+    for epsg_code, indexes in by_epsg.items():
+        xs = []
+        ys = []
+        for i in indexes:
+            bbox_xs, bbox_ys = densify_bbox(envelopes[i][0], envelopes[i][1], densify_pts)
+            xs.extend(bbox_xs)
+            ys.extend(bbox_ys)
+
+        if epsg_code != "4326":
+            xs, ys = get_transformer(epsg_code).transform(xs, ys)
+
+        for n, i in enumerate(indexes):
+            start = n * points_per_bbox
+            points = [(lon, lat) for lon, lat in zip(xs[start:start + points_per_bbox],
+                                                     ys[start:start + points_per_bbox])
+                      if math.isfinite(lon) and math.isfinite(lat)]
+            if points:
+                lons = [lon for lon, _ in points]
+                lats = [lat for _, lat in points]
+                lat_lon_bboxes[i] = ((min(lats), min(lons)), (max(lats), max(lons)))
+    return lat_lon_bboxes
+
+
+@timed('convert_coordinates_to_lat_lon')
+def convert_coordinates_to_lat_lon(lower_coords, upper_coords, epsg_code="3310"):
+    """
+    Convert bounding box coordinates from EPSG:3310, or another EPSG code, to latitude and longitude (EPSG:4326).
+
+    Parameters:
+    - lower_coords: list of float, lower corner coordinates [x_min, y_min].
+    - upper_coords: list of float, upper corner coordinates [x_max, y_max].
+    - epsg_code: str, EPSG code of the coordinates, 3310 by default.
+
+    Returns:
+    - lat_lon_bbox: tuple, ((lat_min, lon_min), (lat_max, lon_max)).
+    """
+    return convert_envelopes_to_lat_lon([(lower_coords, upper_coords, epsg_code)])[0]
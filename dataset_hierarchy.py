@@ -1,14 +1,13 @@
 import os
 
-import requests
-from dotenv import load_dotenv
-
-load_dotenv()
+from http_cache import cached_get
+from metrics import timed
 
 
+@timed('get_clm_hierarchy')
 def get_clm_hierarchy():
     url = os.getenv('rrk_api_url')
-    response = requests.get(f"{url}/DatasetCollection/100/taxonomy/33/hierarchy")
+    response = cached_get(f"{url}/DatasetCollection/100/taxonomy/33/hierarchy")
     response.raise_for_status()
     return response.json()
 
@@ -45,3 +44,67 @@ def get_datasets(title, forest):
         tmp = get_datasets(title, subtree)
         datasets = datasets + tmp
     return datasets
+
+
+class HierarchyIndex:
+    """
+    Index of the CLM taxonomy built in one pass over the output of
+    get_clm_hierarchy(), answering get_category and get_datasets lookups
+    in constant time.
+    """
+
+    def __init__(self, forest):
+        self.categories = {}
+        self.paths = {}
+        self.datasets_by_title = {}
+        self._index_categories(forest, [])
+        self._index_titles(forest)
+
+    def _index_categories(self, forest, path):
+        # same order as get_category: the direct children of a taxonomy item
+        # first, then its sub items, so the first match wins in both
+        for tree in forest:
+            if "taxonomy_item_name" in tree.keys() and "children" in tree.keys():
+                tree_path = path + [(tree["key"], tree["label"])]
+                subtree = []
+                for kid in tree["children"]:
+                    if "dataset_id" in kid.keys():
+                        self.categories.setdefault(kid["dataset_id"], (tree["key"], tree["label"]))
+                        self.paths.setdefault(kid["dataset_id"], tree_path)
+                    else:
+                        subtree.append(kid)
+                self._index_categories(subtree, tree_path)
+
+    def _index_titles(self, forest):
+        # breadth first, same order as get_datasets
+        level = forest
+        while level:
+            subtree = []
+            for tree in level:
+                if "taxonomy_item_name" in tree.keys() and "children" in tree.keys():
+                    subtree = subtree + tree["children"]
+                elif "dataset_name" in tree.keys():
+                    self.datasets_by_title.setdefault(tree["dataset_name"], []).append(tree["dataset_id"])
+            level = subtree
+
+    def get_category(self, dataset_id):
+        """
+        Returns:
+        - (key, label) of the taxonomy item holding the dataset, or (None, None).
+        """
+        return self.categories.get(dataset_id, (None, None))
+
+    def get_path(self, dataset_id):
+        """
+        Returns:
+        - list of (key, label) from the root taxonomy item down to the one
+          holding the dataset.
+        """
+        return list(self.paths.get(dataset_id, []))
+
+    def get_datasets(self, title):
+        """
+        Returns:
+        - list of the ids of the datasets named title.
+        """
+        return list(self.datasets_by_title.get(title, []))
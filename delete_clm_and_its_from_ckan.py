@@ -1,50 +1,109 @@
-import json
+import argparse
 import os
-import requests
+
 from dotenv import load_dotenv
 
+import metrics
+import profiling
+from catalog import PackageCatalog
+from http_client import ckan_action, search_packages
+from metrics import timed
+from worker_pool import run_ordered
+
 load_dotenv()
 
 
-def get_clm_and_its_package_ids():
-    ckan_url = os.getenv('ckan_url')
-    api_key = os.getenv('api_key')
-    headers = {
-        'X-CKAN-API-Key': api_key,
-        'Content-Type': 'application/json'
-    }
+@timed('get_clm_and_its_package_ids')
+def get_clm_and_its_package_ids(org=None):
+    """
+    List the clm-/its- packages of an organization with a paginated
+    package_search, without downloading the portal's whole package list.
 
-    api_url = f"{ckan_url}/api/3/action/package_list"
-    response = requests.post(api_url, headers=headers)
+    Parameters:
+    - org: str, organization name, org_ckan_name in .env by default.
 
-    # Check the response
-    if response.status_code == 200:
-        package_ids = response.json()['result']
-        return [package_id for package_id in package_ids if
-                package_id.startswith('clm-') or package_id.startswith('its-')]
-    else:
-        raise BaseException(f"Error creating dataset: {response.text}")
+    Returns:
+    - list of package names.
+    """
+    if org is None:
+        org = os.getenv('org_ckan_name')
+    return [package['name'] for package in search_packages(('clm-', 'its-'), org, fields='id,name')]
 
 
-def delete_clm_and_its_packages():
-    ckan_url = os.getenv('ckan_url')
-    api_key = os.getenv('api_key')
-    headers = {
-        'X-CKAN-API-Key': api_key,
-        'Content-Type': 'application/json'
+@timed('delete_package')
+def delete_package(package_id, purge=False):
+    action = 'dataset_purge' if purge else 'package_delete'
+    dataset_dict = {
+        "id": package_id
     }
+    response = ckan_action(action, dataset_dict)
+    if response.status_code != 200:
+        raise BaseException(f"Error deleting dataset: {response.text}")
+
 
-    api_url = f"{ckan_url}/api/3/action/package_delete"
+def delete_clm_and_its_packages(purge=False, dry_run=False, workers=None, catalog=None):
+    """
+    Delete the clm-/its- packages of the organization in parallel.
 
+    Parameters:
+    - purge: bool, purge the packages instead of marking them deleted.
+    - dry_run: bool, only list the packages that would be deleted.
+    - workers: int, number of parallel deletions, publish_workers in .env by default.
+    - catalog: PackageCatalog, to remove the deleted packages from, the one
+      of catalog_path in .env by default.
+    """
     package_ids = get_clm_and_its_package_ids()
-    for package_id in package_ids:
-        dataset_dict = {
-            "id": package_id
-        }
-        response = requests.post(api_url, data=json.dumps(dataset_dict), headers=headers)
-        if response.status_code == 200:
-            print("deleted", package_id)
+    if dry_run:
+        for package_id in package_ids:
+            print("would delete", package_id)
+        print(f"{len(package_ids)} datasets would be deleted")
+        return
+
+    failures = []
+    def delete(package_id):
+        profiling.track(package_id, delete_package)(package_id, purge)
+
+    own_catalog = catalog is None
+    if own_catalog:
+        catalog = PackageCatalog()
+    try:
+        for package_id, _, error in run_ordered(delete, package_ids, workers):
+            if error is None:
+                print("purged" if purge else "deleted", package_id)
+                catalog.remove(package_id)
+            else:
+                print(f"failed {package_id}: {error}")
+                failures.append((package_id, error))
+    finally:
+        if own_catalog:
+            catalog.close()
+
+    print(f"{len(package_ids) - len(failures)} datasets deleted, {len(failures)} failed")
+    if failures:
+        raise BaseException(f"{len(failures)} of {len(package_ids)} datasets could not be deleted: " +
+                            "; ".join(f"{package_id}: {error}" for package_id, error in failures))
 
 
 if __name__ == "__main__":
-    delete_clm_and_its_packages()
+    parser = argparse.ArgumentParser(description="Delete the CLM and ITS datasets from CKAN")
+    parser.add_argument("--purge", action="store_true",
+                        help="purge the datasets instead of marking them deleted (requires a sysadmin API key)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="list the datasets that would be deleted without deleting them")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of parallel deletions")
+    parser.add_argument("--profile", metavar="DIR",
+                        help="write a CPU profile, stage timeline, memory snapshots and the slowest deletions to DIR")
+    args = parser.parse_args()
+
+    if args.profile:
+        profiling.start(args.profile)
+    success = False
+    try:
+        delete_clm_and_its_packages(purge=args.purge, dry_run=args.dry_run, workers=args.workers)
+        success = True
+    except BaseException as e:
+        print(f"Error: {str(e)}")
+    finally:
+        profiling.stop()
+        metrics.write_reports(success)
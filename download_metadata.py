@@ -0,0 +1,215 @@
+"""
+#
+# Harvest the size, ETag and Last-Modified date of the CLM download zips
+# with concurrent HEAD requests, kept in a persistent cache so that a
+# changed zip is detected without downloading it
+#
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+
+import requests
+
+import http_cache
+from http_client import head_or_first_byte
+from metrics import timed
+from rate_control import RETRY_STATUSES, backoff_delay
+from worker_pool import run_ordered
+
+# url -> {'status', 'size', 'etag', 'last_modified_header', 'checked', 'changed'}
+metadata = None
+metadata_lock = threading.Lock()
+
+
+def get_cache_path():
+    return os.path.join(http_cache.get_cache_dir(), 'download_metadata.json')
+
+
+def load_cache(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def save_cache(path, entries):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(entries, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+@timed('head_download')
+def head_download(url, previous=None, timeout=None):
+    """
+    Read the size, ETag and Last-Modified date of a download without
+    downloading it: a HEAD, conditional when previous holds validators, or
+    a one-byte range GET when the server refuses HEAD. A 429 or 5xx keeps
+    the previous entry, so that an outage does not look like a change of
+    the zip, while a 404 or 410 replaces it.
+
+    Parameters:
+    - url: str.
+    - previous: dict, the cached entry of the URL.
+    - timeout: float, download_metadata_timeout in .env, 20 by default.
+
+    Returns:
+    - dict, the new entry; changed tells whether the zip differs from previous.
+    """
+    if timeout is None:
+        timeout = float(os.getenv('download_metadata_timeout', 20))
+    headers = {}
+    if previous and previous.get('status') == 200:
+        if previous.get('etag'):
+            headers['If-None-Match'] = previous['etag']
+        if previous.get('last_modified_header'):
+            headers['If-Modified-Since'] = previous['last_modified_header']
+
+    response = head_or_first_byte(url, headers, timeout, need_length=True)
+    if response.status_code == 304:
+        return dict(previous, checked=time.time(), changed=False)
+
+    size = response.headers.get('Content-Length')
+    if response.status_code == 206:
+        # the total size is at the end of the Content-Range of the first byte
+        match = re.search(r'/(\d+)$', response.headers.get('Content-Range', ''))
+        size = match.group(1) if match else None
+        response.status_code = 200
+    if previous and response.status_code in RETRY_STATUSES:
+        # checked again on the next run
+        print(f"Keeping the previous metadata of {url}: HTTP {response.status_code}")
+        return dict(previous, changed=False)
+
+    entry = {
+        'status': response.status_code,
+        'size': int(size) if response.status_code == 200 and size else None,
+        'etag': response.headers.get('ETag'),
+        'last_modified_header': response.headers.get('Last-Modified'),
+        # an entry of a throttled or failing server is checked again on the next run
+        'checked': 0 if response.status_code in RETRY_STATUSES else time.time(),
+    }
+    entry['changed'] = previous is not None and any(
+        previous.get(key) != entry[key] for key in ('status', 'size', 'etag', 'last_modified_header'))
+    return entry
+
+
+def check_download(url, previous=None, retries=None):
+    """
+    head_download, retried with backoff on connection errors, timeouts and
+    429 or 5xx statuses, download_metadata_retries (2) times.
+    """
+    if retries is None:
+        retries = int(os.getenv('download_metadata_retries', 2))
+    attempt = 0
+    while True:
+        try:
+            entry = head_download(url, previous)
+            if entry['status'] not in RETRY_STATUSES or attempt >= retries:
+                return entry
+        except requests.exceptions.RequestException:
+            if attempt >= retries:
+                raise
+        time.sleep(backoff_delay(attempt))
+        attempt += 1
+
+
+@timed('harvest_download_metadata')
+def harvest_download_metadata(path="clm_download_urls.json", workers=None, ttl=None):
+    """
+    Fetch the metadata of every download URL once per run. Cached entries
+    younger than ttl seconds are reused, older ones are revalidated.
+
+    Parameters:
+    - path: str, the JSON list of download URLs.
+    - workers: int, concurrent requests, download_metadata_workers in .env, 16 by default.
+    - ttl: float, download_metadata_ttl in .env, one day by default.
+    """
+    global metadata
+    with metadata_lock:
+        if metadata is not None:
+            return
+        if workers is None:
+            workers = int(os.getenv('download_metadata_workers', 16))
+        if ttl is None:
+            ttl = float(os.getenv('download_metadata_ttl', 24 * 60 * 60))
+        with open(path, 'r') as json_file:
+            urls = sorted(set(json.load(json_file)))
+
+        # replayed runs request every URL, refreshed ones revalidate them all
+        use_cache = not http_cache.disabled
+        cache = load_cache(get_cache_path()) if use_cache else {}
+        now = time.time()
+        entries = {}
+        stale = []
+        for url in urls:
+            previous = cache.get(url)
+            if previous and not http_cache.refresh and now - previous['checked'] < ttl:
+                entries[url] = dict(previous, changed=False)
+            else:
+                stale.append(url)
+
+        failures = 0
+        for url, entry, error in run_ordered(lambda url: check_download(url, cache.get(url)), stale, workers):
+            if error is not None:
+                failures += 1
+                if url in cache:
+                    # left stale, so that it is checked again on the next run
+                    entries[url] = dict(cache[url], changed=False)
+                continue
+            entries[url] = entry
+
+        if use_cache:
+            save_cache(get_cache_path(), entries)
+        metadata = entries
+
+        changed = changed_downloads()
+        for url in changed:
+            print(f"Download changed: {url}")
+        print(f"download metadata: {len(stale)} of {len(urls)} URLs checked, {len(changed)} changed, "
+              f"{failures} unreachable")
+
+
+def changed_downloads():
+    """
+    Returns:
+    - list of the download URLs whose size, ETag or Last-Modified date
+      changed since the previous harvest.
+    """
+    return sorted(url for url, entry in (metadata or {}).items() if entry.get('changed'))
+
+
+def lookup_download_metadata(url):
+    """
+    Returns:
+    - dict of the CKAN resource fields of a download, size, last_modified
+      and etag, with only the known ones; empty when the URL is unreachable.
+    """
+    harvest_download_metadata()
+    entry = metadata.get(url)
+    if not entry or entry.get('status') != 200:
+        return {}
+    fields = {}
+    if entry.get('size') is not None:
+        fields['size'] = entry['size']
+    if entry.get('last_modified_header'):
+        try:
+            # CKAN expects an ISO 8601 date without a time zone, in UTC
+            last_modified = parsedate_to_datetime(entry['last_modified_header'])
+            if last_modified.tzinfo is not None:
+                last_modified = last_modified.astimezone(timezone.utc).replace(tzinfo=None)
+            fields['last_modified'] = last_modified.isoformat()
+        except (TypeError, ValueError):
+            pass
+    if entry.get('etag'):
+        fields['etag'] = entry['etag']
+    return fields
@@ -0,0 +1,81 @@
+"""
+#
+# Resolve the download URL of a CLM dataset from clm_download_urls.json
+#
+"""
+
+import json
+import os
+
+
+def file_stem(path):
+    """
+    Lower-cased file name without directories and extension, e.g.
+    https://rrk.sdsc.edu/full_extent/d/airQuality/Tier1/HeavyFuels_SNV_T2_v5.zip
+    becomes heavyfuels_snv_t2_v5.
+    """
+    name = os.path.basename(path.rstrip('/'))
+    return os.path.splitext(name)[0].lower()
+
+
+def build_download_url_index(download_urls):
+    """
+    Index download URLs by file stem.
+
+    Parameters:
+    - download_urls: list of str.
+
+    Returns:
+    - dict, file stem -> list of the URLs with that stem.
+    """
+    index = {}
+    for url in download_urls:
+        urls = index.setdefault(file_stem(url), [])
+        if url not in urls:
+            urls.append(url)
+    return index
+
+
+def load_download_url_index(path="clm_download_urls.json"):
+    with open(path, "r") as json_file:
+        return build_download_url_index(json.load(json_file))
+
+
+def find_download_url(index, file_path):
+    """
+    Find the download URL of a dataset file.
+
+    Parameters:
+    - index: dict, as returned by build_download_url_index.
+    - file_path: str, the file_path of the RRK dataset.
+
+    Returns:
+    - str, or None when no URL, or more than one, has the file's stem.
+    """
+    urls = index.get(file_stem(file_path), [])
+    if len(urls) == 1:
+        return urls[0]
+    return None
+
+
+def report_download_urls(index, file_paths):
+    """
+    Print the dataset files that have no download URL or more than one.
+
+    Returns:
+    - (unmatched, multiple): lists of file paths.
+    """
+    unmatched = []
+    multiple = []
+    for file_path in file_paths:
+        urls = index.get(file_stem(file_path), [])
+        if not urls:
+            unmatched.append(file_path)
+        elif len(urls) > 1:
+            multiple.append(file_path)
+
+    for file_path in unmatched:
+        print(f"No download URL for {file_path}")
+    for file_path in multiple:
+        print(f"More than one download URL for {file_path}: {', '.join(index[file_stem(file_path)])}")
+    return unmatched, multiple
@@ -0,0 +1,123 @@
+"""
+#
+# Build every CLM and ITS package without writing to CKAN, from a snapshot
+# of the upstream responses, and compare the payloads with the previous build
+#
+"""
+
+import argparse
+import difflib
+import json
+import os
+import threading
+
+from dotenv import load_dotenv
+
+from catalog import PackageCatalog
+from package_export import PackageExporter, iter_packages
+from snapshot import use_snapshot
+
+load_dotenv()
+
+
+def diff_builds(previous, current):
+    """
+    Compare two builds.
+
+    Parameters:
+    - previous, current: dict, package name -> package dict.
+
+    Returns:
+    - (added, removed, changed, text): the names of the added, removed and
+      changed packages, and a unified diff of the changed ones.
+    """
+    added = sorted(set(current) - set(previous))
+    removed = sorted(set(previous) - set(current))
+    changed = sorted(name for name in set(current) & set(previous) if current[name] != previous[name])
+    text = []
+    for name in changed:
+        before = json.dumps(previous[name], indent=2, sort_keys=True).splitlines()
+        after = json.dumps(current[name], indent=2, sort_keys=True).splitlines()
+        text.extend(difflib.unified_diff(before, after, f"previous/{name}", f"current/{name}", lineterm=''))
+    for name in added:
+        text.append(f"+ {name}")
+    for name in removed:
+        text.append(f"- {name}")
+    return added, removed, changed, '\n'.join(text) + '\n'
+
+
+def dry_run(snapshot_dir='snapshot', out_dir='build', record=False):
+    """
+    Build the CLM and ITS packages and write them to out_dir/packages.jsonl,
+    sorted by name, with out_dir/diff.txt comparing them to the packages of
+    the previous build and out_dir/catalog.sqlite to query them. Nothing is
+    sent to CKAN.
+
+    Parameters:
+    - snapshot_dir: str, the snapshot bundle of the RRK, GeoServer and CKAN
+      responses.
+    - out_dir: str, where the build is written.
+    - record: bool, fetch the responses from the network and record them in
+      snapshot_dir instead of replaying them.
+
+    Returns:
+    - (added, removed, changed) package names.
+    """
+    # imported here so that the snapshot adapter is in place first
+    from save_clm_to_ckan import save_clm_to_ckan
+    from save_its_to_ckan import save_its_to_ckan
+
+    os.makedirs(out_dir, exist_ok=True)
+    packages_path = os.path.join(out_dir, 'packages.jsonl')
+    previous = {}
+    if os.path.exists(packages_path):
+        previous = {package['name']: package for package in iter_packages(packages_path)}
+
+    packages = {}
+    lock = threading.Lock()
+
+    def collect(package_dict):
+        with lock:
+            packages[package_dict['name']] = package_dict
+
+    adapter = use_snapshot(snapshot_dir, record)
+    # the CLM export of a real run is not overwritten
+    os.environ['package_export_path'] = os.path.join(out_dir, 'clm_export.jsonl')
+    try:
+        save_its_to_ckan(publish=collect)
+        save_clm_to_ckan(publish=collect)
+    finally:
+        adapter.close()
+
+    with PackageExporter(packages_path) as exporter:
+        for name in sorted(packages):
+            exporter.write(packages[name])
+
+    catalog_path = os.path.join(out_dir, 'catalog.sqlite')
+    for path in (catalog_path, f"{catalog_path}-wal", f"{catalog_path}-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+    with PackageCatalog(catalog_path) as catalog:
+        for name in sorted(packages):
+            catalog.add(packages[name])
+
+    added, removed, changed, text = diff_builds(previous, packages)
+    with open(os.path.join(out_dir, 'diff.txt'), 'w') as f:
+        f.write(text)
+    print(f"{len(packages)} packages built in {packages_path}: "
+          f"{len(added)} added, {len(removed)} removed, {len(changed)} changed since the previous build")
+    return added, removed, changed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the CKAN packages from a snapshot without publishing them")
+    parser.add_argument("--snapshot", default="snapshot", help="directory of the snapshot bundle")
+    parser.add_argument("--out", default="build", help="directory of the build")
+    parser.add_argument("--record", action="store_true",
+                        help="fetch the RRK, GeoServer and CKAN responses and record them in the snapshot")
+    args = parser.parse_args()
+
+    try:
+        dry_run(args.snapshot, args.out, args.record)
+    except BaseException as e:
+        print(f"Error: {str(e)}")
@@ -0,0 +1,352 @@
+"""
+#
+# Check the resources of the generated packages before they are published:
+# a small GetMap, GetCoverage or GetFeature on the GeoServer endpoints, a
+# HEAD on the download zips and ?f=json on the ArcGIS services
+#
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+
+import http_cache
+from catalog import spatial_bbox
+from coordinates import CALIFORNIA_BBOX
+from http_client import get_session, head_or_first_byte
+from metrics import timed
+
+ACTIONS = ('report', 'flag', 'drop')
+
+
+def build_probe(resource, bbox=None):
+    """
+    The request checking a resource.
+
+    Parameters:
+    - resource: dict, a CKAN resource.
+    - bbox: (min_lon, min_lat, max_lon, max_lat), the extent of its package.
+
+    Returns:
+    - (kind, method, url, params), or None for a resource without a URL.
+    """
+    url = resource.get('url')
+    if not url:
+        return None
+    # California for the resources of packages without a spatial extent
+    min_lon, min_lat, max_lon, max_lat = bbox or CALIFORNIA_BBOX
+    resource_format = (resource.get('format') or '').upper()
+    if resource_format == 'WMS' and resource.get('wms_layer'):
+        return 'wms', 'GET', url, {
+            'service': 'WMS',
+            'version': '1.3.0',
+            'request': 'GetMap',
+            'layers': resource['wms_layer'],
+            'styles': '',
+            # EPSG:4326 is latitude first in WMS 1.3.0
+            'crs': 'EPSG:4326',
+            'bbox': f"{min_lat},{min_lon},{max_lat},{max_lon}",
+            'width': 8,
+            'height': 8,
+            'format': 'image/png',
+        }
+    if resource_format == 'WCS' and resource.get('wcs_coverage_id'):
+        return 'wcs', 'GET', url, {
+            'service': 'WCS',
+            'version': '2.0.1',
+            'request': 'GetCoverage',
+            'coverageId': resource['wcs_coverage_id'],
+            'format': 'image/tiff',
+            'scalesize': 'i(8),j(8)',
+        }
+    if resource_format == 'WFS' and resource.get('wfs_feature_id'):
+        return 'wfs', 'GET', url, {
+            'service': 'WFS',
+            'version': '1.1.0',
+            'request': 'GetFeature',
+            'typeName': resource['wfs_feature_id'],
+            'maxFeatures': 1,
+        }
+    if resource_format == 'ARCGIS FEATURE SERVICE' or '/arcgis/rest/services/' in url:
+        return 'arcgis', 'GET', url, {'f': 'json'}
+    return 'download', 'HEAD', url, None
+
+
+def check_response(kind, response):
+    """
+    Returns:
+    - str, why the probe response shows a broken resource, or None.
+    """
+    if kind == 'download':
+        if response.status_code in (200, 206):
+            return None
+        return f"HTTP {response.status_code}"
+    if response.status_code != 200:
+        return f"HTTP {response.status_code}"
+    content_type = response.headers.get('Content-Type', '')
+    if kind in ('wms', 'wcs'):
+        # GeoServer answers errors with a 200 XML exception report
+        if 'xml' in content_type or 'text' in content_type:
+            return f"{kind.upper()} exception: {response.text[:200].strip()}"
+        return None
+    if kind == 'wfs':
+        if 'ExceptionReport' in response.text[:2000]:
+            return f"WFS exception: {response.text[:200].strip()}"
+        return None
+    if kind == 'arcgis':
+        try:
+            document = response.json()
+        except ValueError:
+            return "not a JSON response"
+        if 'error' in document:
+            return f"ArcGIS error: {document['error'].get('message', document['error'])}"
+        return None
+    return None
+
+
+class ResourceValidator:
+    """
+    Probes resources concurrently on a pool of `workers` threads, with at
+    most `per_host` probes in flight per host. Results are cached on disk
+    by probe URL for `ttl` seconds, so that a rerun only probes what expired.
+    """
+
+    def __init__(self, workers=None, per_host=None, ttl=None, timeout=None, cache_path=None):
+        """
+        Parameters:
+        - workers: int, validation_workers in .env, 32 by default.
+        - per_host: int, max_connections_per_host in .env, 8 by default.
+        - ttl: float, validation_ttl in .env, one hour by default.
+        - timeout: float, seconds per probe, validation_timeout in .env, 20 by default.
+        - cache_path: str, validation.json in the HTTP cache directory by default.
+        """
+        self.workers = workers or int(os.getenv('validation_workers', 32))
+        self.per_host = per_host or int(os.getenv('max_connections_per_host', 8))
+        self.ttl = ttl if ttl is not None else float(os.getenv('validation_ttl', 60 * 60))
+        self.timeout = timeout or float(os.getenv('validation_timeout', 20))
+        self.cache_path = cache_path or os.path.join(http_cache.get_cache_dir(), 'validation.json')
+        # replayed or refreshed runs probe everything again
+        self.use_cache = not http_cache.disabled and not http_cache.refresh
+        self.lock = threading.Lock()
+        self.semaphores = {}
+        self.cache = self.load_cache() if self.use_cache else {}
+        self.results = []
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+    def load_cache(self):
+        if not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+
+    def save_cache(self):
+        if not self.use_cache:
+            return
+        with self.lock:
+            now = time.time()
+            cache = {key: entry for key, entry in self.cache.items() if now - entry['checked'] < self.ttl}
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            tmp_path = f"{self.cache_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, self.cache_path)
+
+    def host_semaphore(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.per_host)
+            return self.semaphores[host]
+
+    @timed('validate_resource')
+    def probe(self, kind, method, url, params):
+        """
+        Send a probe and return (status, error).
+        """
+        session = get_session()
+        with self.host_semaphore(url):
+            try:
+                if kind == 'download':
+                    response = head_or_first_byte(url, timeout=self.timeout)
+                else:
+                    response = session.request(method, url, params=params, timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                return None, f"{type(e).__name__}: {e}"
+        return response.status_code, check_response(kind, response)
+
+    def check(self, resource, bbox=None):
+        """
+        Validate one resource.
+
+        Returns:
+        - dict with the resource name, format and url, the probe kind and
+          URL, the HTTP status, ok, the error, seconds and whether the
+          result came from the cache; None for a resource without a URL.
+        """
+        probe = build_probe(resource, bbox)
+        if probe is None:
+            return None
+        kind, method, url, params = probe
+        probe_url = requests.Request(method, url, params=params).prepare().url
+        key = f"{method} {probe_url}"
+        with self.lock:
+            entry = self.cache.get(key)
+        cached = entry is not None and time.time() - entry['checked'] < self.ttl
+        if not cached:
+            start = time.perf_counter()
+            status, error = self.probe(kind, method, url, params)
+            entry = {'status': status, 'error': error, 'seconds': time.perf_counter() - start,
+                     'checked': time.time()}
+            with self.lock:
+                self.cache[key] = entry
+        return {
+            'name': resource.get('name'),
+            'format': resource.get('format'),
+            'url': url,
+            'kind': kind,
+            'probe': key,
+            'status': entry['status'],
+            'ok': entry['error'] is None,
+            'error': entry['error'],
+            'seconds': entry['seconds'],
+            'cached': cached,
+        }
+
+    def validate_package(self, package_dict, action='report'):
+        """
+        Validate the resources of a package concurrently and apply action
+        to the broken ones, in place: 'report' leaves them, 'flag' marks
+        them with validation_status and validation_error, 'drop' removes them.
+
+        Returns:
+        - (package dict, list of results).
+        """
+        bbox = spatial_bbox(package_dict)
+        results = list(self.executor.map(lambda resource: self.check(resource, bbox),
+                                         package_dict.get('resources', [])))
+        return self.apply(package_dict, results, action), results
+
+    def validate_packages(self, packages, action='report'):
+        """
+        Validate every resource of many packages in one concurrent sweep.
+
+        Returns:
+        - list of validated package dicts.
+        """
+        packages = list(packages)
+        checks = [(resource, spatial_bbox(package_dict))
+                  for package_dict in packages for resource in package_dict.get('resources', [])]
+        results = iter(list(self.executor.map(lambda check: self.check(*check), checks)))
+        return [self.apply(package_dict, [next(results) for _ in package_dict.get('resources', [])], action)
+                for package_dict in packages]
+
+    def apply(self, package_dict, results, action):
+        for result in results:
+            if result is not None:
+                result['package'] = package_dict['name']
+        with self.lock:
+            self.results.extend(result for result in results if result is not None)
+
+        resources = package_dict.get('resources', [])
+        broken = [result is not None and not result['ok'] for result in results]
+        if action == 'drop':
+            package_dict['resources'] = [resource for resource, is_broken in zip(resources, broken) if not is_broken]
+        elif action == 'flag':
+            for resource, result, is_broken in zip(resources, results, broken):
+                if is_broken:
+                    resource['validation_status'] = 'broken'
+                    resource['validation_error'] = result['error']
+        return package_dict
+
+    def wrap(self, publish, action='flag'):
+        """
+        Wrap a publish callable so that each package is validated, and its
+        broken resources flagged or dropped, before it is published.
+        """
+        def validated_publish(package_dict):
+            package_dict, _ = self.validate_package(package_dict, action)
+            return publish(package_dict)
+        return validated_publish
+
+    def summary(self):
+        with self.lock:
+            results = list(self.results)
+        return {
+            'checked': len(results),
+            'ok': sum(1 for result in results if result['ok']),
+            'broken': sum(1 for result in results if not result['ok']),
+            'cached': sum(1 for result in results if result['cached']),
+            'by_kind': {kind: sum(1 for result in results if result['kind'] == kind)
+                        for kind in sorted({result['kind'] for result in results})},
+        }
+
+    def write_report(self, path=None):
+        """
+        Write the results to path (validation_report_path in .env,
+        /tmp/rrk_validation.json by default) and print the broken resources.
+        """
+        if path is None:
+            path = os.getenv('validation_report_path', '/tmp/rrk_validation.json')
+        summary = self.summary()
+        with self.lock:
+            results = sorted(self.results, key=lambda result: (result['package'], result['name'] or ''))
+        with open(path, 'w') as f:
+            json.dump({'summary': summary, 'results': results}, f, indent=1)
+        for result in results:
+            if not result['ok']:
+                print(f"broken {result['package']} {result['name']}: {result['error']}")
+        print(f"validated {summary['checked']} resources: {summary['ok']} ok, {summary['broken']} broken, "
+              f"{summary['cached']} from the cache; report in {path}")
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.save_cache()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def validate_export(path=None, report_path=None):
+    """
+    Validate the resources of the packages of an export, package_export_path
+    in .env by default, and write the report.
+
+    Returns:
+    - dict, the summary.
+    """
+    from package_export import iter_packages
+
+    with ResourceValidator() as validator:
+        validator.validate_packages(iter_packages(path))
+        validator.write_report(report_path)
+        return validator.summary()
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Validate the WMS, WCS, WFS, ArcGIS and download resources "
+                                                 "of exported packages")
+    parser.add_argument("--packages", default=None,
+                        help="package export (JSON Lines, .gz or .zst), package_export_path in .env by default")
+    parser.add_argument("--report", default=None, help="report file, validation_report_path in .env by default")
+    args = parser.parse_args()
+
+    try:
+        validate_export(args.packages, args.report)
+    except BaseException as e:
+        print(f"Error: {str(e)}")
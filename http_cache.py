@@ -0,0 +1,222 @@
+"""
+#
+# Disk-backed cache for the upstream metadata requests (RRK API and
+# GeoServer), revalidated with ETag / Last-Modified once it expires
+#
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import urlencode
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from http_client import get_session
+
+# set by --refresh: revalidate every cached response regardless of its age
+refresh = False
+
+# set when the responses come from a snapshot: bypass the cache entirely
+disabled = False
+
+_evict_lock = threading.Lock()
+
+
+def get_cache_dir():
+    cache_dir = os.getenv('http_cache_dir') or os.path.join(os.path.expanduser('~'), '.cache', 'clm_its_to_ckan')
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def cache_key(url, params=None):
+    if params:
+        url = f"{url}?{urlencode(sorted(params.items()))}"
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+def _read_meta(meta_path):
+    try:
+        with open(meta_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_meta(meta_path, meta):
+    tmp_path = f"{meta_path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+
+
+def _cached_response(meta, body_path, stream):
+    response = requests.Response()
+    response.status_code = meta['status']
+    response.url = meta['url']
+    response.headers = CaseInsensitiveDict(meta['headers'])
+    response.encoding = get_encoding_from_headers(response.headers)
+    if stream:
+        response.raw = open(body_path, 'rb')
+    else:
+        with open(body_path, 'rb') as f:
+            response._content = f.read()
+    return response
+
+
+def _live_get(url, params, stream):
+    """
+    GET without the cache. A streamed body is read through response.raw
+    like a cached one, so it must be decompressed there as well.
+    """
+    response = get_session().get(url, params=params, stream=stream)
+    if stream:
+        response.raw.decode_content = True
+    return response
+
+
+def _store(response, key, cache_dir):
+    """
+    Write the body of a 200 response to the cache while it is downloaded.
+    """
+    body_path = os.path.join(cache_dir, f"{key}.body")
+    tmp_path = f"{body_path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        for chunk in response.iter_content(chunk_size=1 << 16):
+            f.write(chunk)
+    os.replace(tmp_path, body_path)
+
+    headers = {name: response.headers[name] for name in ('Content-Type', 'ETag', 'Last-Modified')
+               if name in response.headers}
+    meta = {
+        'url': response.url,
+        'status': response.status_code,
+        'headers': headers,
+        'stored_at': time.time(),
+    }
+    _write_meta(os.path.join(cache_dir, f"{key}.json"), meta)
+    return meta
+
+
+def evict(cache_dir=None, max_bytes=None):
+    """
+    Remove the least recently used responses until the cache is smaller
+    than max_bytes (http_cache_max_bytes in .env, 512 MiB by default).
+    """
+    if cache_dir is None:
+        cache_dir = get_cache_dir()
+    if max_bytes is None:
+        max_bytes = int(os.getenv('http_cache_max_bytes', 512 * 2 ** 20))
+
+    with _evict_lock:
+        entries = []
+        total = 0
+        for entry in os.scandir(cache_dir):
+            if not entry.name.endswith('.json'):
+                continue
+            key = entry.name[:-len('.json')]
+            body_path = os.path.join(cache_dir, f"{key}.body")
+            try:
+                size = entry.stat().st_size + os.path.getsize(body_path)
+            except OSError:
+                continue
+            # the meta file is touched on every hit
+            entries.append((entry.stat().st_mtime, key, size))
+            total += size
+
+        for _, key, size in sorted(entries):
+            if total <= max_bytes:
+                break
+            for suffix in ('.json', '.body'):
+                try:
+                    os.remove(os.path.join(cache_dir, f"{key}{suffix}"))
+                except OSError:
+                    pass
+            total -= size
+
+
+def cached_get(url, params=None, ttl=None, stream=False):
+    """
+    GET a URL through the disk cache.
+
+    A cached 200 response younger than ttl is returned without a request.
+    An older one is revalidated with If-None-Match / If-Modified-Since and
+    reused on 304. If the server cannot be reached or answers with a 5xx,
+    the stale copy is used. Other statuses are returned as they are and not
+    cached.
+
+    Parameters:
+    - url: str
+    - params: dict, query parameters, part of the cache key.
+    - ttl: float, seconds a response stays fresh (http_cache_ttl in .env,
+      one day by default).
+    - stream: bool, when True the returned response reads its body from the
+      cache file through response.raw.
+
+    Returns:
+    - requests.Response
+    """
+    if disabled:
+        return _live_get(url, params, stream)
+    if ttl is None:
+        ttl = float(os.getenv('http_cache_ttl', 24 * 60 * 60))
+    cache_dir = get_cache_dir()
+    key = cache_key(url, params)
+    meta_path = os.path.join(cache_dir, f"{key}.json")
+    body_path = os.path.join(cache_dir, f"{key}.body")
+
+    meta = _read_meta(meta_path)
+    if meta is not None and not os.path.exists(body_path):
+        meta = None
+
+    force = refresh or os.getenv('http_cache_refresh', '').lower() in ('1', 'true', 'yes')
+    if meta is not None and not force and time.time() - meta['stored_at'] < ttl:
+        try:
+            os.utime(meta_path)
+            return _cached_response(meta, body_path, stream)
+        except OSError:
+            # evicted in the meantime
+            meta = None
+
+    headers = {}
+    if meta is not None:
+        if 'ETag' in meta['headers']:
+            headers['If-None-Match'] = meta['headers']['ETag']
+        if 'Last-Modified' in meta['headers']:
+            headers['If-Modified-Since'] = meta['headers']['Last-Modified']
+
+    try:
+        response = get_session().get(url, params=params, headers=headers, stream=True)
+    except requests.exceptions.RequestException as e:
+        if meta is None:
+            raise
+        print(f"Using the cached response of {url}: {e}")
+        return _cached_response(meta, body_path, stream)
+
+    if response.status_code == 304 and meta is not None:
+        response.close()
+        meta['stored_at'] = time.time()
+        _write_meta(meta_path, meta)
+        return _cached_response(meta, body_path, stream)
+
+    if response.status_code >= 500 and meta is not None:
+        response.close()
+        print(f"Using the cached response of {url}: HTTP {response.status_code}")
+        return _cached_response(meta, body_path, stream)
+
+    if response.status_code != 200:
+        if not stream:
+            # read the body so the connection goes back to the pool
+            response.content
+        return response
+
+    meta = _store(response, key, cache_dir)
+    evict(cache_dir)
+    if not os.path.exists(body_path):
+        # evicted right away, the cache is smaller than the response
+        return _live_get(url, params, stream)
+    return _cached_response(meta, body_path, stream)
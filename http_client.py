@@ -0,0 +1,223 @@
+"""
+#
+# Shared HTTP session for all CKAN, RRK API and GeoServer calls
+#
+"""
+
+import json
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from rate_control import RateController
+
+_session = None
+_session_lock = threading.Lock()
+_controller = None
+
+# POSTed actions that leave the same state when applied twice
+IDEMPOTENT_ACTIONS = ('package_patch', 'package_delete')
+
+
+class PooledSession(requests.Session):
+    """
+    A requests session that applies a default timeout to every request and
+    counts the requests and response bytes per host.
+    """
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        try:
+            response = super().request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            metrics.record_request(url, None, 0)
+            raise
+        if kwargs.get('stream'):
+            # the body is read later, count what the server announced
+            size = int(response.headers.get('Content-Length') or 0)
+        else:
+            size = len(response.content)
+        metrics.record_request(url, response.status_code, size)
+        return response
+
+
+def create_session(pool_connections=None, pool_maxsize=None, timeout=None):
+    """
+    Create a session with keep-alive connection pools.
+
+    Parameters:
+    - pool_connections: int, number of hosts to keep a connection pool for
+      (http_pool_connections in .env, 10 by default).
+    - pool_maxsize: int, connections kept alive per host
+      (http_pool_maxsize in .env, 32 by default).
+    - timeout: float, seconds to wait for a server to connect or respond
+      (http_timeout in .env, 60 by default).
+
+    Returns:
+    - PooledSession
+    """
+    if pool_connections is None:
+        pool_connections = int(os.getenv('http_pool_connections', 10))
+    if pool_maxsize is None:
+        pool_maxsize = int(os.getenv('http_pool_maxsize', 32))
+    if timeout is None:
+        timeout = float(os.getenv('http_timeout', 60))
+
+    session = PooledSession(timeout)
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({
+        'Accept-Encoding': 'gzip, deflate',
+        'Connection': 'keep-alive',
+    })
+    return session
+
+
+def get_session():
+    """
+    Return the process-wide session, creating it on first use.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = create_session()
+        return _session
+
+
+def head_or_first_byte(url, headers=None, timeout=None, need_length=False):
+    """
+    HEAD a URL, or GET its first byte when the server refuses HEAD
+    (403, 405 or 501). The total size of the body is then at the end of
+    the Content-Range header.
+
+    Parameters:
+    - url: str
+    - headers: dict, extra request headers, such as If-None-Match.
+    - timeout: float, seconds, the session timeout by default.
+    - need_length: bool, also GET the first byte when the HEAD response has
+      no Content-Length.
+
+    Returns:
+    - requests.Response, without a body.
+    """
+    kwargs = {'timeout': timeout} if timeout is not None else {}
+    session = get_session()
+    response = session.head(url, headers=headers, allow_redirects=True, **kwargs)
+    refused = response.status_code in (403, 405, 501)
+    if refused or (need_length and response.status_code == 200 and 'Content-Length' not in response.headers):
+        response = session.get(url, headers=dict(headers or {}, Range='bytes=0-0'), stream=True, **kwargs)
+        response.close()
+    return response
+
+
+def get_rate_controller():
+    """
+    Return the process-wide rate controller of the CKAN action calls.
+    """
+    global _controller
+    with _session_lock:
+        if _controller is None:
+            _controller = RateController()
+        return _controller
+
+
+def ckan_headers():
+    return {
+        'X-CKAN-API-Key': os.getenv('api_key'),
+        'Content-Type': 'application/json'
+    }
+
+
+def ckan_action(action, payload=None, params=None):
+    """
+    Call a CKAN action API endpoint.
+
+    Actions with params are sent as GET requests, everything else is POSTed
+    with the payload encoded as JSON. Calls go through the rate controller,
+    which retries 429 and 5xx responses. A POST that may have been applied,
+    because it timed out while waiting for the response or a proxy answered
+    502 or 504, is only sent again when applying it twice is harmless; a
+    package_create is first looked up with package_show.
+
+    Parameters:
+    - action: str, name of the action, e.g. package_create.
+    - payload: dict, body of a POST request.
+    - params: dict, query parameters of a GET request.
+
+    Returns:
+    - requests.Response
+    """
+    api_url = f"{os.getenv('ckan_url')}/api/3/action/{action}"
+    if params is not None:
+        return get_rate_controller().call(
+            lambda: get_session().get(api_url, headers=ckan_headers(), params=params))
+    data = json.dumps(payload) if payload is not None else None
+    applied = None
+    if action == 'package_create' and payload and payload.get('name'):
+        applied = lambda: find_created_package(payload['name'])
+    return get_rate_controller().call(
+        lambda: get_session().post(api_url, data=data, headers=ckan_headers()),
+        idempotent=action in IDEMPOTENT_ACTIONS, applied=applied)
+
+
+def find_created_package(name):
+    """
+    The package_show response of a package_create whose response was lost,
+    or None when the package does not exist and the create must be resent.
+    """
+    response = ckan_action('package_show', params={'id': name})
+    if response.status_code == 200:
+        return response
+    if response.status_code == 404:
+        return None
+    raise BaseException(f"Could not tell whether {name} was created: {response.text}")
+
+
+def search_packages(prefixes=('clm-', 'its-'), org=None, rows=1000, fields=None):
+    """
+    Page through package_search for the packages whose name starts with
+    one of prefixes.
+
+    Parameters:
+    - prefixes: tuple of str, package name prefixes.
+    - org: str, name of the organization owning the packages, or None for all.
+    - rows: int, page size.
+    - fields: str, comma separated fields to return, e.g. "id,name", or None
+      for the full packages.
+
+    Yields:
+    - dict, one package.
+    """
+    params = {
+        'q': " OR ".join(f"name:{prefix}*" for prefix in prefixes),
+        'rows': rows,
+        'include_private': True,
+        'sort': 'name asc',
+    }
+    if org:
+        params['fq'] = f"organization:{org}"
+    if fields:
+        params['fl'] = fields
+
+    start = 0
+    while True:
+        params['start'] = start
+        response = ckan_action('package_search', params=params)
+        if response.status_code != 200:
+            raise BaseException(f"Error searching datasets: {response.text}")
+        results = response.json()['result']['results']
+        for package in results:
+            # the search is by prefix already, this guards against loose matches
+            if package['name'].startswith(tuple(prefixes)):
+                yield package
+        start += len(results)
+        if not results or start >= response.json()['result']['count']:
+            break
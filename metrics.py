@@ -0,0 +1,192 @@
+"""
+#
+# Per-stage timings and per-host HTTP counters of a run, written at the end
+# as a Prometheus textfile and a JSON summary
+#
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlparse
+
+PREFIX = 'clm_its_to_ckan'
+
+_lock = threading.Lock()
+_stages = defaultdict(list)
+_hosts = defaultdict(lambda: {'requests': 0, 'bytes': 0, 'retries': 0, 'errors': 0, 'statuses': defaultdict(int)})
+_started = time.time()
+
+# called with (stage, start, end) after every timed call while profiling
+listener = None
+
+
+def timed(stage):
+    """
+    Decorator recording the duration of every call of a function under
+    stage. Durations include the stages called from it.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                end = time.perf_counter()
+                record_stage(stage, end - start)
+                if listener is not None:
+                    listener(stage, start, end)
+        return wrapper
+    return decorator
+
+
+def record_stage(stage, seconds):
+    with _lock:
+        _stages[stage].append(seconds)
+
+
+def host_of(url):
+    return urlparse(url).hostname or 'unknown'
+
+
+def record_request(url, status, size):
+    """
+    Count a request sent over the network.
+
+    Parameters:
+    - url: str
+    - status: int, HTTP status, or None when no response was received.
+    - size: int, bytes of the response body.
+    """
+    with _lock:
+        host = _hosts[host_of(url)]
+        host['requests'] += 1
+        host['bytes'] += size
+        if status is None or status >= 400:
+            host['errors'] += 1
+        host['statuses'][str(status)] += 1
+
+
+def record_retry(url):
+    with _lock:
+        _hosts[host_of(url)]['retries'] += 1
+
+
+def reset():
+    global _started
+    with _lock:
+        _stages.clear()
+        _hosts.clear()
+        _started = time.time()
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summary(success=None):
+    """
+    Returns:
+    - dict with the run duration and outcome, per stage the count, total,
+      p50, p90, p99 and max seconds, and per host the requests, bytes,
+      retries, errors and status counts.
+    """
+    with _lock:
+        stages = {}
+        for stage, durations in _stages.items():
+            ordered = sorted(durations)
+            stages[stage] = {
+                'count': len(ordered),
+                'sum': sum(ordered),
+                'p50': _percentile(ordered, 0.50),
+                'p90': _percentile(ordered, 0.90),
+                'p99': _percentile(ordered, 0.99),
+                'max': ordered[-1],
+            }
+        hosts = {name: dict(values, statuses=dict(values['statuses'])) for name, values in _hosts.items()}
+        return {
+            'started': _started,
+            'duration': time.time() - _started,
+            'success': success,
+            'stages': stages,
+            'hosts': hosts,
+        }
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(run_summary):
+    lines = [
+        f"# HELP {PREFIX}_stage_duration_seconds Duration of the calls of each stage.",
+        f"# TYPE {PREFIX}_stage_duration_seconds summary",
+    ]
+    for stage, values in sorted(run_summary['stages'].items()):
+        label = f'stage="{_label(stage)}"'
+        for quantile in ('p50', 'p90', 'p99'):
+            lines.append(f'{PREFIX}_stage_duration_seconds{{{label},quantile="0.{quantile[1:]}"}} {values[quantile]}')
+        lines.append(f"{PREFIX}_stage_duration_seconds_sum{{{label}}} {values['sum']}")
+        lines.append(f"{PREFIX}_stage_duration_seconds_count{{{label}}} {values['count']}")
+
+    counters = [
+        ('http_requests_total', 'Requests sent to each host, by status.'),
+        ('http_response_bytes_total', 'Response body bytes received from each host.'),
+        ('http_retries_total', 'Requests retried after a throttled or failed response.'),
+    ]
+    for name, help_text in counters:
+        lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+        lines.append(f"# TYPE {PREFIX}_{name} counter")
+        for host, values in sorted(run_summary['hosts'].items()):
+            label = f'host="{_label(host)}"'
+            if name == 'http_requests_total':
+                for status, count in sorted(values['statuses'].items()):
+                    lines.append(f'{PREFIX}_{name}{{{label},status="{status}"}} {count}')
+            elif name == 'http_response_bytes_total':
+                lines.append(f"{PREFIX}_{name}{{{label}}} {values['bytes']}")
+            else:
+                lines.append(f"{PREFIX}_{name}{{{label}}} {values['retries']}")
+
+    lines += [
+        f"# HELP {PREFIX}_run_duration_seconds Duration of the last run.",
+        f"# TYPE {PREFIX}_run_duration_seconds gauge",
+        f"{PREFIX}_run_duration_seconds {run_summary['duration']}",
+        f"# HELP {PREFIX}_run_success Whether the last run finished without errors.",
+        f"# TYPE {PREFIX}_run_success gauge",
+        f"{PREFIX}_run_success {1 if run_summary['success'] else 0}",
+        f"# HELP {PREFIX}_run_timestamp_seconds Time the last run finished.",
+        f"# TYPE {PREFIX}_run_timestamp_seconds gauge",
+        f"{PREFIX}_run_timestamp_seconds {run_summary['started'] + run_summary['duration']}",
+    ]
+    return '\n'.join(lines) + '\n'
+
+
+def _write_atomic(path, text):
+    # the textfile collector must never read a half written file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def write_reports(success, textfile=None, json_path=None):
+    """
+    Write the metrics of the run as a Prometheus textfile and a JSON summary.
+
+    Parameters:
+    - success: bool, whether the run finished without errors.
+    - textfile: str, metrics_textfile in .env, /tmp/clm_its_to_ckan.prom by default.
+    - json_path: str, metrics_json in .env, /tmp/clm_its_to_ckan_metrics.json by default.
+    """
+    if textfile is None:
+        textfile = os.getenv('metrics_textfile', f"/tmp/{PREFIX}.prom")
+    if json_path is None:
+        json_path = os.getenv('metrics_json', f"/tmp/{PREFIX}_metrics.json")
+    run_summary = summary(success)
+    _write_atomic(textfile, prometheus_text(run_summary))
+    _write_atomic(json_path, json.dumps(run_summary, indent=4))
+    return run_summary
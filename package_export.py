@@ -0,0 +1,151 @@
+"""
+#
+# Stream the generated CKAN packages to a JSON Lines file, one compact
+# line per package, optionally gzip or zstd compressed
+#
+"""
+
+import gzip
+import io
+import json
+import os
+import threading
+
+
+def _compression(path, compression):
+    if compression is not None:
+        return compression or None
+    if path.endswith('.gz'):
+        return 'gzip'
+    if path.endswith('.zst'):
+        return 'zstd'
+    return None
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise BaseException("zstd compression requires the zstandard package: pip install zstandard")
+    return zstandard
+
+
+def _open_write(path, compression):
+    if compression == 'gzip':
+        return gzip.open(path, 'wt', encoding='utf-8')
+    if compression == 'zstd':
+        writer = _zstandard().ZstdCompressor().stream_writer(open(path, 'wb'))
+        return io.TextIOWrapper(writer, encoding='utf-8', write_through=True)
+    return open(path, 'w', encoding='utf-8')
+
+
+def _open_read(path, compression):
+    if compression == 'gzip':
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if compression == 'zstd':
+        reader = _zstandard().ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True)
+        return io.TextIOWrapper(reader, encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+
+def with_outcome(package_dict, outcome=None, error=None):
+    """
+    The export record of a package: a copy carrying publish_outcome,
+    'created', 'patched', 'unchanged', 'skipped' or 'failed', and the
+    publish_error of a package that failed to publish.
+    """
+    if error is not None:
+        return dict(package_dict, publish_outcome='failed', publish_error=str(error))
+    return dict(package_dict, publish_outcome=outcome or 'created')
+
+
+class PackageExporter:
+    """
+    Writes packages as they are produced. Every package is flushed once
+    written, so the file holds all the packages finished before a run is
+    interrupted. Packages handed over out of order with put() are held in a
+    reorder buffer and written in dataset order.
+    """
+
+    def __init__(self, path=None, compression=None):
+        """
+        Parameters:
+        - path: str, package_export_path in .env, /tmp/rrk.jsonl by default.
+        - compression: 'gzip', 'zstd' or '' for none; by default taken from
+          the extension of path (.gz, .zst).
+        """
+        if path is None:
+            path = os.getenv('package_export_path', '/tmp/rrk.jsonl')
+        self.path = path
+        self.compression = _compression(path, compression)
+        self.file = _open_write(path, self.compression)
+        self.lock = threading.Lock()
+        self.count = 0
+        self.pending = {}
+        self.next_index = 0
+
+    def _write(self, package_dict):
+        self.file.write(json.dumps(package_dict, separators=(',', ':')) + '\n')
+        self.file.flush()
+        self.count += 1
+
+    def write(self, package_dict):
+        with self.lock:
+            self._write(package_dict)
+
+    def put(self, index, package_dict):
+        """
+        Hand over the package of dataset number index, or None if the
+        dataset failed. Packages are written once all earlier indexes have
+        been handed over.
+        """
+        with self.lock:
+            self.pending[index] = package_dict
+            while self.next_index in self.pending:
+                package_dict = self.pending.pop(self.next_index)
+                if package_dict is not None:
+                    self._write(package_dict)
+                self.next_index += 1
+
+    def close(self):
+        with self.lock:
+            # packages still waiting for a dataset that never finished
+            for index in sorted(self.pending):
+                if self.pending[index] is not None:
+                    self._write(self.pending[index])
+            self.pending.clear()
+            if not self.file.closed:
+                self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def iter_packages(path=None, compression=None):
+    """
+    Read the packages of an export lazily.
+
+    A run that was interrupted can leave the last line, or the end of the
+    compressed stream, incomplete; reading stops there.
+
+    Parameters:
+    - path: str, package_export_path in .env, /tmp/rrk.jsonl by default.
+    - compression: as for PackageExporter.
+
+    Yields:
+    - dict, one package.
+    """
+    if path is None:
+        path = os.getenv('package_export_path', '/tmp/rrk.jsonl')
+    with _open_read(path, _compression(path, compression)) as f:
+        try:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    return
+        except EOFError:
+            return
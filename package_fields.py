@@ -0,0 +1,46 @@
+"""
+#
+# Helpers on CKAN package dicts shared by the CLM and ITS scripts, the sync
+# and the run journal. Standard library only, so that importing them does
+# not load the CLM and GeoServer code paths.
+#
+"""
+
+import hashlib
+import json
+import re
+import unicodedata
+
+HASH_KEY = "content_hash"
+
+
+def slugify(title):
+    # Normalize unicode characters
+    name = unicodedata.normalize('NFKD', title).encode('ascii', 'ignore').decode('ascii')
+
+    # Convert to lowercase and replace spaces with hyphens
+    name = re.sub(r'[^\w\s-]', '', name.lower())
+    name = re.sub(r'[-\s]+', '-', name).strip('-')
+
+    # Ensure it starts with a letter
+    name = re.sub(r'^[^a-zA-Z]+', '', name)
+
+    # Truncate to 100 characters
+    return name[:96]
+
+
+def get_extra(package_dict, key):
+    for extra in package_dict.get('extras', []):
+        if extra['key'] == key:
+            return extra['value']
+    return None
+
+
+def package_hash(package_dict):
+    """
+    Stable SHA-256 of a package dict, ignoring its content_hash extra.
+    """
+    package = dict(package_dict)
+    package['extras'] = [extra for extra in package.get('extras', []) if extra['key'] != HASH_KEY]
+    content = json.dumps(package, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
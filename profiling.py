@@ -0,0 +1,223 @@
+"""
+#
+# Opt-in profiling of a run (--profile DIR): CPU profile, stage timeline,
+# tracemalloc snapshots per stage and the slowest datasets
+#
+"""
+
+import json
+import os
+import re
+import sys
+import threading
+import time
+from functools import partial
+
+import metrics
+
+# the running Profiler, None when profiling is off
+active = None
+
+
+class Profiler:
+    """
+    Profiles a run and writes to directory:
+    - cpu.pstats: cProfile statistics of every thread, for pstats or snakeviz.
+    - stages.speedscope.json: timeline of the timed stages per thread, for
+      https://www.speedscope.app.
+    - memory-NN-<stage>.snapshot: tracemalloc snapshot taken when a stage
+      first completes and at the end, for tracemalloc.Snapshot.load, and
+      memory.txt with the allocations that grew between snapshots.
+    - slowest_datasets.txt: the `top` datasets that took the longest.
+    """
+
+    def __init__(self, directory, top=20):
+        self.directory = directory
+        self.top = top
+        self.lock = threading.Lock()
+        self.profiles = []
+        self.spans = []
+        self.snapshots = []
+        self.snapshot_stages = set()
+        self.dataset_times = {}
+        self.started = None
+
+    # cProfile, pstats and tracemalloc are imported once profiling starts:
+    # every run imports this module for track(), few of them profile
+    def start(self):
+        import cProfile
+        import tracemalloc
+
+        os.makedirs(self.directory, exist_ok=True)
+        tracemalloc.start()
+        self.started = time.perf_counter()
+        metrics.listener = self.on_span
+        profile = cProfile.Profile()
+        self.profiles.append(profile)
+        if sys.version_info < (3, 12):
+            # cProfile only sees the thread that enabled it before 3.12
+            threading.setprofile(self._profile_thread)
+        profile.enable()
+
+    def _profile_thread(self, frame, event, arg):
+        import cProfile
+
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def on_span(self, stage, start, end):
+        thread = threading.current_thread()
+        with self.lock:
+            self.spans.append((thread.ident, thread.name, stage, start, end))
+            take_snapshot = stage not in self.snapshot_stages
+            self.snapshot_stages.add(stage)
+        if take_snapshot:
+            self._snapshot(stage)
+
+    def _snapshot(self, label):
+        import tracemalloc
+
+        snapshot = tracemalloc.take_snapshot()
+        with self.lock:
+            self.snapshots.append((label, snapshot))
+
+    def call(self, key, func, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.dataset_times[key] = self.dataset_times.get(key, 0.0) + elapsed
+
+    def stop(self):
+        import tracemalloc
+
+        for profile in self.profiles:
+            profile.disable()
+        threading.setprofile(None)
+        metrics.listener = None
+        self._snapshot('end')
+        tracemalloc.stop()
+
+        self.write_cpu_profile(os.path.join(self.directory, 'cpu.pstats'))
+        self.write_speedscope(os.path.join(self.directory, 'stages.speedscope.json'))
+        self.write_memory(self.directory)
+        self.write_slowest_datasets(os.path.join(self.directory, 'slowest_datasets.txt'))
+        print(f"profile written to {self.directory}")
+
+    def write_cpu_profile(self, path):
+        import pstats
+
+        stats = pstats.Stats(self.profiles[0])
+        for profile in self.profiles[1:]:
+            try:
+                stats.add(profile)
+            except TypeError:
+                # a thread that never ran any Python code
+                pass
+        stats.dump_stats(path)
+
+    def write_speedscope(self, path):
+        """
+        One evented profile per thread, with a frame per stage. Stages of
+        a thread are nested calls, so they open and close in stack order.
+        """
+        frames = {}
+        threads = {}
+        for ident, name, stage, start, end in self.spans:
+            frames.setdefault(stage, len(frames))
+            threads.setdefault((ident, name), []).append((start - self.started, end - self.started, stage))
+
+        profiles = []
+        for (ident, name), spans in threads.items():
+            events = []
+            stack = []
+            # outer spans first when they start together
+            for start, end, stage in sorted(spans, key=lambda span: (span[0], -span[1])):
+                while stack and stack[-1][0] <= start:
+                    closed_end, closed_stage = stack.pop()
+                    events.append({'type': 'C', 'frame': frames[closed_stage], 'at': closed_end})
+                events.append({'type': 'O', 'frame': frames[stage], 'at': start})
+                stack.append((end, stage))
+            while stack:
+                closed_end, closed_stage = stack.pop()
+                events.append({'type': 'C', 'frame': frames[closed_stage], 'at': closed_end})
+            profiles.append({
+                'type': 'evented',
+                'name': f"{name} ({ident})",
+                'unit': 'seconds',
+                'startValue': events[0]['at'],
+                'endValue': events[-1]['at'],
+                'events': events,
+            })
+
+        with open(path, 'w') as f:
+            json.dump({
+                '$schema': 'https://www.speedscope.app/file-format-schema.json',
+                'name': 'clm_its_to_ckan stages',
+                'exporter': 'profiling.py',
+                'shared': {'frames': [{'name': stage} for stage in frames]},
+                'profiles': profiles,
+            }, f)
+
+    def write_memory(self, directory, limit=10):
+        # the snapshots of a previous profile in the same directory
+        for name in os.listdir(directory):
+            if re.match(r'memory-\d+-.*\.snapshot$', name):
+                os.remove(os.path.join(directory, name))
+        previous = None
+        with open(os.path.join(directory, 'memory.txt'), 'w') as report:
+            for number, (label, snapshot) in enumerate(self.snapshots):
+                file_label = re.sub(r'[^\w.-]', '_', label)
+                snapshot.dump(os.path.join(directory, f"memory-{number:02d}-{file_label}.snapshot"))
+                total = sum(stat.size for stat in snapshot.statistics('filename'))
+                report.write(f"{number:02d} after {label}: {total / 2 ** 20:.1f} MiB traced\n")
+                if previous is None:
+                    stats = snapshot.statistics('lineno')[:limit]
+                else:
+                    stats = snapshot.compare_to(previous, 'lineno')[:limit]
+                for stat in stats:
+                    report.write(f"    {stat}\n")
+                previous = snapshot
+
+    def write_slowest_datasets(self, path):
+        slowest = sorted(self.dataset_times.items(), key=lambda item: item[1], reverse=True)[:self.top]
+        with open(path, 'w') as f:
+            for key, seconds in slowest:
+                f.write(f"{seconds:10.3f} s  {key}\n")
+
+
+def start(directory, top=None):
+    """
+    Start profiling the run into directory.
+
+    Parameters:
+    - directory: str, created if needed.
+    - top: int, number of slowest datasets listed (profile_top in .env, 20 by default).
+    """
+    global active
+    if top is None:
+        top = int(os.getenv('profile_top', 20))
+    active = Profiler(directory, top)
+    active.start()
+    return active
+
+
+def stop():
+    global active
+    if active is not None:
+        profiler, active = active, None
+        profiler.stop()
+
+
+def track(key, func):
+    """
+    Return func, timed under key in the slowest datasets when profiling.
+    """
+    if active is None:
+        return func
+    return partial(active.call, key, func)
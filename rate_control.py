@@ -0,0 +1,206 @@
+"""
+#
+# Adaptive concurrency, retries with backoff and an optional rate ceiling
+# for the CKAN action API
+#
+"""
+
+import os
+import random
+import threading
+import time
+
+import requests
+from urllib3.exceptions import NewConnectionError
+
+import metrics
+
+# statuses worth retrying: CKAN or its proxy is overloaded or restarting
+RETRY_STATUSES = (429, 502, 503, 504)
+# statuses sent before the action runs, so that even a non-idempotent call
+# can be resent; a 502 or 504 from a proxy may come after CKAN applied it
+REJECTED_STATUSES = (429, 503)
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit: every `window` successful calls faster than
+    latency_target raise the limit by one, and a throttled or failed call,
+    or one slower than latency_target, halves it. Calls started before the
+    last decrease saw the same congestion and do not halve it again.
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=32, latency_target=5.0, window=10):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.window = window
+        self.in_flight = 0
+        self.successes = 0
+        self.decreased_at = float('-inf')
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Wait for a slot. Returns the start time of the call, for release.
+        """
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+            return time.monotonic()
+
+    def release(self, start, overloaded):
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if overloaded or now - start > self.latency_target:
+                if start >= self.decreased_at:
+                    self.limit = max(self.minimum, self.limit // 2)
+                    self.decreased_at = now
+                self.successes = 0
+            else:
+                self.successes += 1
+                if self.successes >= self.window:
+                    self.limit = min(self.maximum, self.limit + 1)
+                    self.successes = 0
+            self.condition.notify_all()
+
+
+class RateCeiling:
+    """
+    Token bucket allowing at most `rate` calls per second.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0):
+    """
+    Full-jitter exponential backoff: a random delay between 0 and
+    min(cap, base * 2 ** attempt) seconds.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def retry_after(response):
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+class RateController:
+    """
+    Sits in front of the CKAN action calls: limits concurrency adaptively,
+    optionally caps the request rate, and retries throttled or failed calls
+    with jittered exponential backoff.
+
+    Configured from .env: ckan_max_concurrency (32), ckan_initial_concurrency
+    (4), ckan_latency_target in seconds (5), ckan_max_rps (no ceiling) and
+    ckan_max_retries (5).
+    """
+
+    def __init__(self):
+        self.limiter = AdaptiveLimiter(
+            initial=int(os.getenv('ckan_initial_concurrency', 4)),
+            maximum=int(os.getenv('ckan_max_concurrency', 32)),
+            latency_target=float(os.getenv('ckan_latency_target', 5.0)),
+        )
+        max_rps = os.getenv('ckan_max_rps')
+        self.ceiling = RateCeiling(float(max_rps)) if max_rps else None
+        self.max_retries = int(os.getenv('ckan_max_retries', 5))
+
+    def call(self, send, idempotent=True, applied=None):
+        """
+        Send a request through the controller.
+
+        Parameters:
+        - send: callable returning a requests.Response.
+        - idempotent: bool, whether a request that may have reached the server
+          (read timeout, dropped connection, 502 or 504) can be sent again.
+          A refused connection, a connect timeout, 429 and 503 are always
+          retried.
+        - applied: callable, for a non-idempotent request that may have
+          reached the server: returns the response to use when the request
+          was applied, or None to send it again. Without it such a request
+          is not sent again.
+
+        Returns:
+        - requests.Response, the last one received.
+        """
+        attempt = 0
+        while True:
+            if self.ceiling is not None:
+                self.ceiling.wait()
+            start = self.limiter.acquire()
+            response = None
+            error = None
+            try:
+                response = send()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self.limiter.release(start, overloaded=True)
+                if attempt >= self.max_retries:
+                    raise
+                if not idempotent and not is_unsent(e):
+                    if applied is None:
+                        raise
+                    outcome = applied()
+                    if outcome is not None:
+                        return outcome
+                error = e
+                delay = backoff_delay(attempt)
+            else:
+                overloaded = response.status_code in RETRY_STATUSES
+                self.limiter.release(start, overloaded)
+                if not overloaded or attempt >= self.max_retries:
+                    return response
+                if not idempotent and response.status_code not in REJECTED_STATUSES:
+                    outcome = applied() if applied is not None else response
+                    if outcome is not None:
+                        return outcome
+                delay = retry_after(response) or backoff_delay(attempt)
+
+            attempt += 1
+            on_retry(attempt, response, error)
+            time.sleep(delay)
+
+
+def is_unsent(error):
+    """
+    Whether a request failed before it was sent: a connect timeout, or a
+    connection that was refused or could not be resolved. Any other
+    connection error, such as a connection aborted or reset while waiting
+    for the response, may come after the server applied the request.
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    # requests wraps the urllib3 MaxRetryError, whose reason is the actual error
+    return isinstance(getattr(reason, 'reason', reason), NewConnectionError)
+
+
+def on_retry(attempt, response, error):
+    if response is not None:
+        metrics.record_retry(response.url)
+        status = response.status_code
+    else:
+        if error.request is not None:
+            metrics.record_retry(error.request.url)
+        status = 'connection error'
+    print(f"retrying CKAN request ({status}), attempt {attempt}")
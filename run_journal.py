@@ -0,0 +1,122 @@
+"""
+#
+# Append-only journal of a publish run, used to resume an interrupted run
+#
+"""
+
+import json
+import os
+import threading
+import time
+
+from package_fields import package_hash
+
+# outcomes confirming that CKAN holds the package
+DONE_OUTCOMES = ('created', 'patched', 'unchanged')
+
+
+class RunJournal:
+    """
+    Records the slug, content hash and outcome of every published package
+    as one JSON line. Lines are flushed as they are written; fsync is
+    batched every sync_every records or sync_interval seconds.
+    """
+
+    def __init__(self, path=None, resume=False, sync_every=50, sync_interval=1.0):
+        """
+        Parameters:
+        - path: str, run_journal_path in .env, /tmp/rrk_journal.jsonl by default.
+        - resume: bool, keep the previous journal and skip the packages it
+          confirms; otherwise the journal starts empty.
+        """
+        if path is None:
+            path = os.getenv('run_journal_path', '/tmp/rrk_journal.jsonl')
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.done = {}
+        if resume:
+            self.done = self.load(path)
+        self.file = open(path, 'a' if resume else 'w')
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.last_sync = time.monotonic()
+
+    @staticmethod
+    def load(path):
+        """
+        Returns:
+        - dict, slug -> content hash of the packages confirmed in the journal.
+        """
+        done = {}
+        if not os.path.exists(path):
+            return done
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a line cut short by the interruption
+                    continue
+                if record['outcome'] in DONE_OUTCOMES:
+                    done[record['slug']] = record['hash']
+                else:
+                    done.pop(record['slug'], None)
+        return done
+
+    def is_done(self, slug, content_hash):
+        return self.done.get(slug) == content_hash
+
+    def record(self, slug, content_hash, outcome, error=None):
+        record = {
+            'slug': slug,
+            'hash': content_hash,
+            'outcome': outcome,
+            'time': time.time(),
+        }
+        if error is not None:
+            record['error'] = str(error)
+        with self.lock:
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+            self.pending += 1
+            if self.pending >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval:
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self.file.fileno())
+        self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def wrap(self, publish, on_skip=None):
+        """
+        Wrap a publish callable so that packages confirmed by the journal
+        with the same content hash are skipped, and every outcome is recorded.
+
+        Parameters:
+        - publish: callable, sends a package dict to CKAN.
+        - on_skip: callable, called with the package dict of a skipped package.
+        """
+        def journaled_publish(package_dict):
+            slug = package_dict['name']
+            content_hash = package_hash(package_dict)
+            if self.is_done(slug, content_hash):
+                print(f"skipping {package_dict['title']}, already published")
+                if on_skip is not None:
+                    on_skip(package_dict)
+                return 'skipped'
+            try:
+                outcome = publish(package_dict) or 'created'
+            except BaseException as e:
+                self.record(slug, content_hash, 'failed', e)
+                raise
+            self.record(slug, content_hash, outcome)
+            return outcome
+        return journaled_publish
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.flush()
+                self._sync()
+                self.file.close()
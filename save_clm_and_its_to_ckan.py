@@ -1,14 +1,119 @@
+import argparse
 import os
 from dotenv import load_dotenv
-from save_clm_to_ckan import save_clm_to_ckan
+import metrics
+import profiling
+from catalog import PackageCatalog
+from ckan_publish import publish_dataset
+from run_journal import RunJournal
 from save_its_to_ckan import save_its_to_ckan
 
 load_dotenv()
 
+
+def publish_clm_and_its(targets=('its', 'clm'), sync=False, delete_orphans=False, use_async=False, resume=False,
+                        workers=None, validate=None):
+    """
+    Register the ITS and CLM packages in CKAN, recording each one in the run
+    journal and adding the published ones to the local catalog.
+
+    Parameters:
+    - targets: the packages to publish, 'its' and/or 'clm'.
+    - sync: bool, create new packages, patch changed ones and skip unchanged
+      ones instead of creating every package.
+    - delete_orphans: bool, with sync, delete the clm-/its- packages that are
+      no longer generated; requires both targets.
+    - use_async: bool, run the CLM ingest on the asyncio pipeline.
+    - resume: bool, skip the packages the run journal confirms as published
+      with the same content.
+    - workers: int, number of CLM packages published in parallel by the
+      threaded ingest.
+    - validate: None, or what to do with the resources that fail their
+      endpoint check before publishing: 'report', 'flag' or 'drop'.
+    """
+    if delete_orphans and set(targets) != {'its', 'clm'}:
+        raise BaseException("deleting orphans requires publishing both the ITS and CLM packages")
+    publishers = {'its': save_its_to_ckan}
+    # the CLM ingest loads the GeoServer and RRK code, only when it is needed
+    if 'clm' in targets and use_async:
+        from clm_pipeline import save_clm_to_ckan_async
+
+        publishers['clm'] = save_clm_to_ckan_async
+    elif 'clm' in targets:
+        from save_clm_to_ckan import save_clm_to_ckan
+
+        publishers['clm'] = lambda publish: save_clm_to_ckan(workers=workers, publish=publish)
+
+    journal = RunJournal(resume=resume)
+    catalog = PackageCatalog()
+    validator = None
+    if validate:
+        from endpoint_validation import ResourceValidator
+
+        validator = ResourceValidator()
+
+    def checked(publish):
+        publish = catalog.wrap(publish)
+        if validator is not None:
+            publish = validator.wrap(publish, validate)
+        return publish
+
+    try:
+        if sync:
+            from ckan_sync import PackageSync
+
+            package_sync = PackageSync(os.getenv('org_ckan_name'))
+            publish = journal.wrap(checked(package_sync.publish), on_skip=package_sync.skip)
+            for target in targets:
+                publishers[target](publish=publish)
+            # only reached when every package was published
+            if delete_orphans:
+                package_sync.delete_orphans(catalog)
+            print(f"sync finished: {package_sync.summary()}")
+        else:
+            publish = journal.wrap(checked(publish_dataset))
+            for target in targets:
+                publishers[target](publish=publish)
+    finally:
+        if validator is not None:
+            validator.close()
+            validator.write_report()
+        catalog.close()
+        journal.close()
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Register the CLM and ITS datasets in CKAN")
+    parser.add_argument("--sync", action="store_true",
+                        help="create new packages, patch changed ones and skip unchanged ones "
+                             "instead of creating every package")
+    parser.add_argument("--delete-orphans", action="store_true",
+                        help="with --sync, delete the clm-/its- packages that are no longer generated")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="run the CLM ingest on the asyncio pipeline")
+    parser.add_argument("--refresh", action="store_true",
+                        help="revalidate every cached RRK and GeoServer response")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip the packages the run journal confirms as published with the same content")
+    parser.add_argument("--validate", choices=('report', 'flag', 'drop'),
+                        help="check every resource endpoint before publishing and report, flag or drop "
+                             "the broken ones")
+    parser.add_argument("--profile", metavar="DIR",
+                        help="write a CPU profile, stage timeline, memory snapshots and the slowest datasets to DIR")
+    args = parser.parse_args()
+
+    if args.refresh:
+        import http_cache
+
+        http_cache.refresh = True
+
+    if args.profile:
+        profiling.start(args.profile)
+    success = False
     try:
-        save_its_to_ckan()
-        save_clm_to_ckan()
+        publish_clm_and_its(sync=args.sync, delete_orphans=args.delete_orphans, use_async=args.use_async,
+                            resume=args.resume, validate=args.validate)
+        success = True
     except BaseException as e:
         if "That URL is already in use." in str(e):
             print(f"Error: the dataset with the same name exists in CKAN")
@@ -16,3 +121,6 @@ if __name__ == "__main__":
             print(f"Error: No orgnaization in CKAN has the name: {os.getenv('org_ckan_name')}")
         else:
             print(f"Error: {str(e)}")
+    finally:
+        profiling.stop()
+        metrics.write_reports(success)
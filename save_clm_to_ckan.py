@@ -6,19 +6,32 @@
 #
 """
 
+import argparse
 import json
 import os
 import re
 import unicodedata
 import xml.etree.ElementTree as ET
 import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
 from dotenv import load_dotenv
-from pyproj import Transformer
 
-from dataset_hierarchy import get_category, get_clm_hierarchy
+import metrics
+import profiling
+from capabilities_extent import WCS_URL, WFS_URL, WMS_URL, lookup_extent, lookup_lat_lon_bbox
+from ckan_publish import publish_dataset
+from coordinates import convert_coordinates_to_lat_lon
+from dataset_hierarchy import HierarchyIndex, get_clm_hierarchy
+from download_metadata import lookup_download_metadata
+from download_urls import find_download_url, load_download_url_index, report_download_urls
+from http_cache import cached_get
+from http_client import ckan_action
+from metrics import timed
+from package_export import PackageExporter, with_outcome
+from package_fields import slugify
 from wms_extent import get_extent_for_wms_layer
+from worker_pool import run_ordered
 
 
 load_dotenv()
@@ -50,24 +63,7 @@ def fix_text(input_text):
     return normalized
 
 
-def convert_coordinates_to_lat_lon(lower_coords, upper_coords):
-    """
-    Convert bounding box coordinates from EPSG:3310 to latitude and longitude (EPSG:4326).
-
-    Parameters:
-    - lower_coords: list of float, lower corner coordinates [x_min, y_min].
-    - upper_coords: list of float, upper corner coordinates [x_max, y_max].
-
-    Returns:
-    - lat_lon_bbox: tuple, ((lat_min, lon_min), (lat_max, lon_max)).
-    """
-
-    transformer = Transformer.from_crs("EPSG:3310", "EPSG:4326", always_xy=True)
-    lon_min, lat_min = transformer.transform(lower_coords[0], lower_coords[1])
-    lon_max, lat_max = transformer.transform(upper_coords[0], upper_coords[1])
-    return ((lat_min, lon_min), (lat_max, lon_max))
-
-
+@timed('get_wcs_extent')
 def get_wcs_extent(wcs_url, coverage_id):
     """
     Get the extent (bounding box) of a WCS coverage.
@@ -79,11 +75,16 @@ def get_wcs_extent(wcs_url, coverage_id):
     Returns:
     - bbox: tuple, (lower_corner, upper_corner) of the bounding box.
     """
-    # Construct the DescribeCoverage request URL
-    describe_coverage_url = f"{wcs_url}?service=WCS&version=2.0.1&request=DescribeCoverage&coverageId={coverage_id}"
+    # Construct the DescribeCoverage request parameters
+    params = {
+        'service': 'WCS',
+        'version': '2.0.1',
+        'request': 'DescribeCoverage',
+        'coverageId': coverage_id
+    }
 
     # Make the request
-    response = requests.get(describe_coverage_url)
+    response = cached_get(wcs_url, params=params)
 
     # Check if the request was successful
     if response.status_code != 200:
@@ -125,6 +126,26 @@ def get_wcs_extent(wcs_url, coverage_id):
     return None
 
 
+def get_layer_extents(layer_name):
+    """
+    Get the WCS extent of a layer from the harvested WCS capabilities, and the
+    WFS extent if it is a vector layer. DescribeCoverage is only requested for
+    layers that are missing from both capabilities documents.
+
+    Parameters:
+    - layer_name: str, the GeoServer layer name.
+
+    Returns:
+    - (wcs_extent, wfs_extent): each is (lower_corner, upper_corner, epsg_code) or None.
+    """
+    kind, extent = lookup_extent(layer_name)
+    if kind == 'coverage' and extent:
+        return extent, None
+    if kind == 'feature':
+        return None, extent
+    return get_wcs_extent(WCS_URL, layer_name), None
+
+
 def fix_title(text):
     # First apply the standard title case
     title = text.title()
@@ -162,22 +183,40 @@ def fix_title(text):
     return ' '.join(words).replace('Sdi:', 'SDI:').replace('Fsh:', 'FSH').replace('(Cso)', '(CSO)')
 
 
-def slugify(title):
-    # Normalize unicode characters
-    name = unicodedata.normalize('NFKD', title).encode('ascii', 'ignore').decode('ascii')
+def get_gis_service(rrk_dataset):
+    gis_service = rrk_dataset['gis_services'][0]
+
+    # fix an error
+    if gis_service['layer_name'] == 'rrk:predlightningigncause_19922015_202406_t3_v5':
+        gis_service['layer_name'] = 'wldfireigncauselightning_19922020_202312_t1_v5'
+    return gis_service
+
+
+def get_dataset_extents(rrk_dataset):
+    """
+    Look up the extents of the layer of a dataset on GeoServer.
 
-    # Convert to lowercase and replace spaces with hyphens
-    name = re.sub(r'[^\w\s-]', '', name.lower())
-    name = re.sub(r'[-\s]+', '-', name).strip('-')
+    Parameters:
+    - rrk_dataset: dict, the RRK dataset.
 
-    # Ensure it starts with a letter
-    name = re.sub(r'^[^a-zA-Z]+', '', name)
+    Returns:
+    - (lat_lon_bbox, wcs_extent): lat_lon_bbox is ((lat_min, lon_min), (lat_max, lon_max))
+      or None; wcs_extent is (lower_corner, upper_corner, epsg_code), or None for vector layers.
+    """
+    layer_name = get_gis_service(rrk_dataset)['layer_name']
+    lat_lon_bbox = get_extent_for_wms_layer(layer_name)
 
-    # Truncate to 100 characters
-    return name[:96]
+    wcs_extent, wfs_extent = get_layer_extents(layer_name)
+    native_extent = wcs_extent or wfs_extent
+    if not lat_lon_bbox and native_extent:
+        lat_lon_bbox = lookup_lat_lon_bbox(layer_name) or \
+            convert_coordinates_to_lat_lon(native_extent[0], native_extent[1], native_extent[2] or "3310")
+    return lat_lon_bbox, wcs_extent
 
 
-def transform_to_ckan_package(rrk_dataset, org, category, label, dataset_keyword_map, dataset_download_urls):
+@timed('transform_to_ckan_package')
+def transform_to_ckan_package(rrk_dataset, org, category, label, dataset_keyword_map, download_url_index,
+                              extents=None):
 
     title = fix_text(rrk_dataset['name'])
 
@@ -285,14 +324,11 @@ def transform_to_ckan_package(rrk_dataset, org, category, label, dataset_keyword
     for keyword in keywords:
         tags.append({'name': keyword})
             
-    gis_service = rrk_dataset['gis_services'][0]
+    gis_service = get_gis_service(rrk_dataset)
 
-    # fix an error
-    if gis_service['layer_name'] == 'rrk:predlightningigncause_19922015_202406_t3_v5':
-        gis_service['layer_name'] = 'wldfireigncauselightning_19922020_202312_t1_v5'
-    
-    lat_lon_bbox = get_extent_for_wms_layer(gis_service['layer_name'])
-    wcs_extent = None
+    if extents is None:
+        extents = get_dataset_extents(rrk_dataset)
+    lat_lon_bbox, wcs_extent = extents
     if lat_lon_bbox:
         spatial_geojson = {
             "type": "Polygon",
@@ -309,25 +345,6 @@ def transform_to_ckan_package(rrk_dataset, org, category, label, dataset_keyword
             "key": "spatial",
             "value": json.dumps(spatial_geojson)
         })
-    
-    wcs_extent = get_wcs_extent("https://sparcal.sdsc.edu/geoserver/rrk/wcs", gis_service['layer_name'])
-    if not lat_lon_bbox and wcs_extent:
-        lat_lon_bbox = convert_coordinates_to_lat_lon(wcs_extent[0], wcs_extent[1])
-        spatial_geojson = {
-            "type": "Polygon",
-            "coordinates": [[
-                [lat_lon_bbox[0][1], lat_lon_bbox[0][0]],  # Lower-left corner (lon_min, lat_min)
-                [lat_lon_bbox[1][1], lat_lon_bbox[0][0]],  # Lower-right corner (lon_max, lat_min)
-                [lat_lon_bbox[1][1], lat_lon_bbox[1][0]],  # Upper-right corner (lon_max, lat_max)
-                [lat_lon_bbox[0][1], lat_lon_bbox[1][0]],  # Upper-left corner (lon_min, lat_max)
-                [lat_lon_bbox[0][1], lat_lon_bbox[0][0]]   # Close the polygon (lon_min, lat_min)
-            ]]
-        }
-    
-        extras.append({
-            "key": "spatial",
-            "value": json.dumps(spatial_geojson)
-        })
         
     resources = rrk_package_dict['resources']        
     wms_resource = {
@@ -335,7 +352,7 @@ def transform_to_ckan_package(rrk_dataset, org, category, label, dataset_keyword
         "description": f"Web Map Service (WMS) endpoint providing visualization capabilities  for {fix_title(title.title())}. Supports standard WMS operations including GetMap, GetCapabilities, and GetFeatureInfo.",
         "format": "WMS",
         "resource_type": "api",
-        "url": "https://sparcal.sdsc.edu/geoserver/rrk/wms",
+        "url": WMS_URL,
         "mimetype": "text/xml",
         "wms_layer": gis_service['layer_name'],
         "wms_version": "1.3.0",
@@ -350,7 +367,7 @@ def transform_to_ckan_package(rrk_dataset, org, category, label, dataset_keyword
             "description": f"Web Coverage Service (WCS) endpoint providing direct access to the raw raster data values for {fix_title(title.title())}. ",
             "format": "WCS",
             "resource_type": "api",
-            "url": "https://sparcal.sdsc.edu/geoserver/rrk/wcs",
+            "url": WCS_URL,
             "mimetype": "text/xml",
             "wcs_coverage_id": gis_service['layer_name'].replace(':', '__'),
             "wcs_version": "2.0.1",
@@ -369,7 +386,7 @@ def transform_to_ckan_package(rrk_dataset, org, category, label, dataset_keyword
             "description": f"Web Feature Service (WFS) endpoint for {fix_title(title.title())}",
             "format": "WFS",
             "resource_type": "api",
-            "url": "https://sparcal.sdsc.edu/geoserver/rrk/wfs",
+            "url": WFS_URL,
             "mimetype": "text/xml",
             "wfs_feature_id": gis_service['layer_name'],
             "wfs_version": "1.1.0",
@@ -383,10 +400,7 @@ def transform_to_ckan_package(rrk_dataset, org, category, label, dataset_keyword
             "value": "Shapefile"
         })
         
-    download_url = None
-    for download_url in dataset_download_urls:
-        if rrk_dataset['file_path'] in download_url:
-            break
+    download_url = find_download_url(download_url_index, rrk_dataset['file_path'])
     if download_url:
         download_resource = {
             "name": f"[DATA] {fix_title(title.title())}",
@@ -397,35 +411,13 @@ def transform_to_ckan_package(rrk_dataset, org, category, label, dataset_keyword
             "mimetype": "application/zip",
             "compression": "zip",
         }
+        # size, last_modified and etag from a HEAD, when the zip is reachable
+        download_resource.update(lookup_download_metadata(download_url))
         resources.append(download_resource)
         
     return rrk_package_dict
 
 
-def create_dataset(dataset_dict):
-    ckan_url = os.getenv('ckan_url')
-    api_key = os.getenv('api_key')
-    headers = {
-        'X-CKAN-API-Key': api_key,
-        'Content-Type': 'application/json'
-    }
-
-    # create dataset
-    api_url = f"{ckan_url}/api/3/action/package_create"
-
-    # Make the API request to create a new dataset
-    response = requests.post(api_url, data=json.dumps(dataset_dict), headers=headers)
-
-    # Check the response
-    if response.status_code == 200:
-        created_package = response.json()['result']
-        # print('-' * 70)
-        # print("Dataset created successfully:")
-        # print(json.dumps(created_package, indent=2))
-    else:
-        raise BaseException(f"Error creating dataset: {response.text}")
-
-
 def fix_metadata(dataset):
     if dataset['name'] == 'Tree Mortality - Past 1 Year':
         dataset["dataset_metadata"] = [
@@ -511,6 +503,7 @@ the Sierra Nevada region.""",
         ]
 
 
+@timed('validate_org')
 def validate_org(org_name):
     """
     Validate if an organization exists in CKAN.
@@ -523,80 +516,180 @@ def validate_org(org_name):
     Returns:
     - bool: True if the organization exists, False otherwise
     """
-    ckan_url = os.getenv('ckan_url')
-    api_key = os.getenv('api_key')
-    headers = {
-        'X-CKAN-API-Key': api_key,
-        'Content-Type': 'application/json'
-    }
-    
-    endpoint = f"{ckan_url}/api/3/action/organization_show"
     params = {
         "id": org_name
     }
 
-    response = requests.get(endpoint, headers=headers, params=params)
+    response = ckan_action('organization_show', params=params)
 
     if response.status_code != 200:
         raise BaseException(f"The organization {org_name} doesn't exist in CKAN.")
 
         
-def save_clm_to_ckan():
-    
-    # load CLM datasets from fast api
+@timed('get_clm_dataset_page')
+def get_clm_dataset_page(skip, limit):
+    """
+    Fetch one page of the RRK CLM dataset collection, ordered by dataset_id.
+    """
     url = os.getenv('rrk_api_url')
+    params = {
+        'skip': skip,
+        'limit': limit,
+        'order_by': 'dataset_id',
+        'ascending': 'true'
+    }
+    response = cached_get(f"{url}/DatasetCollection/100/Dataset", params=params)
+    response.raise_for_status()
+    return response.json()
+
+
+def get_page_size():
+    return int(os.getenv('rrk_page_size', 500))
+
+
+def next_skip(skip, page, last_id):
+    """
+    Check that a page continues the previous one and return the offset of
+    the next page, so that an API ignoring skip cannot loop forever.
+    """
+    if last_id is not None and page[0]['dataset_id'] <= last_id:
+        raise BaseException(f"The RRK API returned dataset {page[0]['dataset_id']} again at offset {skip}")
+    return skip + len(page)
+
+
+def iter_clm_datasets(page_size=None):
+    """
+    Page through the RRK CLM dataset collection until it is exhausted,
+    fetching the next page in the background while the current one is
+    processed.
+
+    Parameters:
+    - page_size: int, datasets per request (rrk_page_size in .env, 500 by default).
+
+    Yields:
+    - dict, one RRK dataset, in dataset_id order.
+    """
+    if page_size is None:
+        page_size = get_page_size()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        skip = 0
+        last_id = None
+        next_page = executor.submit(get_clm_dataset_page, skip, page_size)
+        while True:
+            page = next_page.result()
+            # an empty page ends the collection; a short one may only mean
+            # the API caps the page size
+            if not page:
+                return
+            skip = next_skip(skip, page, last_id)
+            last_id = page[-1]['dataset_id']
+            next_page = executor.submit(get_clm_dataset_page, skip, page_size)
+            yield from page
+
+
+def prepare_dataset(dataset, hierarchy):
+    """
+    Fix the missing metadata of a dataset and look up its category.
+
+    Returns:
+    - (category, label)
+    """
+    # print("=" * 70)
+    # print(json.dumps(dataset, indent=4))
+
+    # fix missing metadata for three datasets
+    has_notes = False
+    for metadata in dataset["dataset_metadata"]:
+        if metadata["name"] == 'metric_definition_and_relevance':
+            has_notes = True
+    if not has_notes:
+        fix_metadata(dataset)
+                
+    # get hierarchy and label 
+    return hierarchy.get_category(dataset["dataset_id"])
+
+
+def save_clm_to_ckan(workers=None, publish=None):
+    """
+    Register every CLM dataset in CKAN.
+
+    Packages are transformed and created concurrently on a pool of `workers`
+    threads (publish_workers in .env, 8 by default). A failing package does
+    not stop the batch; failures are reported once all packages are done.
+
+    Parameters:
+    - workers: int, number of packages processed in parallel.
+    - publish: callable, sends a package dict to CKAN, publish_dataset by default.
+    """
+    if publish is None:
+        publish = publish_dataset
+    
     org = os.getenv('org_ckan_name')
     validate_org(org)
   
-    response = requests.get(f"{url}/DatasetCollection/100/Dataset?skip=0&limit=500&order_by=dataset_id&ascending=true")
-    response.raise_for_status()
-    datasets = response.json()
-
     # load clm hierarchy
-    hierarchy = get_clm_hierarchy()
+    hierarchy = HierarchyIndex(get_clm_hierarchy())
 
     # load clm download urls
-    with open("clm_download_urls.json", "r") as json_file:
-        dataset_download_urls = json.load(json_file)
-        
+    download_url_index = load_download_url_index("clm_download_urls.json")
+
     # load precalculated keywords
     with open("dataset_keywords_map.json", "r") as json_file:
         dataset_keywords_map = json.load(json_file)
 
-    packages = []
-    for index, dataset in enumerate(datasets):
-        # print("=" * 70)
-        # print(json.dumps(dataset, indent=4))
-
-        # fix missing metadata for three datasets
-        has_notes = False
-        for metadata in dataset["dataset_metadata"]:
-            if metadata["name"] == 'metric_definition_and_relevance':
-                has_notes = True
-        if not has_notes:
-            fix_metadata(dataset)
-                    
-        # get hierarchy and label 
-        category, label = get_category(dataset["dataset_id"], hierarchy)
+    def process(dataset):
+        category, label = prepare_dataset(dataset, hierarchy)
 
         # create json for CKAN package 
-        package_dict = transform_to_ckan_package(dataset, org, category, label, dataset_keywords_map, dataset_download_urls)
+        package_dict = transform_to_ckan_package(dataset, org, category, label, dataset_keywords_map, download_url_index)
 
         if not "notes" in package_dict.keys():
             raise ValueError(f'No notes: {package_dict["name"]}')
 
-        packages.append(package_dict)
-        
-        print(f"creating {package_dict['title']}")
-        create_dataset(package_dict)
-        
-    with open("/tmp/rrk.json", "w") as json_file:
-        json.dump(packages, json_file, indent=4)
+        # a package that fails to publish is still exported, with its error
+        try:
+            return with_outcome(package_dict, publish(package_dict)), None
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except BaseException as e:
+            return with_outcome(package_dict, error=e), e
+
+    def tracked_process(dataset):
+        return profiling.track(dataset['name'], process)(dataset)
+
+    # load CLM datasets from fast api page by page as they are processed;
+    # packages are exported in dataset order with the outcome of their publish
+    file_paths = []
+    failures = []
+    with PackageExporter() as exporter:
+        for dataset, result, error in run_ordered(tracked_process, iter_clm_datasets(), workers):
+            file_paths.append(dataset['file_path'])
+            if error is None:
+                record, error = result
+                exporter.write(record)
+            if error is not None:
+                print(f"failed {dataset['name']}: {error}")
+                failures.append((dataset['name'], error))
+
+    report_download_urls(download_url_index, file_paths)
+
+    if failures:
+        raise BaseException(f"{len(failures)} of {len(file_paths)} CLM datasets failed: " +
+                            "; ".join(f"{name}: {error}" for name, error in failures))
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Register the CLM datasets in CKAN")
+    parser.add_argument("--profile", metavar="DIR",
+                        help="write a CPU profile, stage timeline, memory snapshots and the slowest datasets to DIR")
+    args = parser.parse_args()
+
+    if args.profile:
+        profiling.start(args.profile)
+    success = False
     try:
         save_clm_to_ckan()
+        success = True
     except BaseException as e:
         if "That URL is already in use." in str(e):
             print(f"Error: the dataset with the same name exists in CKAN")
@@ -605,3 +698,6 @@ if __name__ == "__main__":
         else:
             print(f"Error: {str(e)}")
             raise
+    finally:
+        profiling.stop()
+        metrics.write_reports(success)
@@ -1,12 +1,14 @@
 import os
 import json
-from save_clm_to_ckan import create_dataset, slugify
+from arcgis_harvest import harvest_its_layers, layer_url, merge_bboxes, merge_statistics
+from ckan_publish import publish_dataset
+from package_fields import slugify
 from dotenv import load_dotenv
 
 load_dotenv()
 
 
-def save_its_to_ckan():
+def save_its_to_ckan(publish=publish_dataset):
     title = "California Wildfire & Landscape Resilience Interagency Treatments"
     name = slugify(f'its-{title}')
     org = os.getenv('org_ckan_name')
@@ -24,20 +26,30 @@ What is included in the geodatabase download?
 The geodatabase provided here provides treatment point, line, and polygon data from state and federal land management databases covering the State of California. Please see the documentation available at https://wildfiretaskforce.org/treatment-dashboard/ for information on the original data sources and processing procedures. The information in the geodatabase contains the data processed into the Interagency Treatment Tracking System schema. A subset of these data are included on the Dashboard, but the geodatabase includes activity types (such as some forms of timber harvest or ecological restoration) and years of data that are not included on the Dashboard. The additional data should not be considered complete and comprehensive because there are known gaps in the source data.
     """
 
-    lat_lon_bbox = ((-1383489.9179190733, 3836082.3922780156), (-12735118.01130016, 5161279.835675545))
+    # the extent and counts of the FeatureServer layers, in EPSG:4326; a
+    # partial harvest is not published, it would replace the values in CKAN
+    layers = harvest_its_layers()
+    failed = [layer_name for layer_name, layer in layers.items() if layer is None]
+    if failed:
+        raise BaseException(f"Not publishing the ITS package, failed to harvest the ArcGIS layers {', '.join(failed)}")
+    harvested = list(layers.values())
+    bbox = merge_bboxes(layer['bbox'] for layer in harvested)
+    if bbox is None:
+        raise BaseException("Not publishing the ITS package, none of the ArcGIS layers has an extent")
+    min_lon, min_lat, max_lon, max_lat = bbox
     spatial_geojson = {
         "type": "Polygon",
         "coordinates": [[
-            [lat_lon_bbox[0][1], lat_lon_bbox[0][0]],  # Lower-left corner (lon_min, lat_min)
-            [lat_lon_bbox[1][1], lat_lon_bbox[0][0]],  # Lower-right corner (lon_max, lat_min)
-            [lat_lon_bbox[1][1], lat_lon_bbox[1][0]],  # Upper-right corner (lon_max, lat_max)
-            [lat_lon_bbox[0][1], lat_lon_bbox[1][0]],  # Upper-left corner (lon_min, lat_max)
-            [lat_lon_bbox[0][1], lat_lon_bbox[0][0]]  # Close the polygon (lon_min, lat_min)
+            [min_lon, min_lat],
+            [max_lon, min_lat],
+            [max_lon, max_lat],
+            [min_lon, max_lat],
+            [min_lon, min_lat]
         ]],
         "crs": {
             "type": "name",
             "properties": {
-                "name": "urn:ogc:def:crs:EPSG::3857"
+                "name": "urn:ogc:def:crs:EPSG::4326"
             }
         }
     }
@@ -58,17 +70,17 @@ The geodatabase provided here provides treatment point, line, and polygon data f
             }, {
                 "name": "ITS_V1_1_points_gdb",
                 "description": "Point geometries from ITS_Geodatabase_V1.1",
-                "url": "https://sparcal.sdsc.edu/arcgis/rest/services/Hosted/ITS_V1_1_points_gdb/FeatureServer/0",
+                "url": layer_url("ITS_V1_1_points_gdb"),
                 "format": "ArcGIS Feature Service",
             }, {
                 "name": "ITS_V1_1_lines_gdb",
                 "description": "Line geometries from ITS_Geodatabase_V1.1",
-                "url": "https://sparcal.sdsc.edu/arcgis/rest/services/Hosted/ITS_V1_1_lines_gdb/FeatureServer/0",
+                "url": layer_url("ITS_V1_1_lines_gdb"),
                 "format": "ArcGIS Feature Service",
             }, {
                 "name": "ITS_V1_1_polygons_gdb",
                 "description": "Polygon geometries from ITS_Geodatabase_V1.1",
-                "url": "https://sparcal.sdsc.edu/arcgis/rest/services/Hosted/ITS_V1_1_polygons_gdb/FeatureServer/0",
+                "url": layer_url("ITS_V1_1_polygons_gdb"),
                 "format": "ArcGIS Feature Service",
             }
         ],
@@ -91,12 +103,26 @@ The geodatabase provided here provides treatment point, line, and polygon data f
                 "value": json.dumps(spatial_geojson)
             }, {
                 "key": "EPSG",
-                "value": "3857"
+                "value": "4326"
             }
         ]
     }
-    print(f"creating {package_dict['title']}")
-    create_dataset(package_dict)
+
+    for resource in package_dict['resources']:
+        layer = layers.get(resource['name'])
+        if layer is not None:
+            resource['feature_count'] = layer['count']
+            resource['agency_statistics'] = json.dumps(layer['statistics'], sort_keys=True)
+    package_dict['extras'].extend([
+        {
+            "key": "Feature Count",
+            "value": str(sum(layer['count'] for layer in harvested))
+        }, {
+            "key": "Agency Statistics",
+            "value": json.dumps(merge_statistics(harvested), sort_keys=True)
+        }
+    ])
+    publish(package_dict)
 
 
 if __name__ == "__main__":
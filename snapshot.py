@@ -0,0 +1,132 @@
+"""
+#
+# Record the upstream responses of a run (RRK API, GeoServer, CKAN reads)
+# into a snapshot bundle, and replay them later without any network access
+#
+"""
+
+import hashlib
+import io
+import json
+import os
+import threading
+from http import HTTPStatus
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+import http_cache
+from http_client import get_session
+
+UNREPLAYED_HEADERS = ('content-encoding', 'transfer-encoding', 'connection', 'keep-alive')
+
+
+def request_key(method, url):
+    """
+    Identify a request by its method and URL, with the query parameters
+    sorted so that their order does not matter.
+    """
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return f"{method} {urlunsplit((parts.scheme, parts.netloc, parts.path, query, ''))}"
+
+
+class SnapshotAdapter(BaseAdapter):
+    """
+    A requests transport adapter backed by a snapshot bundle: a directory
+    holding index.json, which maps request keys to their status, URL and
+    headers, and one file per response body.
+
+    In record mode requests are sent through a regular HTTPAdapter and the
+    responses stored; in replay mode they are answered from the bundle and
+    a request missing from it fails at once, without being retried.
+    """
+
+    def __init__(self, directory, record=False):
+        super().__init__()
+        self.directory = directory
+        self.record = record
+        self.lock = threading.Lock()
+        self.index_path = os.path.join(directory, 'index.json')
+        self.index = {}
+        if record:
+            os.makedirs(directory, exist_ok=True)
+            self.http = HTTPAdapter()
+        elif os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                self.index = json.load(f)
+        else:
+            raise BaseException(f"No snapshot in {directory}, record one first")
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        key = request_key(request.method, request.url)
+        if self.record:
+            live = self.http.send(request, stream=False, timeout=timeout, verify=verify, cert=cert, proxies=proxies)
+            entry = {
+                'status': live.status_code,
+                'url': live.url,
+                # the body is stored decoded, so its transfer headers no longer apply
+                'headers': {name: value for name, value in live.headers.items()
+                            if name.lower() not in UNREPLAYED_HEADERS},
+                'body': f"{hashlib.sha256(key.encode('utf-8')).hexdigest()}.body",
+            }
+            with open(os.path.join(self.directory, entry['body']), 'wb') as f:
+                f.write(live.content)
+            with self.lock:
+                self.index[key] = entry
+        else:
+            entry = self.index.get(key)
+            if entry is None:
+                raise requests.exceptions.RequestException(f"{key} is not in the snapshot {self.directory}",
+                                                           request=request)
+        return self.build_response(request, entry)
+
+    def build_response(self, request, entry):
+        with open(os.path.join(self.directory, entry['body']), 'rb') as f:
+            body = f.read()
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.url = entry['url']
+        if 'headers' in entry:
+            response.headers = CaseInsensitiveDict(entry['headers'])
+        else:
+            # recorded before the headers were kept
+            response.headers = CaseInsensitiveDict({'Content-Length': str(len(body))})
+            if entry.get('content_type'):
+                response.headers['Content-Type'] = entry['content_type']
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.raw = io.BytesIO(body)
+        response.request = request
+        try:
+            response.reason = HTTPStatus(entry['status']).phrase
+        except ValueError:
+            response.reason = ''
+        return response
+
+    def close(self):
+        if self.record:
+            with self.lock:
+                tmp_path = f"{self.index_path}.tmp"
+                with open(tmp_path, 'w') as f:
+                    json.dump(self.index, f, indent=1, sort_keys=True)
+                os.replace(tmp_path, self.index_path)
+            self.http.close()
+
+
+def use_snapshot(directory, record=False):
+    """
+    Route every request of the shared session through a snapshot bundle,
+    bypassing the disk cache so that each response is recorded or replayed.
+
+    Returns:
+    - SnapshotAdapter, to be closed at the end of the run to save a recording.
+    """
+    adapter = SnapshotAdapter(directory, record)
+    session = get_session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    http_cache.disabled = True
+    return adapter
@@ -0,0 +1,7 @@
+import os
+import sys
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT_DIR)
+# the fake servers of the benchmarks
+sys.path.insert(1, os.path.join(ROOT_DIR, 'benchmarks'))
@@ -0,0 +1,129 @@
+import math
+import os
+import threading
+import unittest
+from unittest import mock
+
+import fakes
+
+import arcgis_harvest
+import save_its_to_ckan
+
+LAYER = 'ITS_V1_1_points_gdb'
+FEATURES = 2500
+MAX_RECORD_COUNT = 300
+
+
+def expected_statistics(count, area_field=None):
+    statistics = {}
+    for i in range(count):
+        attributes = fakes.its_feature(i)
+        arcgis_harvest.add_statistics(statistics, attributes['AGENCY'], 1,
+                                      attributes['TREATED_ACRES'] if area_field else None)
+    return statistics
+
+
+class HarvestLayerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = fakes.FakeServer()
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.environ = mock.patch.dict(os.environ, {
+            'its_arcgis_url': f"{cls.server.base_url}/arcgis/rest/services/Hosted",
+        })
+        cls.environ.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.environ.stop()
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def reset(self, statistics):
+        self.server.state.reset({'its_features': FEATURES, 'arcgis_statistics': statistics,
+                                 'arcgis_max_record_count': MAX_RECORD_COUNT})
+
+    def requests(self, route):
+        return self.server.state.stats[route]['requests']
+
+    def assert_extent(self, bbox):
+        extent = fakes.its_extent(LAYER)
+        for value, expected in zip(bbox, (extent['xmin'], extent['ymin'], extent['xmax'], extent['ymax'])):
+            self.assertAlmostEqual(value, expected, places=6)
+
+    def test_statistics(self):
+        self.reset(statistics=True)
+        layer = arcgis_harvest.harvest_layer(LAYER, agency_field='agency', area_field='treated_acres')
+
+        self.assertEqual(layer['method'], 'statistics')
+        self.assertEqual(layer['count'], FEATURES)
+        self.assertEqual(layer['statistics'], expected_statistics(FEATURES, area_field=True))
+        self.assertEqual(sum(entry['features'] for entry in layer['statistics'].values()), FEATURES)
+        self.assert_extent(layer['bbox'])
+        self.assertEqual(self.requests('arcgis page'), 0)
+
+    def test_paging_without_statistics(self):
+        self.reset(statistics=False)
+        layer = arcgis_harvest.harvest_layer(LAYER, page_size=1000, workers=3)
+
+        self.assertEqual(layer['method'], 'paging')
+        self.assertEqual(layer['count'], FEATURES)
+        self.assertEqual(layer['statistics'], expected_statistics(FEATURES))
+        self.assert_extent(layer['bbox'])
+        # pages are capped by the maxRecordCount of the layer
+        self.assertEqual(self.requests('arcgis page'), math.ceil(FEATURES / MAX_RECORD_COUNT))
+        self.assertEqual(self.requests('arcgis statistics'), 0)
+
+    def test_unknown_layer(self):
+        self.reset(statistics=True)
+        layers = arcgis_harvest.harvest_its_layers((LAYER, 'ITS_missing'))
+
+        self.assertEqual(layers[LAYER]['count'], FEATURES)
+        self.assertIsNone(layers['ITS_missing'])
+
+    def test_its_package(self):
+        self.reset(statistics=True)
+        published = []
+        save_its_to_ckan.save_its_to_ckan(publish=published.append)
+
+        extras = {extra['key']: extra['value'] for extra in published[0]['extras']}
+        self.assertEqual(int(extras['Feature Count']), sum(
+            int(FEATURES * fakes.ITS_LAYERS[layer][0]) for layer in arcgis_harvest.ITS_LAYERS))
+
+    def test_partial_harvest_is_not_published(self):
+        self.reset(statistics=True)
+        published = []
+        harvest = lambda: arcgis_harvest.harvest_its_layers((LAYER, 'ITS_missing'))
+        with mock.patch.object(save_its_to_ckan, 'harvest_its_layers', harvest):
+            with self.assertRaises(BaseException) as raised:
+                save_its_to_ckan.save_its_to_ckan(publish=published.append)
+
+        self.assertIn('ITS_missing', str(raised.exception))
+        self.assertEqual(published, [])
+
+
+class EnvelopeToBboxTest(unittest.TestCase):
+
+    def test_web_mercator(self):
+        bbox = arcgis_harvest.envelope_to_bbox(fakes.its_extent(LAYER, web_mercator=True))
+        extent = fakes.its_extent(LAYER)
+        for value, expected in zip(bbox, (extent['xmin'], extent['ymin'], extent['xmax'], extent['ymax'])):
+            self.assertAlmostEqual(value, expected, places=6)
+
+    def test_wkid_102100_only(self):
+        envelope = fakes.its_extent(LAYER, web_mercator=True)
+        envelope['spatialReference'] = {'wkid': 102100}
+        bbox = arcgis_harvest.envelope_to_bbox(envelope)
+        self.assertAlmostEqual(bbox[0], fakes.its_extent(LAYER)['xmin'], places=6)
+
+    def test_empty_extent(self):
+        self.assertIsNone(arcgis_harvest.envelope_to_bbox(None))
+        self.assertIsNone(arcgis_harvest.envelope_to_bbox({}))
+        self.assertIsNone(arcgis_harvest.envelope_to_bbox({'xmin': 'NaN', 'ymin': 'NaN', 'xmax': 'NaN',
+                                                           'ymax': 'NaN', 'spatialReference': {'wkid': 4326}}))
+        self.assertIsNone(arcgis_harvest.envelope_to_bbox({'xmin': None, 'spatialReference': {'wkid': 102100}}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,75 @@
+import threading
+
 import requests
+import urllib3
 import xml.etree.ElementTree as ET
 
-layers = None
-
+from capabilities_extent import WMS_URL, normalize_layer_name
+from http_cache import cached_get
+from metrics import timed
 
+layers = None
+layer_index = None
+ambiguous_layers = set()
+layers_lock = threading.Lock()
+
+
+def iter_wms_layers(source):
+    """
+    Parse a WMS GetCapabilities document incrementally and yield one record
+    per named layer, without duplicates.
+
+    Tags are matched on their local name, so the document can use the WMS
+    namespace or none at all. Each Layer is read from its direct Name, Title
+    and first BoundingBox children once it is closed, and then cleared, so
+    memory stays flat however many layers the document lists.
+
+    Parameters:
+    - source: str or file object, the capabilities document.
+
+    Yields:
+    - dict: {'name': str, 'title': str, 'bbox': {'minx', 'miny', 'maxx', 'maxy'}}
+    """
+    local_names = {}
+    seen = set()
+
+    for _, elem in ET.iterparse(source, events=('end',)):
+        tag = local_names.get(elem.tag)
+        if tag is None:
+            tag = local_names[elem.tag] = elem.tag.rsplit('}', 1)[-1]
+        if tag != 'Layer':
+            continue
+
+        name = None
+        title = None
+        bbox = None
+        for kid in elem:
+            kid_tag = local_names.get(kid.tag) or kid.tag.rsplit('}', 1)[-1]
+            if kid_tag == 'Name' and name is None:
+                name = kid.text
+            elif kid_tag == 'Title' and title is None:
+                title = kid.text
+            elif kid_tag == 'BoundingBox' and bbox is None:
+                bbox = {
+                    'minx': kid.get('minx'),
+                    'miny': kid.get('miny'),
+                    'maxx': kid.get('maxx'),
+                    'maxy': kid.get('maxy')
+                }
+
+        # nested layers were already emitted, drop the whole subtree
+        elem.clear()
+
+        if name and name not in seen:
+            seen.add(name)
+            yield {
+                'name': name,
+                'title': title,
+                'bbox': bbox
+            }
+
+
+@timed('get_wms_info')
 def get_wms_info(wms_url):
     params = {
         'service': 'WMS',
@@ -12,99 +78,82 @@ def get_wms_info(wms_url):
     }
 
     try:
-        # Make request
-        response = requests.get(wms_url, params=params)
-
-        # Try to fix common XML issues
-        xml_text = response.text
+        # Make request and parse the cached response as it is read
+        response = cached_get(wms_url, params=params, stream=True)
+        if response.status_code != 200:
+            print(f"Failed to retrieve WMS capabilities: {response.status_code}")
+            response.close()
+            return None
 
-        # Try to parse XML
         try:
-            # Parse XML using default parser
-            root = ET.fromstring(xml_text)
-
-            # Find layers (try different possible paths)
-            layers = []
-            for path in [
-                './/{http://www.opengis.net/wms}Layer',
-                './/Layer',
-                './Capability/Layer/Layer'  # Common path in WMS 1.1.1
-            ]:
-                layers.extend(root.findall(path))
-
-            layers_info = []
-            for layer in layers:
-                try:
-                    # Try different possible tag paths
-                    name = None
-                    for name_path in ['./{http://www.opengis.net/wms}Name', './Name']:
-                        name_elem = layer.find(name_path)
-                        if name_elem is not None:
-                            name = name_elem.text
-                            break
-
-                    title = None
-                    for title_path in ['./{http://www.opengis.net/wms}Title', './Title']:
-                        title_elem = layer.find(title_path)
-                        if title_elem is not None:
-                            title = title_elem.text
-                            break
-
-                    bbox = None
-                    for bbox_path in ['./{http://www.opengis.net/wms}BoundingBox', './BoundingBox']:
-                        bbox_elem = layer.find(bbox_path)
-                        if bbox_elem is not None:
-                            bbox = {
-                                'minx': bbox_elem.get('minx'),
-                                'miny': bbox_elem.get('miny'),
-                                'maxx': bbox_elem.get('maxx'),
-                                'maxy': bbox_elem.get('maxy')
-                            }
-                            break
-
-                    if name:  # Only add if we found a name
-                        layer_info = {
-                            'name': name,
-                            'title': title,
-                            'bbox': bbox
-                        }
-                        layers_info.append(layer_info)
-
-                except Exception as e:
-                    print(f"Error parsing layer: {e}")
-                    continue
-
-            return layers_info
+            return list(iter_wms_layers(response.raw))
 
         except ET.ParseError as e:
-            # If parsing fails, print the XML for debugging
             print(f"XML parsing error: {e}")
-            print("Raw XML response:")
-            print(xml_text[:1000])  # Print first 1000 chars of response
             return None
 
-    except requests.exceptions.RequestException as e:
+        finally:
+            response.close()
+
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
         print(f"Request error: {e}")
         return None
 
 
+def build_layer_index(layers):
+    """
+    Index WMS layers by their name without the workspace prefix.
+
+    Parameters:
+    - layers: list of dict, as returned by get_wms_info.
+
+    Returns:
+    - (index, ambiguous): index maps a normalized layer name to its bbox
+      ((lat_min, lon_min), (lat_max, lon_max)); ambiguous holds the names
+      shared by layers with different bboxes.
+    """
+    index = {}
+    ambiguous = set()
+    for layer in layers:
+        if not layer['bbox']:
+            continue
+        try:
+            lat_min = float(layer['bbox']['miny'])
+            lon_min = float(layer['bbox']['minx'])
+            lat_max = float(layer['bbox']['maxy'])
+            lon_max = float(layer['bbox']['maxx'])
+        except (TypeError, ValueError):
+            print(f"Invalid bbox for WMS layer {layer['name']}: {layer['bbox']}")
+            continue
+
+        key = normalize_layer_name(layer['name'])
+        bbox = ((lat_min, lon_min), (lat_max, lon_max))
+        if key in index and index[key] != bbox:
+            ambiguous.add(key)
+        index.setdefault(key, bbox)
+
+    for key in sorted(ambiguous):
+        names = [layer['name'] for layer in layers if normalize_layer_name(layer['name']) == key]
+        print(f"Ambiguous WMS layer name {key}: {', '.join(names)}")
+    return index, ambiguous
+
+
+def load_layer_index():
+    """
+    Fetch the WMS capabilities and build the layer index, once per run.
+    """
+    global layers, layer_index, ambiguous_layers
+    with layers_lock:
+        if layer_index is None:
+            layers = get_wms_info(WMS_URL)
+            layer_index, ambiguous_layers = build_layer_index(layers or [])
+
+
+@timed('get_extent_for_wms_layer')
 def get_extent_for_wms_layer(layer_name):
-    wms_url = "https://sparcal.sdsc.edu/geoserver/rrk/wms"
-    global layers
-    if layers is None:
-        layers = get_wms_info(wms_url)
-    if layers:
-        for layer in layers:
-            """
-            print(f"Layer: {layer['name']}")
-            print(f"Title: {layer['title']}")
-            print(f"BBox: {layer['bbox']}")
-            print("---")
-            """
-            if layer_name.endswith(layer['name']):
-                lat_min = float(layer['bbox']['miny'])
-                lon_min = float(layer['bbox']['minx'])
-                lat_max = float(layer['bbox']['maxy'])
-                lon_max = float(layer['bbox']['maxx'])
-                return ((lat_min, lon_min), (lat_max, lon_max))
-    return None
+    load_layer_index()
+    key = normalize_layer_name(layer_name)
+    if key in ambiguous_layers:
+        print(f"Skipping the WMS extent of {layer_name}: more than one layer is named {key}")
+        return None
+    return layer_index.get(key)
@@ -0,0 +1,65 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def get_worker_count(default=8):
+    """
+    Read the number of concurrent workers from the environment.
+
+    Parameters:
+    - default: int, used when publish_workers is not set.
+
+    Returns:
+    - int, at least 1.
+    """
+    value = os.getenv('publish_workers')
+    if not value:
+        return default
+    return max(1, int(value))
+
+
+def run_ordered(func, items, workers=None, window=None):
+    """
+    Apply func to every item on a bounded thread pool and yield the outcomes
+    in the same order as the input.
+
+    At most `window` items are in flight at a time, so `items` can be a lazy
+    iterable of any length. An exception raised by func is captured and
+    returned for that item instead of stopping the batch.
+
+    Parameters:
+    - func: callable, applied to each item.
+    - items: iterable, the inputs.
+    - workers: int, size of the thread pool.
+    - window: int, maximum number of submitted but unconsumed items.
+
+    Yields:
+    - (item, result, error): error is None when func succeeded.
+    """
+    if workers is None:
+        workers = get_worker_count()
+    if window is None:
+        window = workers * 2
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        try:
+            for item in items:
+                pending.append((item, executor.submit(func, item)))
+                if len(pending) >= window:
+                    yield _outcome(*pending.popleft())
+            while pending:
+                yield _outcome(*pending.popleft())
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
+def _outcome(item, future):
+    try:
+        return item, future.result(), None
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except BaseException as e:
+        return item, None, e